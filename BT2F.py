@@ -4,6 +4,12 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
+import logging
+
+from integrity import DamagedPage, fetch_verified
+from httpclient import HttpClient
+from pagestore import replacing
+from logsetup import PageLog, setup_logging
 
 class MangaDownloader:
     def __init__(self, manga_name, uppercase=False):
@@ -15,6 +21,8 @@ class MangaDownloader:
         self.manga_folder = Path(self.formatted_manga_name)
         self.executor = ThreadPoolExecutor()
         self.history_file = Path("download_history.txt")
+        self.client = None
+        self.page_log = PageLog()
 
     def format_chapter_number(self, chapter_number):
         if '.' in chapter_number:
@@ -31,19 +39,22 @@ class MangaDownloader:
 
     async def download_image(self, session, url, path):
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    path.parent.mkdir(parents=True, exist_ok=True)  # Create the folder only if the image is successfully downloaded
-                    with open(path, 'wb') as file:
-                        file.write(await response.read())
-                    print(f"Downloaded: {url}")
-                    return True
-                else:
-                    print(f"Failed to download {url}: {response.status}")
-                    return False
+            status, data = await fetch_verified(session, url)
+        except DamagedPage as e:
+            # Keep going with the next page; D4C --verify re-fetches the gap later
+            logging.error("Skipping damaged page %s", e)
+            return True
         except aiohttp.ClientError as e:
-            print(f"Error downloading {url}: {e}")
+            logging.error("Error downloading %s: %s", url, e)
+            return False
+        if status != 200:
+            logging.warning("Failed to download %s: %s", url, status)
             return False
+        path.parent.mkdir(parents=True, exist_ok=True)  # Create the folder only if the image is successfully downloaded
+        with replacing(path) as file:
+            file.write(data)
+        self.page_log.downloaded(url, len(data))
+        return True
 
     def extract_text_from_html(self, html_content):
         pattern = re.compile(r'vm\.CurPathName\s*=\s*"([^"]+)"')
@@ -64,19 +75,20 @@ class MangaDownloader:
                         # Save the manga name to history as soon as it's confirmed valid
                         self.save_history(self.manga_name)
                     else:
-                        print(f"Could not find 'vm.CurPathName' in the page. This might be due to an incorrect manga name '{self.manga_name}' or chapter number '{formatted_chapter_number}'.")
+                        logging.warning("Could not find 'vm.CurPathName' in the page. This might be due to an incorrect manga name '%s' or chapter number '%s'.", self.manga_name, formatted_chapter_number)
                     return manga_address
                 else:
-                    print(f"Error accessing {url}: HTTP {response.status}")
+                    logging.error("Error accessing %s: HTTP %s", url, response.status)
                     return None
         except aiohttp.ClientError as e:
-            print(f"Error accessing {url}: {e}. This might be due to a server issue.")
+            logging.error("Error accessing %s: %s. This might be due to a server issue.", url, e)
             return None
 
     async def download_chapter_images(self, session, chapter_number):
         formatted_chapter_number = self.format_chapter_number(chapter_number)
         manga_address = await self.extract_text_from_url(session, formatted_chapter_number)
         if manga_address:
+            self.client.prewarm(manga_address)
             chapter_folder = self.manga_folder / f"Chapter-{formatted_chapter_number}"
             png_number = 1
             while True:
@@ -91,12 +103,13 @@ class MangaDownloader:
             return False
 
     async def download_chapters(self, chapters_to_download):
-        async with aiohttp.ClientSession() as session:
+        async with HttpClient() as self.client:
             tasks = []
             for chapter_number in chapters_to_download:
-                task = self.download_chapter_images(session, chapter_number)
+                task = self.download_chapter_images(self.client.session, chapter_number)
                 tasks.append(task)
             await asyncio.gather(*tasks)
+        self.page_log.flush()
 
     def save_history(self, manga_name):
         if not self.history_file.exists():
@@ -123,8 +136,10 @@ def main():
     parser.add_argument('-c', '--chapters', metavar='CHAPTERS', type=str, help="Chapters to download, separated by commas")
     parser.add_argument('-H', '--history', action='store_true', help="View download history")
     parser.add_argument('-U', '--uppercase', action='store_true', help="Use uppercase for the manga name")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print every downloaded page instead of periodic summaries")
 
     args = parser.parse_args()
+    setup_logging(verbose=args.verbose)
 
     if args.download and args.chapters:
         manga_name = args.download
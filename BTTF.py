@@ -4,6 +4,9 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from httpclient import HttpClient
+from pagestore import replacing
+
 class MangaDownloader:
     def __init__(self, manga_name):
         self.manga_name = manga_name.title()
@@ -12,6 +15,7 @@ class MangaDownloader:
         self.manga_folder.mkdir(exist_ok=True)
         self.session_pool = ThreadPoolExecutor()
         self.executor = ThreadPoolExecutor()
+        self.client = None
 
     async def generate_image_url(self, chapter_number, png_number, manga_address):
         base_url = f"https://{manga_address}/manga/{{}}/{{}}-{{:03d}}.png"
@@ -20,13 +24,12 @@ class MangaDownloader:
 
     async def download_image(self, url, path):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    response.raise_for_status()
-                    with open(path, 'wb') as file:
-                        file.write(await response.read())
-                    print(f"Downloaded: {url}")
-                    return True
+            async with self.client.session.get(url) as response:
+                response.raise_for_status()
+                with replacing(path) as file:
+                    file.write(await response.read())
+                print(f"Downloaded: {url}")
+                return True
         except aiohttp.ClientError as e:
             print(f"Error downloading {url}: {e}")
             return False
@@ -43,11 +46,10 @@ class MangaDownloader:
     async def extract_text_from_url(self, chapter_number):
         url = f"https://manga4life.com/read-online/{self.formatted_manga_name}-chapter-{chapter_number}.html"
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    response.raise_for_status()
-                    html_content = await response.text()
-                    return self.extract_text_from_html(html_content)
+            async with self.client.session.get(url) as response:
+                response.raise_for_status()
+                html_content = await response.text()
+                return self.extract_text_from_html(html_content)
         except aiohttp.ClientError as e:
             print(f"Error accessing {url}: {e}")
             return None
@@ -57,6 +59,7 @@ class MangaDownloader:
         while True:
             manga_address = await self.extract_text_from_url(chapter_number)
             if manga_address:
+                self.client.prewarm(manga_address)
                 url = await self.generate_image_url(chapter_number, png_number, manga_address)
                 image_filename = "{:03d}.png".format(png_number)
                 image_path = chapter_folder / image_filename
@@ -67,16 +70,20 @@ class MangaDownloader:
             else:
                 break
 
+    async def download_all(self, chapters_to_download):
+        # Every image used to open its own ClientSession; one shared client
+        # keeps the connections alive across pages and chapters
+        async with HttpClient() as self.client:
+            tasks = []
+            for chapter_number in chapters_to_download:
+                chapter_folder_name = f"Chapter: {str(chapter_number).zfill(4)}"
+                chapter_folder = self.manga_folder / chapter_folder_name
+                chapter_folder.mkdir(exist_ok=True)
+                tasks.append(self.download_chapter_images(chapter_number, chapter_folder))
+            await asyncio.gather(*tasks)
+
     def download_chapters(self, chapters_to_download):
-        loop = asyncio.get_event_loop()
-        tasks = []
-        for chapter_number in chapters_to_download:
-            chapter_folder_name = f"Chapter: {str(chapter_number).zfill(4)}"
-            chapter_folder = self.manga_folder / chapter_folder_name
-            chapter_folder.mkdir(exist_ok=True)
-            task = asyncio.ensure_future(self.download_chapter_images(chapter_number, chapter_folder))
-            tasks.append(task)
-        loop.run_until_complete(asyncio.wait(tasks))
+        asyncio.run(self.download_all(chapters_to_download))
 
 def main():
     manga_name = input("Enter the manga name: ")
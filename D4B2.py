@@ -1,3 +1,4 @@
+import os
 import re
 import aiohttp
 import asyncio
@@ -7,6 +8,9 @@ import argparse
 import logging
 import sys
 from colorama import init, Fore, Style
+from integrity import DamagedPage, fetch_verified
+from planner import ResolverCache, MAX_PAGES, resolve_host, plan_download, print_plan
+from httpclient import HttpClient
 
 # Initialize Colorama
 init(autoreset=True)
@@ -24,6 +28,11 @@ class MangaDownloader:
             self.manga_name = manga_name
         else:
             self.manga_name = manga_name.upper() if uppercase else manga_name.title()
+        self.client = None
+        self.resolver_cache = ResolverCache()
+        self.pages_done = 0
+        self.total_pages = None
+        self.incomplete_chapters = []
 
         # Replace spaces with hyphens
         self.formatted_manga_name = re.sub(r'\s+', '-', self.manga_name)
@@ -46,18 +55,24 @@ class MangaDownloader:
         url = base_url.format(self.formatted_manga_name, chapter_number, png_number)
         return url
 
-    async def download_image(self, session: aiohttp.ClientSession, url: str, path: Path) -> bool:
+    async def download_image(self, session: aiohttp.ClientSession, url: str, path: Path) -> int:
+        # Returns the HTTP status, or None when the page was skipped
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    path.parent.mkdir(parents=True, exist_ok=True)
-                    async with aiofiles.open(path, 'wb') as file:
-                        await file.write(await response.read())
-                    return True
-                else:
-                    return False
+            status, data = await fetch_verified(session, url)
+        except DamagedPage as e:
+            logging.error(f"Skipping damaged page {e}")
+            return None
         except aiohttp.ClientError:
-            return False
+            return None
+        if status != 200:
+            return status
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Replace rather than truncate: the old page may be a hardlink into a page store
+        partial_path = path.with_name(path.name + ".part")
+        async with aiofiles.open(partial_path, 'wb') as file:
+            await file.write(data)
+        os.replace(partial_path, path)
+        return status
 
     def extract_text_from_html(self, html_content: str) -> str:
         pattern = re.compile(r'vm\.CurPathName\s*=\s*"([^"]+)"')
@@ -84,24 +99,17 @@ class MangaDownloader:
         except aiohttp.ClientError:
             return None
 
-    async def count_pages_in_chapter(self, session: aiohttp.ClientSession, chapter_number: str) -> int:
-        formatted_chapter_number = self.format_chapter_number(chapter_number)
-        manga_address = await self.extract_text_from_url(session, formatted_chapter_number)
+    async def resolve_chapter(self, session: aiohttp.ClientSession, chapter_number: str) -> tuple:
+        manga_address, resolved = await resolve_host(self, session, chapter_number, self.resolver_cache)
         if manga_address:
-            async def check_page_exists(png_number):
-                url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
-                try:
-                    async with session.get(url) as response:
-                        return response.status == 200
-                except aiohttp.ClientError:
-                    return False
-
-            tasks = [check_page_exists(png_number) for png_number in range(1, 101)]
-            results = await asyncio.gather(*tasks)
-            return sum(results)
-        return 0
+            self.client.prewarm(manga_address)
+        return manga_address, resolved
 
     async def colorful_progress_bar(self, current: int, total: int):
+        if not total:
+            sys.stdout.write(f'\r{Fore.GREEN}{current} page(s) downloaded{Style.RESET_ALL}')
+            sys.stdout.flush()
+            return
         current = min(current, total)
         percent = (current / total) * 100
         bar_length = 50  # Length of the progress bar
@@ -119,51 +127,74 @@ class MangaDownloader:
         sys.stdout.write(f'\r{color}[{bar}] {percent:.2f}%{Style.RESET_ALL}')
         sys.stdout.flush()
 
-    async def download_chapter_images(self, session: aiohttp.ClientSession, chapter_number: str, total_pages: int, chapter_index: int) -> bool:
-        formatted_chapter_number = self.format_chapter_number(chapter_number)
-        manga_address = await self.extract_text_from_url(session, formatted_chapter_number)
-        if manga_address:
-            chapter_folder = self.manga_folder / f"Chapter-{formatted_chapter_number}"
-            chapter_folder.mkdir(parents=True, exist_ok=True)
-
-            for png_number in range(1, total_pages + 1):
-                url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
-                image_filename = f"{png_number:03d}.png"
-                image_path = chapter_folder / image_filename
-                if await self.download_image(session, url, image_path):
-                    overall_progress = (chapter_index * total_pages) + png_number
-                    await self.colorful_progress_bar(overall_progress, total_chapters_pages)
-            return True
-        else:
-            return False
+    async def download_chapter_images(self, session: aiohttp.ClientSession, formatted_chapter_number: str, manga_address: str) -> int:
+        chapter_folder = self.manga_folder / f"Chapter-{formatted_chapter_number}"
+        chapter_folder.mkdir(parents=True, exist_ok=True)
+
+        # The first page that answers 404 ends the chapter, so the download
+        # doubles as the page count
+        downloaded = 0
+        for png_number in range(1, MAX_PAGES + 1):
+            url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
+            image_filename = f"{png_number:03d}.png"
+            image_path = chapter_folder / image_filename
+            status = await self.download_image(session, url, image_path)
+            if status == 404:
+                break
+            if status is not None and status != 200:
+                # Still throttled or failing after the retries; the chapter is not over
+                logging.error(f"\nChapter {formatted_chapter_number} stopped at HTTP {status} after page {png_number - 1} and was left unfinished.")
+                self.incomplete_chapters.append(formatted_chapter_number)
+                break
+            if status == 200:
+                downloaded += 1
+                self.pages_done += 1
+                await self.colorful_progress_bar(self.pages_done, self.total_pages)
+        return downloaded
 
-    async def download_chapters(self, chapters_to_download: list):
+    async def download_chapters(self, chapters_to_download: list, confirm: bool = True):
         chapter_count = len(chapters_to_download)
         logging.info(f"There are {chapter_count} chapter(s) to download.")
+        chapters = [self.format_chapter_number(chapter_number) for chapter_number in chapters_to_download]
 
-        global total_chapters_pages
-        total_chapters_pages = 0
-        pages_per_chapter = {}
-        async with aiohttp.ClientSession() as session:
-            for chapter_number in chapters_to_download:
-                page_count = await self.count_pages_in_chapter(session, chapter_number)
-                pages_per_chapter[chapter_number] = page_count
-                total_chapters_pages += page_count
-
-        for chapter_number, page_count in pages_per_chapter.items():
-            logging.info(f"Chapter {chapter_number} has {page_count} pages.")
+        # One client for estimating and downloading keeps the connections warm
+        async with HttpClient() as self.client:
+            session = self.client.session
+            if confirm:
+                # D4B2 fetches one page at a time
+                plan = await plan_download(self, chapters, 1, self.resolver_cache, client=self.client)
+                print_plan(plan)
+                user_input = input("Do you want to proceed with the download? (Y/N): ").strip().upper()
+                if user_input != 'Y':
+                    logging.info("Download canceled by user.")
+                    return
+                self.total_pages = plan["pages"]
 
-        user_input = input("Do you want to proceed with the download? (Y/N): ").strip().upper()
-
-        if user_input != 'Y':
-            logging.info("Download canceled by user.")
-            return
-
-        conn = aiohttp.TCPConnector(limit=10)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            for chapter_index, chapter_number in enumerate(chapters_to_download):
-                total_pages = pages_per_chapter[chapter_number]
-                await self.download_chapter_images(session, chapter_number, total_pages, chapter_index)
+            # The next chapter page is looked up while the current chapter downloads
+            lookup = asyncio.ensure_future(self.resolve_chapter(session, chapters[0])) if chapters else None
+            try:
+                for chapter_index, chapter in enumerate(chapters):
+                    manga_address, resolved = await lookup
+                    if chapter_index + 1 < len(chapters):
+                        lookup = asyncio.ensure_future(self.resolve_chapter(session, chapters[chapter_index + 1]))
+                    if not manga_address:
+                        logging.error(f"\nChapter {chapter} not found.")
+                        continue
+                    downloaded = await self.download_chapter_images(session, chapter, manga_address)
+                    if not downloaded and not resolved and chapter not in self.incomplete_chapters:
+                        # The cached image host may have moved; resolve the chapter again
+                        self.resolver_cache.forget(self.formatted_manga_name, chapter)
+                        manga_address, _ = await self.resolve_chapter(session, chapter)
+                        if manga_address:
+                            await self.download_chapter_images(session, chapter, manga_address)
+            finally:
+                if lookup is not None and not lookup.done():
+                    lookup.cancel()
+                self.resolver_cache.save()
+        sys.stdout.write("\n")  # End the progress bar line
+        if self.incomplete_chapters:
+            logging.error(f"Incomplete chapter(s), download them again: {', '.join(self.incomplete_chapters)}")
+        self.client.log_stats()
 
         await self.save_history(self.manga_name)
         logging.info(f"Saved {self.manga_name} to history.")  # Display this after the progress bar completes
@@ -199,7 +230,15 @@ def parse_chapters(chapters_str):
             chapters.append(int(part))
     return [str(chapter) for chapter in chapters]
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manga Downloader")
+    parser.add_argument('--plan', action='store_true', help="Only print a download plan (pages, size, requests, time); no images are fetched")
+    parser.add_argument('--json', action='store_true', help="Print the plan as JSON")
+    parser.add_argument('-y', '--yes', action='store_true', help="Start downloading right away, without the estimate and confirmation")
+    return parser.parse_args()
+
 async def main():
+    args = parse_args()
     manga_name = input("Please type Manga Name: ").strip()
     chapters_str = input("Please input Manga Chapter Number(s) (e.g., 1,2-5): ").strip()
     uppercase = input("Would you like the manga name to be uppercase? (y/n): ").strip().lower() == 'y'
@@ -207,8 +246,12 @@ async def main():
 
     downloader = MangaDownloader(manga_name, uppercase=uppercase, edit=edit)
     chapters_to_download = parse_chapters(chapters_str)
-    
-    await downloader.download_chapters(chapters_to_download)
+
+    if args.plan:
+        # D4B2 fetches one page at a time
+        print_plan(await plan_download(downloader, chapters_to_download, concurrency=1), args.json)
+        return
+    await downloader.download_chapters(chapters_to_download, confirm=not args.yes)
 
 if __name__ == "__main__":
     asyncio.run(main())
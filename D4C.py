@@ -1,4 +1,6 @@
+import os
 import re
+import sys
 import aiohttp
 import asyncio
 import aiofiles
@@ -7,8 +9,19 @@ import argparse
 import logging
 from concurrent.futures import ThreadPoolExecutor
 
+from pagestore import PageStore, log_stats
+from integrity import DamagedPage, fetch_page, fetch_verified, find_broken_pages
+from httpclient import HttpClient, CONNECTION_LIMIT
+from ratelimit import RateLimiter
+from budget import parse_size
+from archivestream import STREAM_FORMATS, stream_archive
+from mangaclient import PageUnavailable
+from logsetup import PageLog, setup_logging
+from tasktable import TaskTable, run_tasks
+from pagemeta import load_metadata, save_metadata, page_validators, conditional_headers
+
 class MangaDownloader:
-    def __init__(self, manga_name: str, uppercase: bool = False, edit: bool = False):
+    def __init__(self, manga_name: str, uppercase: bool = False, edit: bool = False, page_store: PageStore = None, revalidate: bool = False, rate_limiter: RateLimiter = None):
         if edit:
             self.manga_name = manga_name
         else:
@@ -17,6 +30,13 @@ class MangaDownloader:
         self.manga_folder = Path(self.formatted_manga_name)
         self.executor = ThreadPoolExecutor()
         self.history_file = Path("download_history.txt")
+        self.page_store = page_store
+        self.revalidate = revalidate
+        self.rate_limiter = rate_limiter
+        self.client = None
+        self.unchanged_pages = 0
+        self.updated_pages = 0
+        self.page_log = PageLog()
 
     def format_chapter_number(self, chapter_number: str) -> str:
         if '.' in chapter_number:
@@ -31,21 +51,49 @@ class MangaDownloader:
         url = base_url.format(self.formatted_manga_name, chapter_number, png_number)
         return url
 
-    async def download_image(self, session: aiohttp.ClientSession, url: str, path: Path) -> bool:
+    async def save_page(self, data: bytes, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.page_store is not None:
+            # Hashing and linking run in the executor, off the event loop
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.page_store.store_page, data, path)
+        else:
+            # Replace rather than truncate: the old page may be a hardlink into a page store
+            partial_path = path.with_name(path.name + ".part")
+            async with aiofiles.open(partial_path, 'wb') as file:
+                await file.write(data)
+            os.replace(partial_path, path)
+
+    async def download_image(self, session: aiohttp.ClientSession, url: str, path: Path, metadata: dict = None) -> bool:
+        # metadata holds the validators of the chapter's pages; when
+        # revalidating, pages already on disk are requested conditionally
+        on_disk = self.revalidate and path.exists()
+        known = metadata.get(path.name) if metadata is not None and on_disk else None
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    path.parent.mkdir(parents=True, exist_ok=True)
-                    async with aiofiles.open(path, 'wb') as file:
-                        await file.write(await response.read())
-                    logging.info(f"Downloaded: {url}")
-                    return True
-                else:
-                    logging.warning(f"Failed to download {url}: {response.status}")
-                    return False
+            status, data, headers = await fetch_page(session, url, conditional_headers(known))
+        except DamagedPage as e:
+            # Keep going with the next page; D4C --verify re-fetches the gap later
+            logging.error("Skipping damaged page %s", e)
+            return True
         except aiohttp.ClientError as e:
-            logging.error(f"Error downloading {url}: {e}")
+            logging.error("Error downloading %s: %s", url, e)
+            return False
+        if status == 304:
+            self.unchanged_pages += 1
+            return True
+        if status != 200:
+            logging.warning("Failed to download %s: %s", url, status)
             return False
+        if metadata is not None:
+            metadata[path.name] = page_validators(headers, len(data))
+        if on_disk:
+            async with aiofiles.open(path, 'rb') as file:
+                if await file.read() == data:
+                    self.unchanged_pages += 1
+                    return True
+            self.updated_pages += 1
+        await self.save_page(data, path)
+        self.page_log.downloaded(url, len(data))
+        return True
 
     def extract_text_from_html(self, html_content: str) -> str:
         pattern = re.compile(r'vm\.CurPathName\s*=\s*"([^"]+)"')
@@ -83,31 +131,81 @@ class MangaDownloader:
         formatted_chapter_number = self.format_chapter_number(chapter_number)
         manga_address = await self.extract_text_from_url(session, formatted_chapter_number)
         if manga_address:
+            self.client.prewarm(manga_address)
             chapter_folder = self.manga_folder / f"Chapter-{formatted_chapter_number}"
+            metadata = load_metadata(chapter_folder)
             png_number = 1
             while True:
                 url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
                 image_filename = f"{png_number:03d}.png"
                 image_path = chapter_folder / image_filename
-                if not await self.download_image(session, url, image_path):
+                if not await self.download_image(session, url, image_path, metadata):
                     break
                 png_number += 1
+            save_metadata(chapter_folder, metadata)
             return png_number > 1
         else:
             return False
 
-    async def download_chapters(self, chapters_to_download: list):
-        conn = aiohttp.TCPConnector(limit=10)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            tasks = []
-            for chapter_number in chapters_to_download:
-                tasks.append(self.download_chapter_images(session, chapter_number))
-                if len(tasks) >= 5:  # Limit concurrent tasks to avoid overloading
-                    await asyncio.gather(*tasks)
-                    tasks = []
-            if tasks:
-                await asyncio.gather(*tasks)
+    async def download_chapters(self, chapters_to_download: list) -> list:
+        # Returns the chapters that were found and downloaded
+        downloaded = []
+        async with HttpClient(rate_limiter=self.rate_limiter) as self.client:
+            session = self.client.session
+            for start in range(0, len(chapters_to_download), 5):  # Limit concurrent tasks to avoid overloading
+                batch = chapters_to_download[start:start + 5]
+                results = await asyncio.gather(*(self.download_chapter_images(session, chapter_number) for chapter_number in batch))
+                downloaded += [chapter_number for chapter_number, done in zip(batch, results) if done]
+            self.page_log.flush()
+            self.client.log_stats()
+        if self.revalidate:
+            logging.info(f"Revalidated {self.manga_name}: {self.unchanged_pages} page(s) unchanged, {self.updated_pages} updated")
+        if self.page_store is not None:
+            log_stats(self.page_store)
         await self.save_history(self.manga_name)
+        return downloaded
+
+    async def repair_pages(self, broken: TaskTable) -> int:
+        # broken holds the damaged and missing pages of this series; a fixed
+        # set of workers walks it, so only pages in flight have a URL or coroutine
+        repaired = 0
+        addresses = {}
+        async with HttpClient(rate_limiter=self.rate_limiter) as self.client:
+            session = self.client.session
+
+            async def lookup(chapter_number: str) -> str:
+                manga_address = await self.extract_text_from_url(session, chapter_number)
+                self.client.prewarm(manga_address)
+                return manga_address
+
+            async def resolve(chapter_number: str) -> str:
+                # One lookup (and prewarm) per chapter, shared by the workers repairing its pages
+                if chapter_number not in addresses:
+                    addresses[chapter_number] = asyncio.ensure_future(lookup(chapter_number))
+                return await addresses[chapter_number]
+
+            async def repair_page(task: int):
+                nonlocal repaired
+                _, chapter_number, page_number = broken.task(task)
+                chapter_number = self.format_chapter_number(chapter_number)
+                manga_address = await resolve(chapter_number)
+                if not manga_address:
+                    return
+                path = broken.path(task)
+                url = await self.generate_image_url(chapter_number, page_number, manga_address)
+                try:
+                    status, data = await fetch_verified(session, url)
+                except (DamagedPage, aiohttp.ClientError) as e:
+                    logging.error(f"Could not re-fetch {path}: {e}")
+                    return
+                if status != 200:
+                    logging.error(f"Could not re-fetch {path}: HTTP {status}")
+                    return
+                await self.save_page(data, path)
+                repaired += 1
+
+            await run_tasks(broken, repair_page, CONNECTION_LIMIT)
+        return repaired
 
     async def save_history(self, manga_name: str):
         if not self.history_file.exists():
@@ -141,6 +239,21 @@ def parse_chapters(chapters_str):
             chapters.append(int(part))
     return [str(chapter) for chapter in chapters]
 
+def verify_library(roots: list, page_store: PageStore = None, rate_limiter: RateLimiter = None):
+    # Pages are checked in parallel across cores; only damaged or missing
+    # pages are downloaded again, never whole chapters
+    broken_by_series = {}
+    for folder, chapter_number, page_number, path, problem in find_broken_pages(roots, os.cpu_count() or 1):
+        logging.warning("%s: %s", path, problem)
+        broken_by_series.setdefault(folder.parent, TaskTable()).add(folder.parent.name, chapter_number, page_number, folder, path.name)
+    if not broken_by_series:
+        logging.info("All pages are intact.")
+        return
+    for series_folder, broken in broken_by_series.items():
+        downloader = MangaDownloader(series_folder.name, edit=True, page_store=page_store, rate_limiter=rate_limiter)
+        repaired = asyncio.run(downloader.repair_pages(broken))
+        logging.info(f"Re-fetched {repaired} of {len(broken)} page(s) for {series_folder.name}")
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Manga Downloader")
     parser.add_argument('-d', '--download', metavar='MANGA_NAME', type=str, help="Download manga chapters")
@@ -148,22 +261,48 @@ def parse_args():
     parser.add_argument('-H', '--history', action='store_true', help="View download history")
     parser.add_argument('-U', '--uppercase', action='store_true', help="Use uppercase for the manga name")
     parser.add_argument('-e', '--edit', action='store_true', help="Edit manga name directly without formatting")
+    parser.add_argument('-r', '--revalidate', action='store_true', help="Re-check downloaded pages with conditional requests and rewrite only changed ones")
+    parser.add_argument('--verify', metavar='LIBRARY', type=Path, nargs='+', help="Check downloaded pages and re-fetch damaged or missing ones")
+    parser.add_argument('--store', metavar='DIR', type=Path, help="Deduplicate pages into a content-addressed page store (hardlinked pages)")
+    parser.add_argument('--stdout', metavar='FORMAT', choices=STREAM_FORMATS, help=f"Stream the chapters to stdout as one archive ({', '.join(STREAM_FORMATS)}) instead of saving them; needs -d and -c")
+    parser.add_argument('--max-rps', metavar='N', type=float, help="Requests per second per host, shared by all downloader processes on this machine")
+    parser.add_argument('--max-rate', metavar='SIZE', type=parse_size, help="Bytes per second per host (e.g. 2MB), shared by all downloader processes on this machine")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log every page request instead of periodic summaries")
     return parser.parse_args()
 
 def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     args = parse_args()
+    setup_logging('%(asctime)s - %(levelname)s - %(message)s', args.verbose)
+    page_store = PageStore(args.store) if args.store else None
+    rate_limiter = RateLimiter(args.max_rps, args.max_rate) if args.max_rps or args.max_rate else None
 
-    if args.download and args.chapters:
+    if args.verify:
+        verify_library(args.verify, page_store, rate_limiter)
+    elif args.stdout:
+        if not (args.download and args.chapters):
+            logging.error("--stdout needs the manga name (-d) and the chapters (-c).")
+            sys.exit(2)
+        downloader = MangaDownloader(args.download, uppercase=args.uppercase, edit=args.edit)
+        try:
+            asyncio.run(stream_archive(downloader.manga_name, parse_chapters(args.chapters), sys.stdout.buffer, args.stdout, rate_limiter))
+        except BrokenPipeError:
+            # The reading end went away; stop quietly like other pipe producers
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+        except (PageUnavailable, DamagedPage) as e:
+            # The archive already written is cut short; fail instead of passing it off as complete
+            logging.error(f"Stopped streaming: {e}")
+            sys.exit(1)
+    elif args.download and args.chapters:
         manga_name = args.download
         chapters_to_download = parse_chapters(args.chapters)
-        downloader = MangaDownloader(manga_name, uppercase=args.uppercase, edit=args.edit)
+        downloader = MangaDownloader(manga_name, uppercase=args.uppercase, edit=args.edit, page_store=page_store, revalidate=args.revalidate, rate_limiter=rate_limiter)
         asyncio.run(downloader.download_chapters(chapters_to_download))
     elif args.download:
         manga_name = args.download
         input_chapters = input("Enter the chapter number(s) separated by commas or ranges: ")
         chapters_to_download = parse_chapters(input_chapters)
-        downloader = MangaDownloader(manga_name, uppercase=args.uppercase, edit=args.edit)
+        downloader = MangaDownloader(manga_name, uppercase=args.uppercase, edit=args.edit, page_store=page_store, revalidate=args.revalidate, rate_limiter=rate_limiter)
         asyncio.run(downloader.download_chapters(chapters_to_download))
     elif args.history:
         downloader = MangaDownloader("dummy")
@@ -176,7 +315,7 @@ def main():
                 manga_name = input("Enter the manga name: ")
                 input_chapters = input("Enter the chapter number(s) separated by commas or ranges: ")
                 chapters_to_download = parse_chapters(input_chapters)
-                downloader = MangaDownloader(manga_name)
+                downloader = MangaDownloader(manga_name, page_store=page_store, rate_limiter=rate_limiter)
                 asyncio.run(downloader.download_chapters(chapters_to_download))
             elif choice == 'h':
                 if downloader is None:
@@ -186,6 +325,8 @@ def main():
                 break
             else:
                 logging.warning("Invalid choice, please try again.")
+    if page_store is not None:
+        page_store.close()
 
 if __name__ == "__main__":
     main()
@@ -4,11 +4,27 @@ import asyncio
 import aiofiles
 import logging
 import sys
+import time
+import argparse
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 from colorama import init, Fore, Style
+from budget import ByteBudget, parse_size, format_size
+from buildcache import BuildCache
+from sinks import SinkPipeline, SINK_TYPES, build_sinks, parse_formats
+from pagestore import PageStore, log_stats
+from recompress import Recompressor, RECOMPRESS_MODES, parse_recompress
+from integrity import DamagedPage, fetch_verified
+from httpclient import HttpClient
+from ratelimit import RateLimiter
+from scheduler import ChapterScheduler, URGENT, ORDERS
+from storage import Storage, parse_storage
+from planner import ResolverCache, HostStats, MAX_PAGES, resolve_host, plan_download, print_plan
+
+CONNECTION_LIMIT = 10
+# Pages requested at once while a chapter's length is still unknown
+PAGE_WINDOW = CONNECTION_LIMIT
+# Chapters whose image host is looked up while an earlier one downloads
+RESOLVE_AHEAD = 3
 
 # Initialize Colorama
 init(autoreset=True)
@@ -21,7 +37,7 @@ logging.basicConfig(
 )
 
 class MangaDownloader:
-    def __init__(self, manga_name: str, uppercase: bool = False, edit: bool = False):
+    def __init__(self, manga_name: str, uppercase: bool = False, edit: bool = False, max_buffer: int = 256 * 1024 ** 2, formats: list = None, page_store: PageStore = None, recompressor: Recompressor = None, rate_limiter: RateLimiter = None, order: str = "given", storage: Storage = None):
         if edit:
             self.manga_name = manga_name
         else:
@@ -32,6 +48,20 @@ class MangaDownloader:
         self.manga_folder = self.main_folder / self.formatted_manga_name
         self.history_file = Path("download_history.txt")
         self.manga_folder.mkdir(parents=True, exist_ok=True)
+        self.budget = ByteBudget(max_buffer)
+        self.pages_done = 0
+        self.total_pages = None
+        self.incomplete_chapters = []
+        self.build_cache = BuildCache(self.manga_folder / ".build-cache.json")
+        self.formats = formats or ["pdf"]
+        self.page_store = page_store
+        self.recompressor = recompressor
+        self.rate_limiter = rate_limiter
+        self.order = order
+        self.storage = storage
+        self.resolver_cache = ResolverCache()
+        self.host_stats = HostStats()
+        self.client = None
 
     def format_chapter_number(self, chapter_number: str) -> str:
         if '.' in chapter_number:
@@ -46,17 +76,15 @@ class MangaDownloader:
         url = base_url.format(self.formatted_manga_name, chapter_number, png_number)
         return url
 
-    async def download_image(self, session: aiohttp.ClientSession, url: str) -> bytes:
+    async def download_image(self, session: aiohttp.ClientSession, url: str) -> tuple:
+        # Returns (status, body); status is None when the page could not be fetched
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    return await response.read()
-                else:
-                    logging.warning(f"Failed to download {url}: {response.status}")
-                    return None
+            return await fetch_verified(session, url)
+        except DamagedPage as e:
+            logging.error(f"Damaged page {e}")
         except aiohttp.ClientError as e:
             logging.error(f"Error downloading {url}: {e}")
-            return None
+        return None, None
 
     def extract_text_from_html(self, html_content: str) -> str:
         pattern = re.compile(r'vm\.CurPathName\s*=\s*"([^"]+)"')
@@ -83,24 +111,19 @@ class MangaDownloader:
         except aiohttp.ClientError:
             return None
 
-    async def count_pages_in_chapter(self, session: aiohttp.ClientSession, chapter_number: str) -> int:
-        formatted_chapter_number = self.format_chapter_number(chapter_number)
-        manga_address = await self.extract_text_from_url(session, formatted_chapter_number)
+    async def resolve_chapter(self, session: aiohttp.ClientSession, chapter_number: str) -> tuple:
+        manga_address, resolved = await resolve_host(self, session, chapter_number, self.resolver_cache)
         if manga_address:
-            async def check_page_exists(png_number):
-                url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
-                try:
-                    async with session.get(url) as response:
-                        return response.status == 200
-                except aiohttp.ClientError:
-                    return False
-
-            tasks = [check_page_exists(png_number) for png_number in range(1, 101)]
-            results = await asyncio.gather(*tasks)
-            return sum(results)
-        return 0
+            self.client.prewarm(manga_address)
+        return manga_address, resolved
 
     async def colorful_progress_bar(self, current: int, total: int):
+        if not total:
+            # Without a plan the total is only known once the last chapter ends
+            sys.stdout.write(f'\r{Fore.GREEN}{current} page(s) downloaded{Style.RESET_ALL}')
+            sys.stdout.flush()
+            await asyncio.sleep(0)
+            return
         current = min(current, total)  # Prevent overflows
         percent = (current / total) * 100
         bar_length = 50
@@ -122,62 +145,151 @@ class MangaDownloader:
         sys.stdout.flush()
         await asyncio.sleep(0)  # Allow other tasks to run
 
-    async def download_chapter_images(self, session: aiohttp.ClientSession, chapter_number: str, total_pages: int, chapter_index: int, total_chapters_pages: int) -> list:
-        formatted_chapter_number = self.format_chapter_number(chapter_number)
-        manga_address = await self.extract_text_from_url(session, formatted_chapter_number)
-        image_data = []
+    async def download_chapter_images(self, session: aiohttp.ClientSession, formatted_chapter_number: str, manga_address: str, pipeline: SinkPipeline, expected_pages: int = None) -> int:
+        started = time.monotonic()
+        downloaded_bytes = 0
 
-        if manga_address:
-            png_number = 1
-            for _ in range(total_pages):  
-                url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
-                image_bytes = await self.download_image(session, url)
-                if image_bytes:
-                    image_data.append(image_bytes)
-                    overall_progress = (chapter_index * total_pages) + png_number
-                    await self.colorful_progress_bar(overall_progress, total_chapters_pages)
-                png_number += 1
-
-            return image_data
+        # Pages are fetched concurrently but handed to the sinks in page order
+        pending = {}
+        next_page = 1
+        downloaded = 0
+        flush_lock = asyncio.Lock()
+        # There is no counting pass: the download itself finds the end of the
+        # chapter, the first page that answers 404. A planned length only
+        # narrows the window so fewer requests run past the end.
+        next_number = 1
+        last_page = MAX_PAGES
+        limit = expected_pages + 1 if expected_pages else MAX_PAGES
+        failure = None  # why the chapter stopped short, if it did
+
+        async def fetch_page(png_number: int):
+            nonlocal next_page, downloaded, downloaded_bytes, last_page, limit, failure
+            await self.budget.wait_for_room()
+            url = await self.generate_image_url(formatted_chapter_number, png_number, manga_address)
+            status, image_bytes = await self.download_image(session, url)
+            if status == 404:
+                last_page = min(last_page, png_number - 1)
+            elif status != 200:
+                # Damaged, unreachable, or still throttled after the retries:
+                # stop, rather than pass the pages so far off as the whole chapter
+                failure = failure or (f"HTTP {status}" if status is not None else "an unreadable page")
+                last_page = min(last_page, png_number - 1)
+            elif png_number >= limit:
+                # The chapter grew since it was planned
+                limit = MAX_PAGES
+            if image_bytes:
+                downloaded_bytes += len(image_bytes)
+                self.budget.charge(len(image_bytes))
+                if self.recompressor is not None:
+                    recompressed = await self.recompressor.transform(image_bytes)
+                    self.budget.charge(len(recompressed))
+                    self.budget.release(len(image_bytes))
+                    image_bytes = recompressed
+                downloaded += 1
+                self.pages_done += 1
+                await self.colorful_progress_bar(self.pages_done, self.total_pages)
+            pending[png_number] = image_bytes
+            async with flush_lock:
+                while next_page in pending:
+                    page_bytes = pending.pop(next_page)
+                    if page_bytes:
+                        await pipeline.put_page(next_page, page_bytes)
+                    next_page += 1
+
+        async def fetch_pages():
+            nonlocal next_number
+            while next_number <= min(last_page, limit):
+                png_number = next_number
+                next_number += 1
+                await fetch_page(png_number)
+
+        await pipeline.open_chapter(formatted_chapter_number)
+        try:
+            await asyncio.gather(*(fetch_pages() for _ in range(min(PAGE_WINDOW, limit))))
+        except BaseException:
+            await pipeline.abort_chapter()
+            raise
+        if failure is not None:
+            logging.error(f"\nChapter {formatted_chapter_number} stopped at {failure} after page {last_page} and was left unfinished.")
+            self.incomplete_chapters.append(formatted_chapter_number)
+            await pipeline.abort_chapter()
         else:
-            return []
-
-    async def save_chapter_to_pdf(self, chapter_number: str, image_data: list):
-        pdf_filename = self.manga_folder / f"Chapter-{self.format_chapter_number(chapter_number)}.pdf"
-        c = canvas.Canvas(str(pdf_filename), pagesize=letter)
-
-        for image_bytes in image_data:
-            with NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-                temp_file.write(image_bytes)
-                temp_file_path = temp_file.name
-                width, height = letter
-                c.drawImage(temp_file_path, 0, 0, width=width, height=height, preserveAspectRatio=True, anchor='c')
-                c.showPage()  # Create a new page
-
-        c.save()
-
-    async def download_chapters(self, chapters_to_download: list):
-        chapter_count = len(chapters_to_download)
-        logging.info(f"There are {chapter_count} chapter(s) to download.")
-
-        global total_chapters_pages
-        async with aiohttp.ClientSession() as session:
-            # Gather counts of pages in all chapters
-            page_counts = await asyncio.gather(*(self.count_pages_in_chapter(session, chapter_number) for chapter_number in chapters_to_download))
-            total_chapters_pages = sum(page_counts)
-
-        user_input = input("Do you want to proceed with the download? (Y/N): ").strip().upper()
-        if user_input != 'Y':
-            logging.info("Download canceled by user.")
-            return
+            await pipeline.close_chapter()
+        self.host_stats.record(manga_address, downloaded_bytes, time.monotonic() - started)
+        return downloaded
+
+    async def download_chapters(self, chapters_to_download: list, confirm: bool = True, urgent_chapters: list = ()):
+        scheduler = ChapterScheduler(self.formatted_manga_name, self.order, self.format_chapter_number)
+        scheduler.add(urgent_chapters, URGENT)
+        scheduler.add(chapters_to_download)
+        chapters = scheduler.peek(len(scheduler))
+        logging.info(f"There are {len(chapters)} chapter(s) to download.")
 
-        conn = aiohttp.TCPConnector(limit=10)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            for chapter_index, chapter_number in enumerate(chapters_to_download):
-                total_pages = page_counts[chapter_index]
-                image_data = await self.download_chapter_images(session, chapter_number, total_pages, chapter_index, total_chapters_pages)
-                if image_data:
-                    await self.save_chapter_to_pdf(chapter_number, image_data)
+        # Estimating and downloading share one client, so the connections opened
+        # while estimating are still warm when the first page is fetched
+        async with HttpClient(limit=CONNECTION_LIMIT, rate_limiter=self.rate_limiter) as self.client:
+            session = self.client.session
+            planned_pages = {}
+            if confirm:
+                # The HEAD-based plan is cheap; the hosts it resolves and the page
+                # counts it finds are reused by the download
+                plan = await plan_download(self, chapters, CONNECTION_LIMIT, self.resolver_cache, self.host_stats, self.client)
+                print_plan(plan)
+                user_input = input("Do you want to proceed with the download? (Y/N): ").strip().upper()
+                if user_input != 'Y':
+                    logging.info("Download canceled by user.")
+                    return
+                planned_pages = {chapter["chapter"]: chapter["pages"] for chapter in plan["chapters"]}
+                self.total_pages = plan["pages"]
+
+            # Every fetched page fans out to all requested outputs; each chapter is
+            # written in the background while the next one downloads, and the byte
+            # budget keeps the pages waiting on the sinks bounded. Chapter pages
+            # are resolved a few chapters ahead, so a chapter starts downloading
+            # as soon as the previous one is done. The scheduler is asked for the
+            # next chapter only then, so urgent chapters queued meanwhile
+            # (scheduler.py) go before the rest of the backlog.
+            pipeline = SinkPipeline(build_sinks(self.formats, self.manga_folder, self.build_cache, self.page_store, self.storage), self.budget)
+            lookups = {}
+            try:
+                while True:
+                    scheduler.poll()
+                    chapter = scheduler.pop()
+                    if chapter is None:
+                        break
+                    for upcoming in [chapter] + scheduler.peek(RESOLVE_AHEAD):
+                        if upcoming not in lookups:
+                            lookups[upcoming] = asyncio.ensure_future(self.resolve_chapter(session, upcoming))
+                    manga_address, resolved = await lookups.pop(chapter)
+                    if not manga_address:
+                        logging.error(f"\nChapter {chapter} not found.")
+                        continue
+                    downloaded = await self.download_chapter_images(session, chapter, manga_address, pipeline, planned_pages.get(chapter))
+                    if not downloaded and not resolved and chapter not in self.incomplete_chapters:
+                        # The cached image host may have moved; resolve the chapter again
+                        self.resolver_cache.forget(self.formatted_manga_name, chapter)
+                        manga_address, _ = await self.resolve_chapter(session, chapter)
+                        if manga_address:
+                            await self.download_chapter_images(session, chapter, manga_address, pipeline)
+            finally:
+                for lookup in lookups.values():
+                    lookup.cancel()
+                await asyncio.gather(*lookups.values(), return_exceptions=True)
+                await pipeline.close()
+                self.build_cache.save()
+                self.resolver_cache.save()
+                self.host_stats.save()
+        for sink_name, failed_chapters in pipeline.failures.items():
+            if failed_chapters:
+                logging.error(f"\n{sink_name} output failed for chapter(s): {', '.join(failed_chapters)}")
+        if self.incomplete_chapters:
+            logging.error(f"\nIncomplete chapter(s), download them again: {', '.join(self.incomplete_chapters)}")
+        logging.info(f"\nPeak buffered page data: {format_size(self.budget.peak)}")
+        self.client.log_stats()
+        if self.recompressor is not None:
+            self.recompressor.log_report()
+        if self.page_store is not None:
+            log_stats(self.page_store)
 
         await self.save_history(self.manga_name)
         logging.info(f"Saved {self.manga_name} to history.")
@@ -212,16 +324,63 @@ def parse_chapters(chapters_str):
             chapters.append(int(part))
     return [str(chapter) for chapter in chapters]
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manga Downloader (PDF)")
+    parser.add_argument('--max-buffer', metavar='SIZE', type=parse_size, default=parse_size("256MB"), help="Ceiling on downloaded page data waiting to be rendered (e.g. 256MB)")
+    parser.add_argument('-f', '--format', metavar='FORMATS', type=parse_formats, default=["pdf"], help=f"Comma-separated outputs written from one download ({', '.join(SINK_TYPES)})")
+    parser.add_argument('--store', metavar='DIR', type=Path, help="Deduplicate folder output into a content-addressed page store (hardlinked pages)")
+    parser.add_argument('--storage', metavar='LOCATION', help="Where outputs go: a folder, tar:FOLDER for sharded tar files, or s3://bucket/prefix (credentials from AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY, endpoint from S3_ENDPOINT_URL)")
+    parser.add_argument('--recompress', metavar='MODE[:N]', type=parse_recompress, help=f"Re-encode pages before writing ({', '.join(RECOMPRESS_MODES)}; N is the quality, or the number of shades for grey)")
+    parser.add_argument('--plan', action='store_true', help="Only print a download plan (pages, size, requests, time); no images are fetched")
+    parser.add_argument('--json', action='store_true', help="Print the plan as JSON")
+    parser.add_argument('--max-rps', metavar='N', type=float, help="Requests per second per host, shared by all downloader processes on this machine")
+    parser.add_argument('--max-rate', metavar='SIZE', type=parse_size, help="Bytes per second per host (e.g. 2MB), shared by all downloader processes on this machine")
+    parser.add_argument('--order', choices=ORDERS, default="given", help="Chapter order: as given, reading order, or newest first")
+    parser.add_argument('--urgent', metavar='CHAPTERS', type=parse_chapters, default=[], help="Chapters to download before all others (e.g. 1050,1051)")
+    parser.add_argument('-y', '--yes', action='store_true', help="Start downloading right away, without the estimate and confirmation")
+    parser.add_argument('--workers', type=int, help="Recompression worker processes (default: CPU count)")
+    return parser.parse_args()
+
 async def main():
+    args = parse_args()
+    # Built only now: S3 opens a session and a thread pool, and a bad location
+    # or missing credentials should be reported as such
+    try:
+        storage = parse_storage(args.storage) if args.storage and not args.plan else None
+    except ValueError as e:
+        logging.error(f"Invalid --storage {args.storage!r}: {e}")
+        return
     manga_name = input("Please type Manga Name: ").strip()
     chapters_str = input("Please input Manga Chapter Number(s) (e.g., 1,2-5): ").strip()
     uppercase = input("Would you like the manga name to be uppercase? (y/n): ").strip().lower() == 'y'
     edit = input("Would you like to edit the manga name? (y/n): ").strip().lower() == 'y'
 
-    downloader = MangaDownloader(manga_name, uppercase=uppercase, edit=edit)
+    if args.plan:
+        downloader = MangaDownloader(manga_name, uppercase=uppercase, edit=edit)
+        print_plan(await plan_download(downloader, parse_chapters(chapters_str), CONNECTION_LIMIT, downloader.resolver_cache, downloader.host_stats), args.json)
+        return
+
+    if args.store and storage is not None and storage.local_path("") is None:
+        logging.error("--store hardlinks pages and only works with local storage.")
+        storage.close()
+        return
+    page_store = PageStore(args.store) if args.store else None
+    recompressor = Recompressor(*args.recompress, workers=args.workers) if args.recompress else None
+    rate_limiter = RateLimiter(args.max_rps, args.max_rate) if args.max_rps or args.max_rate else None
+    downloader = MangaDownloader(manga_name, uppercase=uppercase, edit=edit, max_buffer=args.max_buffer, formats=args.format,
+                                 page_store=page_store, recompressor=recompressor, rate_limiter=rate_limiter,
+                                 order=args.order, storage=storage)
     chapters_to_download = parse_chapters(chapters_str)
-    
-    await downloader.download_chapters(chapters_to_download)
+
+    try:
+        await downloader.download_chapters(chapters_to_download, confirm=not args.yes, urgent_chapters=args.urgent)
+    finally:
+        if page_store is not None:
+            page_store.close()
+        if recompressor is not None:
+            recompressor.close()
+        if storage is not None:
+            storage.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
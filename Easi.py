@@ -1,8 +1,10 @@
 import re
-import requests
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from httpclient import print_connection_stats, shared_requests_session
+from pagestore import replacing
+
 def generate_image_url(manga_name, chapter_number, png_number, manga_address):
     base_url = f"https://{manga_address}/manga/{{}}/{{}}-{{:03d}}.png"
     formatted_manga_name = manga_name.replace(" ", "-")
@@ -11,9 +13,9 @@ def generate_image_url(manga_name, chapter_number, png_number, manga_address):
 
 def download_image(url, path):
     try:
-        with requests.get(url, stream=True) as response:
+        with shared_requests_session().get(url, stream=True) as response:
             if response.status_code == 200:
-                with open(path, 'wb') as file:
+                with replacing(path) as file:
                     for chunk in response.iter_content(1024):
                         file.write(chunk)
                 print(f"Downloaded: {url}")
@@ -39,7 +41,7 @@ def extract_text_from_url(manga_name, manga_chapter):
     manga_name = manga_name.replace(" ", "-")
     url = f"https://manga4life.com/read-online/{manga_name}-chapter-{manga_chapter}.html"
     try:
-        with requests.get(url) as response:
+        with shared_requests_session().get(url) as response:
             if response.status_code == 200:
                 html_content = response.text
                 return extract_text_from_html(html_content)
@@ -71,7 +73,7 @@ def main():
     manga_folder = Path(formatted_manga_name)
     manga_folder.mkdir(exist_ok=True)
 
-    with requests.Session() as session, ThreadPoolExecutor() as executor:
+    with ThreadPoolExecutor() as executor:
         for chapter_number in chapters_to_download:
             chapter_folder_name = f"Chapter: {str(chapter_number).zfill(4)}"
             chapter_folder = manga_folder / chapter_folder_name
@@ -80,6 +82,7 @@ def main():
             manga_address = extract_text_from_url(manga_name, chapter_number)
             if manga_address:
                 executor.map(download_chapter_images, [(manga_name, chapter_number, manga_address, chapter_folder)])
+    print_connection_stats(shared_requests_session())
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,11 @@
 
 import os
 import re
-import requests
 import subprocess
 
+from httpclient import print_connection_stats, shared_requests_session
+from pagestore import replacing
+
 def generate_image_url(manga_name, chapter_number, png_number, manga_address):
     base_url = f"https://{manga_address}/manga/{{}}/{{}}-{{:03d}}.png"
     formatted_manga_name = manga_name.replace(" ", "-")
@@ -12,9 +14,9 @@ def generate_image_url(manga_name, chapter_number, png_number, manga_address):
 
 def download_image(url, path):
     try:
-        response = requests.get(url, stream=True)
+        response = shared_requests_session().get(url, stream=True)
         if response.status_code == 200:
-            with open(path, 'wb') as file:
+            with replacing(path) as file:
                 for chunk in response.iter_content(1024):
                     file.write(chunk)
             print(f"Downloaded: {url}")
@@ -49,7 +51,7 @@ def extract_text_from_url(manga_name, manga_chapter):
     
     url = f"https://manga4life.com/read-online/{manga_name}-chapter-{manga_chapter}.html"
     try:
-        response = requests.get(url)
+        response = shared_requests_session().get(url)
         if response.status_code == 200:
             html_content = response.text
             return extract_text_from_html(html_content)
@@ -107,3 +109,5 @@ for chapter_number in chapters_to_download:
             if not download_image(url, image_path):
                 print(f"Download of Chapter {chapter_number} Complete")
                 break  # Exit the loop if the
+
+print_connection_stats(shared_requests_session())
@@ -1,8 +1,10 @@
 import os
 import re
-import requests
 from concurrent.futures import ThreadPoolExecutor
 
+from httpclient import print_connection_stats, shared_requests_session
+from pagestore import replacing
+
 def generate_image_url(manga_name, chapter_number, png_number, manga_address):
     base_url = f"https://{manga_address}/manga/{{}}/{{}}-{{:03d}}.png"
     formatted_manga_name = manga_name.replace(" ", "-")
@@ -13,7 +15,7 @@ def download_image(session, url, path):
     try:
         response = session.get(url, stream=True)
         if response.status_code == 200:
-            with open(path, 'wb') as file:
+            with replacing(path) as file:
                 for chunk in response.iter_content(1024):
                     file.write(chunk)
             print(f"Downloaded: {url}")
@@ -51,16 +53,17 @@ def extract_text_from_url(manga_name, manga_chapter, session):
         return None
 
 def download_chapter_images(manga_name, chapter_number, manga_address, chapter_folder):
-    with requests.Session() as session:
-        png_number = 1
-        while True:
-            url = generate_image_url(manga_name, chapter_number, png_number, manga_address)
-            image_filename = "{:03d}.png".format(png_number)
-            image_path = os.path.join(chapter_folder, image_filename)
-            if not download_image(session, url, image_path):
-                print(f"Download of Chapter {chapter_number} Complete")
-                break
-            png_number += 1
+    # Reuse the connections of the shared session instead of one session per chapter
+    session = shared_requests_session()
+    png_number = 1
+    while True:
+        url = generate_image_url(manga_name, chapter_number, png_number, manga_address)
+        image_filename = "{:03d}.png".format(png_number)
+        image_path = os.path.join(chapter_folder, image_filename)
+        if not download_image(session, url, image_path):
+            print(f"Download of Chapter {chapter_number} Complete")
+            break
+        png_number += 1
 
 def main():
     manga_name = input("Enter the manga name: ")
@@ -71,15 +74,16 @@ def main():
     manga_folder = os.path.join(os.getcwd(), formatted_manga_name)
     os.makedirs(manga_folder, exist_ok=True)
 
-    with requests.Session() as session:
-        for chapter_number in chapters_to_download:
-            chapter_folder_name = f"Chapter : {str(chapter_number).zfill(4)}"
-            chapter_folder = os.path.join(manga_folder, chapter_folder_name)
-            os.makedirs(chapter_folder, exist_ok=True)
+    session = shared_requests_session()
+    for chapter_number in chapters_to_download:
+        chapter_folder_name = f"Chapter : {str(chapter_number).zfill(4)}"
+        chapter_folder = os.path.join(manga_folder, chapter_folder_name)
+        os.makedirs(chapter_folder, exist_ok=True)
 
-            manga_address = extract_text_from_url(manga_name, chapter_number, session)
-            if manga_address:
-                download_chapter_images(manga_name, chapter_number, manga_address, chapter_folder)
+        manga_address = extract_text_from_url(manga_name, chapter_number, session)
+        if manga_address:
+            download_chapter_images(manga_name, chapter_number, manga_address, chapter_folder)
+    print_connection_stats(session)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+import io
+import time
+import asyncio
+import logging
+import tarfile
+import zipfile
+
+from mangaclient import MangaClient
+from ratelimit import RateLimiter
+from sinks import image_extension
+
+STREAM_FORMATS = ("cbz", "tar")
+
+
+class ArchiveStream:
+    # Writes pages as archive members to a non-seekable stream such as stdout.
+    # zipfile falls back to data descriptors there, and tar's stream mode
+    # never seeks, so nothing is staged on disk.
+    def __init__(self, output, archive_format: str):
+        if archive_format not in STREAM_FORMATS:
+            raise ValueError(f"Unknown archive format {archive_format!r} (choose from {', '.join(STREAM_FORMATS)})")
+        if archive_format == "cbz":
+            self.archive = zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(fileobj=output, mode='w|')
+        self.archive_format = archive_format
+        self.output = output
+
+    def add(self, name: str, data: bytes):
+        if self.archive_format == "cbz":
+            member = zipfile.ZipInfo(name, time.localtime()[:6])
+            self.archive.writestr(member, data)
+        else:
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = int(time.time())
+            self.archive.addfile(member, io.BytesIO(data))
+        self.output.flush()
+
+    def close(self):
+        self.archive.close()
+
+
+async def stream_archive(series: str, chapters: list, output, archive_format: str = "cbz",
+                         rate_limiter: RateLimiter = None) -> int:
+    # One archive for all chapters, members named Chapter-NNNN/NNN.ext, in
+    # chapter order. Members are written from a worker thread so a slow reader
+    # on the other end of the pipe does not stall the fetches in flight.
+    loop = asyncio.get_running_loop()
+    archive = ArchiveStream(output, archive_format)
+    pages = 0
+    found = set()
+    try:
+        async with MangaClient(rate_limiter=rate_limiter) as client:
+            async for chapter, page in client.stream_chapters(series, chapters, skip_missing=True):
+                name = f"Chapter-{chapter}/{page.index:03d}{image_extension(page.data)}"
+                await loop.run_in_executor(None, archive.add, name, page.data)
+                found.add(chapter)
+                pages += 1
+    finally:
+        await loop.run_in_executor(None, archive.close)
+    logging.info(f"Streamed {pages} page(s) from {len(found)} chapter(s).")
+    if len(found) < len(chapters):
+        logging.warning(f"{len(chapters) - len(found)} chapter(s) missing or empty.")
+    return pages
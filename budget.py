@@ -0,0 +1,81 @@
+import asyncio
+import re
+from collections import deque
+
+_SIZE_UNITS = {
+    "": 1,
+    "B": 1,
+    "K": 1024, "KB": 1024, "KIB": 1024,
+    "M": 1024 ** 2, "MB": 1024 ** 2, "MIB": 1024 ** 2,
+    "G": 1024 ** 3, "GB": 1024 ** 3, "GIB": 1024 ** 3,
+}
+
+
+def parse_size(size_str: str) -> int:
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([A-Za-z]*)\s*', size_str)
+    if not match or match.group(2).upper() not in _SIZE_UNITS:
+        raise ValueError(f"Invalid size: {size_str!r} (expected e.g. 256MB)")
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+
+def format_size(num_bytes: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024 or unit == "GB":
+            return f"{num_bytes:.0f}{unit}" if unit == "B" else f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+
+
+class ByteBudget:
+    # Shared ceiling on page bytes that have been fetched but not yet consumed
+    # by a sink. Fetchers wait for room before issuing a request and charge
+    # the body size once it is read; sinks release it after writing the page.
+    # Requests already in flight are never blocked, so a single oversized page
+    # can always complete and the pipeline cannot deadlock on its own buffer.
+    def __init__(self, limit: int):
+        if limit <= 0:
+            raise ValueError("Buffer limit must be positive")
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self._waiters = deque()
+        self._loop = None
+
+    def _has_room(self) -> bool:
+        return self.in_flight < self.limit
+
+    async def wait_for_room(self):
+        self._loop = asyncio.get_running_loop()
+        if self._has_room() and not self._waiters:
+            return
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        # Let the next waiter through too if there is still room
+        self._wake_waiters()
+
+    def charge(self, nbytes: int):
+        self.in_flight += nbytes
+        self.peak = max(self.peak, self.in_flight)
+
+    def release(self, nbytes: int):
+        self.in_flight = max(0, self.in_flight - nbytes)
+        self._wake_waiters()
+
+    def release_threadsafe(self, nbytes: int):
+        # Sinks render in worker threads; hand the release back to the loop
+        if self._loop is None:
+            self.release(nbytes)
+        else:
+            self._loop.call_soon_threadsafe(self.release, nbytes)
+
+    def _wake_waiters(self):
+        while self._waiters and self._has_room():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
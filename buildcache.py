@@ -0,0 +1,68 @@
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+
+def settings_digest(settings: dict) -> str:
+    encoded = json.dumps(settings, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class PageSetHasher:
+    # Order-sensitive digest over the hashes of every page in a chapter
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self.page_count = 0
+
+    def update(self, page_bytes: bytes):
+        self._digest.update(hashlib.sha256(page_bytes).digest())
+        self.page_count += 1
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+class BuildCache:
+    # Records which page set and output settings produced each rendered file,
+    # so unchanged outputs can be left alone on the next run.
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            self.entries = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def is_fresh(self, output: Path, pages: str, settings: str) -> bool:
+        entry = self.lookup(output, settings)
+        return entry is not None and entry["pages"] == pages
+
+    def lookup(self, output: Path, settings: str):
+        # Returns the entry only if the output is still on disk and was built
+        # with the same settings; otherwise the output must be rebuilt anyway.
+        with self._lock:
+            entry = self.entries.get(output.name)
+        if entry is None or entry["settings"] != settings or not output.exists():
+            return None
+        return entry
+
+    def record(self, output: Path, pages: str, settings: str, page_count: int):
+        with self._lock:
+            self.entries[output.name] = {"pages": pages, "settings": settings, "page_count": page_count}
+            self._dirty = True
+
+    def forget(self, output: Path):
+        with self._lock:
+            if self.entries.pop(output.name, None) is not None:
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            partial_path = self.path.with_suffix(".part")
+            partial_path.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+            partial_path.replace(self.path)
+            self._dirty = False
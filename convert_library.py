@@ -0,0 +1,210 @@
+import os
+import re
+import sys
+import zlib
+import zipfile
+import argparse
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from pdfsink import PdfWriter
+from pdfobjects import PdfReader, PdfError
+from sinks import image_extension
+from volume import open_mapped
+
+# Matches the folder names of every downloader: "Chapter-0001" (D4C, D4B2),
+# "Chapter: 0001" (fasterish, Easi) and "Chapter : 0001" (help, Help2)
+CHAPTER_FOLDER = re.compile(r'^Chapter\s*[-:]\s*(\d+(?:\.\d+)?)$')
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.webp', '.gif'}
+
+
+def page_sort_key(name: str):
+    # help.py renames pages to <manga>_<chapter>_<n>.png, so use the last number
+    numbers = re.findall(r'\d+', Path(name).stem)
+    return (int(numbers[-1]) if numbers else 0, name)
+
+
+def find_chapter_folders(root: Path):
+    # os.scandir keeps the walk cheap on trees with millions of page files
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = sorted(os.scandir(folder), key=lambda entry: entry.name)
+        except OSError as e:
+            logging.warning(f"Cannot read {folder}: {e}")
+            continue
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            match = CHAPTER_FOLDER.match(entry.name)
+            if match:
+                yield Path(entry.path), match.group(1)
+            else:
+                stack.append(Path(entry.path))
+
+
+def format_chapter_number(chapter_number: str) -> str:
+    integer_part, _, decimal_part = chapter_number.partition('.')
+    formatted = f"{int(integer_part):04d}"
+    return f"{formatted}.{decimal_part}" if decimal_part else formatted
+
+
+def list_pages(folder: Path) -> list:
+    names = [entry.name for entry in os.scandir(folder)
+             if entry.is_file() and Path(entry.name).suffix.lower() in IMAGE_SUFFIXES]
+    return [folder / name for name in sorted(names, key=page_sort_key)]
+
+
+def write_cbz(pages: list, output: Path):
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for page_number, page in enumerate(pages, start=1):
+            with open(page, 'rb') as file:
+                extension = image_extension(file.read(12))
+            archive.write(page, f"{page_number:03d}{extension}")
+
+
+def write_pdf(pages: list, output: Path):
+    with open(output, 'wb') as file, PdfWriter(file) as writer:
+        for page in pages:
+            writer.add_image(page.read_bytes())
+
+
+def verify_archive(output: Path, output_format: str, page_count: int) -> bool:
+    try:
+        if output_format == 'cbz':
+            with zipfile.ZipFile(output) as archive:
+                return len(archive.infolist()) == page_count and archive.testzip() is None
+        data = open_mapped(output)
+        try:
+            return sum(1 for _ in PdfReader(data).pages()) == page_count
+        finally:
+            data.close()
+    except (OSError, ValueError, zipfile.BadZipFile, PdfError):
+        return False
+
+
+def holds_pages(output: Path, output_format: str, pages: list) -> bool:
+    # Whether an existing archive was packed from exactly these page files:
+    # CBZ members are compared by CRC-32 and size. A PDF cannot be tied back
+    # to its pages, so it is always rebuilt.
+    if output_format != 'cbz' or not verify_archive(output, output_format, len(pages)):
+        return False
+    with zipfile.ZipFile(output) as archive:
+        for member, page in zip(archive.infolist(), pages):
+            data = page.read_bytes()
+            if member.file_size != len(data) or member.CRC != zlib.crc32(data):
+                return False
+    return True
+
+
+def convert_chapter(folder: Path, output: Path, output_format: str, remove_source: bool):
+    # Runs in a worker process; only one page is held in memory at a time.
+    # Pages are only removed once the archive is known to hold them: written
+    # and verified now, or an earlier CBZ with the same page contents.
+    pages = list_pages(folder)
+    if not pages:
+        return "empty", 0
+    if not (output.exists() and holds_pages(output, output_format, pages)):
+        partial_output = output.with_name(output.name + ".part")
+        try:
+            (write_cbz if output_format == 'cbz' else write_pdf)(pages, partial_output)
+            if not verify_archive(partial_output, output_format, len(pages)):
+                return "failed verification", len(pages)
+            partial_output.replace(output)
+        finally:
+            partial_output.unlink(missing_ok=True)
+    if remove_source:
+        for page in pages:
+            page.unlink()
+        try:
+            folder.rmdir()
+        except OSError:
+            pass  # Leave folders that hold anything besides pages
+    return "converted", len(pages)
+
+
+def load_journal(journal: Path) -> set:
+    if not journal.exists():
+        return set()
+    return set(journal.read_text(encoding='utf-8').splitlines())
+
+
+def chapter_output(folder: Path, chapter_number: str, output_format: str) -> Path:
+    return folder.parent / f"Chapter-{format_chapter_number(chapter_number)}.{output_format}"
+
+
+def convert_library(roots: list, output_format: str, workers: int, remove_source: bool, journal: Path):
+    done = load_journal(journal)
+    converted = failed = skipped = 0
+    in_flight = {}
+    # "Chapter: 0001" and "Chapter-0001" in one series map to the same
+    # archive; only the first folder (in this run or a journaled one) gets it
+    owners = {}
+    for key in done:
+        done_format, _, done_folder = key.partition('\t')
+        match = CHAPTER_FOLDER.match(Path(done_folder).name)
+        if done_format == output_format and match:
+            owners[chapter_output(Path(done_folder), match.group(1), output_format)] = Path(done_folder)
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(journal, 'a', encoding='utf-8') as journal_file:
+        def collect(futures):
+            nonlocal converted, failed
+            for future in futures:
+                folder, key = in_flight.pop(future)
+                try:
+                    status, page_count = future.result()
+                except Exception as e:
+                    status, page_count = f"error: {e}", 0
+                if status == "converted":
+                    converted += 1
+                    journal_file.write(key + "\n")
+                    journal_file.flush()
+                    logging.info(f"Packed {folder} ({page_count} pages)")
+                elif status != "empty":
+                    failed += 1
+                    logging.error(f"Could not convert {folder}: {status}")
+
+        for root in roots:
+            for folder, chapter_number in find_chapter_folders(root):
+                key = f"{output_format}\t{folder.resolve()}"
+                if key in done:
+                    skipped += 1
+                    continue
+                output = chapter_output(folder, chapter_number, output_format)
+                owner = owners.setdefault(chapter_output(folder.resolve(), chapter_number, output_format), folder.resolve())
+                if owner != folder.resolve():
+                    failed += 1
+                    logging.error(f"Could not convert {folder}: {output.name} belongs to {owner.name}")
+                    continue
+                # Submit lazily so a huge library never queues every chapter at once
+                while len(in_flight) >= workers * 2:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                in_flight[executor.submit(convert_chapter, folder, output, output_format, remove_source)] = (folder, key)
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(finished)
+    logging.info(f"Converted {converted} chapter(s), {failed} failed, {skipped} already done.")
+    return failed == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack downloaded chapter folders into CBZ or PDF files")
+    parser.add_argument('roots', nargs='+', type=Path, help="Library folders to scan (e.g. MANGA Mangas)")
+    parser.add_argument('-f', '--format', choices=('cbz', 'pdf'), default='cbz', help="Archive format")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument('--remove-source', action='store_true', help="Delete page files once their archive is verified")
+    parser.add_argument('--journal', type=Path, default=Path("convert_journal.txt"), help="Progress file used to resume an interrupted run")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    if not convert_library(args.roots, args.format, max(1, args.workers), args.remove_source, args.journal):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,10 @@ from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from functools import partial
 
+from integrity import DamagedPage, fetch_verified_sync
+from httpclient import create_requests_session, print_connection_stats
+from pagestore import replacing
+
 class MangaDownloader:
     def __init__(self, manga_name):
         self.manga_name = manga_name.title()
@@ -18,12 +22,15 @@ class MangaDownloader:
 
     def download_image(self, session, url, path):
         try:
-            response = session.get(url, stream=True)
-            response.raise_for_status()
-            with open(path, 'wb') as file:
-                file.write(response.content)
+            data = fetch_verified_sync(session, url)
+            with replacing(path) as file:
+                file.write(data)
             print(f"Downloaded: {url}")
             return True
+        except DamagedPage as e:
+            # Keep going with the next page; D4C --verify re-fetches the gap later
+            print(f"Skipping damaged page {e}")
+            return True
         except requests.exceptions.RequestException as e:
             print(f"Error downloading {url}: {e}")
             return False
@@ -59,13 +66,14 @@ class MangaDownloader:
             png_number += 1
 
     def download_chapters(self, chapters_to_download):
-        with requests.Session() as session:
+        with create_requests_session() as session:
             with ThreadPoolExecutor(max_workers=4) as executor:
                 for chapter_number in chapters_to_download:
                     chapter_folder_name = f"Chapter: {str(chapter_number).zfill(4)}"
                     chapter_folder = self.manga_folder / chapter_folder_name
                     chapter_folder.mkdir(exist_ok=True)
                     executor.submit(self.download_chapter_images, session, chapter_number, chapter_folder)
+            print_connection_stats(session)
 
 def main():
     manga_name = input("Enter the manga name: ")
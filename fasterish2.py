@@ -3,13 +3,16 @@ import requests
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from httpclient import create_requests_session, print_connection_stats
+from pagestore import replacing
+
 class MangaDownloader:
     def __init__(self, manga_name):
         self.manga_name = manga_name.title()
         self.formatted_manga_name = self.manga_name.replace(" ", "-")
         self.manga_folder = Path(self.formatted_manga_name)
         self.manga_folder.mkdir(exist_ok=True)
-        self.session_pool = requests.Session()
+        self.session_pool = create_requests_session()
         self.executor = ThreadPoolExecutor()
 
     def generate_image_url(self, chapter_number, png_number, manga_address):
@@ -21,7 +24,7 @@ class MangaDownloader:
         try:
             response = self.session_pool.get(url, stream=True)
             response.raise_for_status()
-            with open(path, 'wb') as file:
+            with replacing(path) as file:
                 file.write(response.content)
             print(f"Downloaded: {url}")
             return True
@@ -71,6 +74,8 @@ class MangaDownloader:
             chapter_folder = self.manga_folder / chapter_folder_name
             chapter_folder.mkdir(exist_ok=True)
             self.executor.submit(self.download_chapter_images, chapter_number, chapter_folder)
+        self.executor.shutdown(wait=True)
+        print_connection_stats(self.session_pool)
 
 def main():
     manga_name = input("Enter the manga name: ")
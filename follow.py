@@ -0,0 +1,201 @@
+import re
+import json
+import time
+import asyncio
+import argparse
+import logging
+from pathlib import Path
+
+import aiohttp
+
+from httpclient import HttpClient
+from planner import JsonStore
+from scheduler import queue_lock
+
+HISTORY_FILE = Path("download_history.txt")
+FOLLOW_STATE_FILE = Path("follow_state.json")
+FOLLOW_QUEUE_FILE = Path("follow_queue.txt")
+INDEX_URL = "https://manga4life.com/manga/{}"
+CHAPTERS_PATTERN = re.compile(r'vm\.Chapters\s*=\s*(\[.*?\]);', re.DOTALL)
+# Polling interval bounds; active series are checked often, dormant ones back off
+MIN_INTERVAL = 30 * 60
+MAX_INTERVAL = 7 * 24 * 3600
+FIRST_INTERVAL = 6 * 3600
+BACKOFF = 1.5
+POLL_CONCURRENCY = 8
+
+
+def decode_chapter(code: str) -> str:
+    # vm.Chapters encodes "0014.5" as "100145": index digit, 4 digits, decimal digit
+    number = f"{int(code[1:-1]):04d}"
+    return f"{number}.{code[-1]}" if code[-1] != '0' else number
+
+
+def parse_chapter_index(html_content: str) -> list:
+    match = CHAPTERS_PATTERN.search(html_content)
+    if not match:
+        return None
+    return [decode_chapter(entry["Chapter"]) for entry in json.loads(match.group(1))]
+
+
+def tracked_series(history_file: Path = HISTORY_FILE) -> list:
+    if not history_file.exists():
+        return []
+    names = [line.strip() for line in history_file.read_text(encoding='utf-8').splitlines()]
+    return list(dict.fromkeys(name for name in names if name))
+
+
+class FollowState(JsonStore):
+    # Per series: known chapters, HTTP validators of the index page and the
+    # adaptive polling schedule
+    def __init__(self, path: Path = FOLLOW_STATE_FILE):
+        super().__init__(path)
+
+    def series(self, name: str) -> dict:
+        return self.entries.setdefault(name, {"chapters": None, "etag": None, "last_modified": None,
+                                              "interval": FIRST_INTERVAL, "next_check": 0})
+
+    def due(self, names: list, now: float) -> list:
+        return [name for name in names if self.series(name)["next_check"] <= now]
+
+    def schedule(self, name: str, found_new: bool, now: float):
+        with self._lock:
+            entry = self.series(name)
+            if found_new:
+                entry["interval"] = max(MIN_INTERVAL, entry["interval"] / 2)
+            else:
+                entry["interval"] = min(MAX_INTERVAL, entry["interval"] * BACKOFF)
+            entry["next_check"] = now + entry["interval"]
+            self.dirty = True
+
+
+async def poll_series(session: aiohttp.ClientSession, state: FollowState, name: str) -> list:
+    # One conditional GET of the series page; returns the new chapters
+    entry = state.series(name)
+    headers = {}
+    if entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    url = INDEX_URL.format(re.sub(r'\s+', '-', name))
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                return []
+            if response.status != 200:
+                logging.warning(f"Could not check {name}: HTTP {response.status}")
+                return []
+            html_content = await response.text()
+            validators = response.headers.get("ETag"), response.headers.get("Last-Modified")
+    except aiohttp.ClientError as e:
+        logging.warning(f"Could not check {name}: {e}")
+        return []
+    chapters = parse_chapter_index(html_content)
+    if chapters is None:
+        logging.warning(f"No chapter list found on the page of {name}")
+        return []
+    with state._lock:
+        known = entry["chapters"]
+        entry["etag"], entry["last_modified"] = validators
+        entry["chapters"] = sorted(set(chapters) | set(known or []))
+        state.dirty = True
+    if known is None:
+        # The first poll only records what already exists
+        logging.info(f"Now following {name} ({len(chapters)} chapters)")
+        return []
+    return sorted(set(chapters) - set(known), key=float)
+
+
+async def poll_due(state: FollowState, names: list, queue_file: Path = FOLLOW_QUEUE_FILE) -> int:
+    now = time.time()
+    due = state.due(names, now)
+    semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+    queued = 0
+    # Every series page lives on manga4life, so all polls share its connections
+    async with HttpClient(limit=POLL_CONCURRENCY, limit_per_host=POLL_CONCURRENCY) as client:
+        async def poll(name: str):
+            nonlocal queued
+            async with semaphore:
+                new_chapters = await poll_series(client.session, state, name)
+            state.schedule(name, bool(new_chapters), now)
+            if new_chapters:
+                logging.info(f"{name}: new chapter(s) {', '.join(new_chapters)}")
+                with queue_lock(queue_file), open(queue_file, 'a', encoding='utf-8') as file:
+                    file.writelines(f"{name}\t{chapter}\n" for chapter in new_chapters)
+                queued += len(new_chapters)
+
+        await asyncio.gather(*(poll(name) for name in due))
+    state.save()
+    logging.info(f"Checked {len(due)} of {len(names)} series, queued {queued} new chapter(s).")
+    return queued
+
+
+def read_queue(queue_file: Path = FOLLOW_QUEUE_FILE) -> dict:
+    if not queue_file.exists():
+        return {}
+    queue = {}
+    with queue_lock(queue_file):
+        for line in queue_file.read_text(encoding='utf-8').splitlines():
+            name, _, chapter = line.partition('\t')
+            if chapter:
+                queue.setdefault(name, []).append(chapter)
+    return queue
+
+
+def remove_from_queue(name: str, chapters: list, queue_file: Path = FOLLOW_QUEUE_FILE):
+    # Rewrites the queue without these chapters of one series; lines queued
+    # meanwhile by another poll are kept
+    done = {(name, chapter) for chapter in chapters}
+    with queue_lock(queue_file):
+        lines = queue_file.read_text(encoding='utf-8').splitlines()
+        kept = [line for line in lines if line.strip() and line.partition('\t')[::2] not in done]
+        partial_path = queue_file.with_name(queue_file.name + ".part")
+        partial_path.write_text("".join(line + "\n" for line in kept), encoding='utf-8')
+        partial_path.replace(queue_file)
+
+
+def download_queue(queue_file: Path = FOLLOW_QUEUE_FILE):
+    # A series' chapters leave the queue only once downloaded, so a failed or
+    # interrupted download is picked up again by the next run
+    from D4C import MangaDownloader
+    for name, chapters in read_queue(queue_file).items():
+        downloader = MangaDownloader(name, edit=True)
+        try:
+            downloaded = asyncio.run(downloader.download_chapters(list(dict.fromkeys(chapters))))
+        except Exception as e:
+            logging.error(f"Could not download {name}, its chapters stay queued: {e}")
+            continue
+        remove_from_queue(name, downloaded, queue_file)
+        missing = [chapter for chapter in dict.fromkeys(chapters) if chapter not in downloaded]
+        if missing:
+            logging.warning(f"{name}: chapter(s) {', '.join(missing)} not downloaded yet, kept in the queue")
+
+
+def next_due(state: FollowState, names: list) -> float:
+    return min((state.series(name)["next_check"] for name in names), default=time.time() + MIN_INTERVAL)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check followed series for new chapters")
+    parser.add_argument('--watch', action='store_true', help="Keep running and poll each series on its own schedule")
+    parser.add_argument('--download', action='store_true', help="Download queued chapters with D4C after polling")
+    parser.add_argument('--history', type=Path, default=HISTORY_FILE, help="Series to follow, one per line")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    state = FollowState()
+    while True:
+        names = tracked_series(args.history)
+        asyncio.run(poll_due(state, names))
+        if args.download:
+            download_queue()
+        if not args.watch:
+            break
+        time.sleep(max(60, next_due(state, names) - time.time()))
+
+
+if __name__ == "__main__":
+    main()
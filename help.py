@@ -1,8 +1,10 @@
 import os
 import re
-import requests
 import subprocess
 
+from httpclient import print_connection_stats, shared_requests_session
+from pagestore import replacing
+
 def generate_image_url(manga_name, chapter_number, png_number, manga_address):
     base_url = f"https://{manga_address}/manga/{{}}/{{}}-{{:03d}}.png"
     formatted_manga_name = manga_name.replace(" ", "-")
@@ -11,9 +13,9 @@ def generate_image_url(manga_name, chapter_number, png_number, manga_address):
 
 def download_image(url, path):
     try:
-        response = requests.get(url, stream=True)
+        response = shared_requests_session().get(url, stream=True)
         if response.status_code == 200:
-            with open(path, 'wb') as file:
+            with replacing(path) as file:
                 for chunk in response.iter_content(1024):
                     file.write(chunk)
             print(f"Downloaded: {url}")
@@ -48,7 +50,7 @@ def extract_text_from_url(manga_name, manga_chapter):
     
     url = f"https://manga4life.com/read-online/{manga_name}-chapter-{manga_chapter}.html"
     try:
-        response = requests.get(url)
+        response = shared_requests_session().get(url)
         if response.status_code == 200:
             html_content = response.text
             return extract_text_from_html(html_content)
@@ -116,4 +118,5 @@ if manga_address:
     convert_to_pdf(chapter_folder, output_pdf)
 else:
     print("Failed to extract manga address.")
+print_connection_stats(shared_requests_session())
 
@@ -0,0 +1,214 @@
+import time
+import socket
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+
+from ratelimit import RateLimiter
+
+DNS_CACHE_TTL = 300
+DNS_CACHE_SIZE = 256
+CONNECTION_LIMIT = 10
+LIMIT_PER_HOST = 8
+# Idle connections are kept long enough to carry over between chapters
+KEEPALIVE_TIMEOUT = 60
+PREWARM_TIMEOUT = 10
+
+
+class ConnectionStats:
+    # Counted through aiohttp's tracing hooks. Every new connection is a TCP
+    # (and, for https, TLS) handshake; reused ones cost neither.
+    def __init__(self):
+        self.requests = Counter()
+        self.connections = Counter()
+        self.reused = Counter()
+        self.dns_lookups = Counter()
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.host = params.url.host
+            self.requests[context.host] += 1
+
+        async def on_connection_create_end(session, context, params):
+            self.connections[getattr(context, 'host', None)] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self.reused[getattr(context, 'host', None)] += 1
+
+        async def on_dns_resolvehost_end(session, context, params):
+            self.dns_lookups[params.host] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        return trace_config
+
+    def summary(self) -> str:
+        return "; ".join(f"{host}: {self.requests[host]} requests, {self.connections[host]} new connections, "
+                         f"{self.dns_lookups[host]} DNS lookups" for host in sorted(self.requests))
+
+
+class HttpClient:
+    # One long-lived session per run, shared by discovery and downloading, so
+    # connections to manga4life and the image hosts are opened once and kept
+    # alive across chapters. Create it inside the running event loop.
+    def __init__(self, limit: int = CONNECTION_LIMIT, limit_per_host: int = LIMIT_PER_HOST, rate_limiter: RateLimiter = None):
+        self.stats = ConnectionStats()
+        self.rate_limiter = rate_limiter
+        connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=DNS_CACHE_TTL,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        trace_configs = [self.stats.trace_config()]
+        if rate_limiter is not None:
+            trace_configs.append(rate_limiter.trace_config())
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=trace_configs)
+        self._prewarming = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def prewarm(self, host: str):
+        # Called as soon as vm.CurPathName is known: the DNS lookup and TLS
+        # handshake to the image host overlap with the rest of the chapter setup
+        if host and host not in self._prewarming:
+            self._prewarming[host] = asyncio.ensure_future(self._warm(f"https://{host}/"))
+
+    async def _warm(self, url: str):
+        try:
+            async with self.session.head(url, timeout=aiohttp.ClientTimeout(total=PREWARM_TIMEOUT)):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    def log_stats(self):
+        if self.stats.requests:
+            logging.info(f"Connections: {self.stats.summary()}")
+        if self.rate_limiter is not None:
+            self.rate_limiter.log_stats()
+
+    async def close(self):
+        for task in self._prewarming.values():
+            task.cancel()
+        await asyncio.gather(*self._prewarming.values(), return_exceptions=True)
+        await self.session.close()
+
+
+_dns_cache = {}
+_dns_lock = threading.Lock()
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def cached_addresses(host: str, port: int) -> list:
+    # Addresses of host, looked up at most once per DNS_CACHE_TTL
+    now = time.monotonic()
+    with _dns_lock:
+        entry = _dns_cache.get((host, port))
+    if entry is not None and now - entry[0] < DNS_CACHE_TTL:
+        return entry[1]
+    addresses = list(dict.fromkeys(info[4][0] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)))
+    with _dns_lock:
+        _dns_cache.pop((host, port), None)
+        while len(_dns_cache) >= DNS_CACHE_SIZE:
+            del _dns_cache[next(iter(_dns_cache))]  # oldest lookup first
+        _dns_cache[(host, port)] = (now, addresses)
+    return addresses
+
+
+class CachedDnsConnectionMixin:
+    # urllib3 connects to _dns_host while TLS and Host headers use host, so
+    # pointing _dns_host at a cached address skips the lookup and nothing else
+    def _new_conn(self):
+        dns_host = self._dns_host
+        try:
+            addresses = cached_addresses(dns_host, self.port)
+        except OSError:
+            return super()._new_conn()  # reported by urllib3 as a resolution error
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except ConnectTimeoutError as e:
+                    error = e
+        finally:
+            self._dns_host = dns_host
+        raise error
+
+
+class CachedDnsHTTPConnection(CachedDnsConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDnsHTTPSConnection(CachedDnsConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDnsHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDnsHTTPConnection
+
+
+class CachedDnsHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+
+class CachedDnsAdapter(HTTPAdapter):
+    # requests has no resolver cache of its own; this gives its sessions one
+    # without touching socket.getaddrinfo for the rest of the process
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CachedDnsHTTPConnectionPool,
+                                                   "https": CachedDnsHTTPSConnectionPool}
+
+
+def create_requests_session(pool_size: int = LIMIT_PER_HOST) -> requests.Session:
+    # requests counterpart of HttpClient for the synchronous scripts
+    session = requests.Session()
+    adapter = CachedDnsAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def shared_requests_session() -> requests.Session:
+    # For scripts built from module-level functions rather than a class
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = create_requests_session()
+        return _shared_session
+
+
+def requests_connection_stats(session: requests.Session) -> dict:
+    # host: (requests, new connections), read from urllib3's connection pools
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_made, connections = stats.get(pool.host, (0, 0))
+            stats[pool.host] = (requests_made + pool.num_requests, connections + pool.num_connections)
+    return stats
+
+
+def print_connection_stats(session: requests.Session):
+    # The synchronous scripts report with print(), so this prints the line
+    # HttpClient.log_stats logs
+    stats = requests_connection_stats(session)
+    if stats:
+        print("Connections: " + "; ".join(f"{host}: {requests_made} requests, {connections} new connections"
+                                           for host, (requests_made, connections) in sorted(stats.items())))
@@ -24,6 +24,9 @@ fi
 # Define script and executable names
 SCRIPT_NAME="D4C.py"
 EXECUTABLE_NAME="D4C"
+# Local modules imported by D4C.py
+HELPER_MODULES="pagestore.py budget.py integrity.py pagemeta.py httpclient.py ratelimit.py mangaclient.py archivestream.py planner.py convert_library.py sinks.py storage.py buildcache.py pdfsink.py pdfobjects.py volume.py logsetup.py tasktable.py"
+INSTALL_DIR="/usr/local/lib/manga4life"
 README_FILE="README_D4C.txt"
 
 # Install required dependencies
@@ -55,17 +58,21 @@ fi
 
 # Install required Python packages
 echo "Installing Python packages..."
-pip3 install aiohttp aiofiles reportlab colorama
+pip3 install aiohttp aiofiles pillow colorama requests
 
-# Ensure the script file exists in the current directory
-if [ ! -f "$SCRIPT_NAME" ]; then
-  echo "Error: $SCRIPT_NAME not found in the current directory."
-  exit 1
-fi
+# Ensure the script files exist in the current directory
+for FILE in $SCRIPT_NAME $HELPER_MODULES; do
+  if [ ! -f "$FILE" ]; then
+    echo "Error: $FILE not found in the current directory."
+    exit 1
+  fi
+done
 
-# Copy the script to /usr/local/bin and make it executable
+# Copy the script and its modules to $INSTALL_DIR and add a launcher to /usr/local/bin
 echo "Installing $EXECUTABLE_NAME..."
-cp "$SCRIPT_NAME" /usr/local/bin/$EXECUTABLE_NAME
+mkdir -p "$INSTALL_DIR"
+cp "$SCRIPT_NAME" $HELPER_MODULES "$INSTALL_DIR"/
+printf '#!/bin/sh\nexec python3 "%s" "$@"\n' "$INSTALL_DIR/$SCRIPT_NAME" > /usr/local/bin/$EXECUTABLE_NAME
 chmod +x /usr/local/bin/$EXECUTABLE_NAME
 
 # Create a README file with usage instructions
@@ -84,8 +91,9 @@ D4C is a command-line tool for downloading manga chapters as PDFs. It supports f
 The following dependencies are automatically installed:
 - \`aiohttp\`
 - \`aiofiles\`
-- \`reportlab\`
+- \`pillow\`
 - \`colorama\`
+- \`requests\`
 
 ## Usage
 Run the following command to use D4C after installation:
@@ -126,7 +134,7 @@ You will be prompted to:
 ## Troubleshooting
 If you encounter issues:
 1. Ensure Python 3 is installed: \`python3 --version\`.
-2. Check if all dependencies are installed: \`aiohttp\`, \`aiofiles\`, \`reportlab\`, \`colorama\`.
+2. Check if all dependencies are installed: \`aiohttp\`, \`aiofiles\`, \`pillow\`, \`colorama\`, \`requests\`.
 
 ## Reinstallation
 To reinstall or update, rerun this installation script:
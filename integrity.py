@@ -0,0 +1,208 @@
+import os
+import sys
+import zlib
+import struct
+import asyncio
+import argparse
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import requests
+
+from convert_library import find_chapter_folders, list_pages, page_sort_key
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Damaged pages are fetched again this many times before giving up
+FETCH_ATTEMPTS = 3
+# Throttling and server errors say nothing about whether a page exists, so
+# they are retried after these pauses (or the server's Retry-After)
+TRANSIENT_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+STATUS_RETRY_DELAYS = (2, 5, 15)
+MAX_RETRY_AFTER = 60
+
+
+class DamagedPage(ValueError):
+    def __init__(self, url: str, problem: str):
+        super().__init__(f"{url}: {problem}")
+        self.url = url
+        self.problem = problem
+
+
+def check_png(data: bytes) -> str:
+    if not data.startswith(PNG_SIGNATURE):
+        return "bad PNG signature"
+    pos = len(PNG_SIGNATURE)
+    first = True
+    while pos + 12 <= len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        end = pos + 12 + length
+        if end > len(data):
+            return "truncated PNG chunk"
+        chunk_type = data[pos + 4:pos + 8]
+        if first and chunk_type != b'IHDR':
+            return "PNG does not start with IHDR"
+        first = False
+        # crc32 over a memoryview avoids copying multi-megabyte IDAT chunks
+        crc, = struct.unpack('>I', data[end - 4:end])
+        if zlib.crc32(memoryview(data)[pos + 4:end - 4]) != crc:
+            return f"bad CRC in {chunk_type.decode('latin-1')} chunk"
+        if chunk_type == b'IEND':
+            return None
+        pos = end
+    return "missing IEND"
+
+
+def check_jpeg(data: bytes) -> str:
+    if not data.startswith(b'\xff\xd8'):
+        return "bad JPEG signature"
+    # Some encoders pad the file after the end-of-image marker
+    if not data.rstrip(b'\x00\r\n ').endswith(b'\xff\xd9'):
+        return "missing JPEG EOI marker"
+    return None
+
+
+def check_image(data: bytes, expected_length: int = None) -> str:
+    # Returns a description of the problem, or None for an intact page
+    if expected_length is not None and len(data) != expected_length:
+        return f"got {len(data)} of {expected_length} bytes"
+    if not data:
+        return "empty file"
+    if data.startswith(b'\x89PNG'):
+        return check_png(data)
+    if data.startswith(b'\xff\xd8'):
+        return check_jpeg(data)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        size, = struct.unpack('<I', data[4:8])
+        return None if len(data) >= size + 8 else "truncated WebP"
+    if data.startswith(b'GIF8'):
+        return None if data.rstrip(b'\x00').endswith(b'\x3b') else "missing GIF trailer"
+    return "not an image"
+
+
+def expected_length(headers) -> int:
+    # Content-Length describes the encoded body, so it only applies unencoded
+    length = headers.get('Content-Length')
+    if length is None or headers.get('Content-Encoding', 'identity') != 'identity' or not length.isdigit():
+        return None
+    return int(length)
+
+
+async def fetch_page(session: aiohttp.ClientSession, url: str, headers: dict = None, attempts: int = FETCH_ATTEMPTS) -> tuple:
+    # Returns (status, body, response headers); body is None for anything but
+    # 200, including 304 answers to conditional requests. Raises DamagedPage
+    # if every attempt delivered a broken image.
+    problem = None
+    for attempt in range(1, attempts + 1):
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status != 200:
+                    return response.status, None, response.headers
+                data = await response.read()
+                problem = check_image(data, expected_length(response.headers))
+        except aiohttp.ClientPayloadError as e:
+            problem = f"connection dropped mid-body ({e})"
+        if problem is None:
+            return 200, data, response.headers
+        logging.warning(f"Damaged page {url} ({problem}), attempt {attempt} of {attempts}")
+    raise DamagedPage(url, problem)
+
+
+def retry_delay(headers, default: float) -> float:
+    value = headers.get('Retry-After', '')
+    return min(int(value), MAX_RETRY_AFTER) if value.isdigit() else default
+
+
+async def fetch_page_retrying(session: aiohttp.ClientSession, url: str, headers: dict = None, attempts: int = FETCH_ATTEMPTS,
+                              delays: tuple = STATUS_RETRY_DELAYS) -> tuple:
+    # fetch_page that also retries transient statuses; one is only returned
+    # once every retry got one too
+    for delay in (*delays, None):
+        status, data, response_headers = await fetch_page(session, url, headers, attempts)
+        if status not in TRANSIENT_STATUSES or delay is None:
+            return status, data, response_headers
+        delay = retry_delay(response_headers, delay)
+        logging.warning(f"{url} answered HTTP {status}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+
+async def fetch_verified(session: aiohttp.ClientSession, url: str, attempts: int = FETCH_ATTEMPTS,
+                         delays: tuple = STATUS_RETRY_DELAYS) -> tuple:
+    # Returns (status, body) for callers that do not keep validators
+    status, data, _ = await fetch_page_retrying(session, url, attempts=attempts, delays=delays)
+    return status, data
+
+
+def fetch_verified_sync(session: requests.Session, url: str, attempts: int = FETCH_ATTEMPTS) -> bytes:
+    # requests counterpart of fetch_verified for the synchronous scripts;
+    # HTTP errors are raised as usual through raise_for_status
+    problem = None
+    for attempt in range(1, attempts + 1):
+        try:
+            response = session.get(url)
+            response.raise_for_status()
+            problem = check_image(response.content, expected_length(response.headers))
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError) as e:
+            problem = f"connection dropped mid-body ({e})"
+        if problem is None:
+            return response.content
+        logging.warning(f"Damaged page {url} ({problem}), attempt {attempt} of {attempts}")
+    raise DamagedPage(url, problem)
+
+
+def verify_chapter(folder: Path) -> list:
+    # Runs in a worker process. Returns (path, problem) for every damaged page
+    # and for every gap in the page numbering.
+    broken = []
+    pages = list_pages(folder)
+    numbers = set()
+    for page in pages:
+        # Only the downloaders' NNN.ext names say how long the chapter is; a
+        # number in another name (scan_20240101.png) is not a page count
+        if page.stem.isdigit():
+            numbers.add(int(page.stem))
+        try:
+            problem = check_image(page.read_bytes())
+        except OSError as e:
+            problem = str(e)
+        if problem:
+            broken.append((page, problem))
+    suffix = pages[0].suffix if pages else ".png"
+    for number in range(1, max(numbers, default=0)):
+        if number not in numbers:
+            broken.append((folder / f"{number:03d}{suffix}", "missing"))
+    return broken
+
+
+def find_broken_pages(roots: list, workers: int):
+    # Yields (chapter folder, chapter number, page number, path, problem)
+    folders = [(folder, chapter_number) for root in roots for folder, chapter_number in find_chapter_folders(root)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(verify_chapter, [folder for folder, _ in folders], chunksize=8)
+        for (folder, chapter_number), broken in zip(folders, results):
+            for path, problem in broken:
+                yield folder, chapter_number, page_sort_key(path.name)[0], path, problem
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check downloaded pages for truncation and corruption")
+    parser.add_argument('roots', nargs='+', type=Path, help="Library folders to scan (e.g. MANGA Mangas)")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help="Worker processes")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    broken = 0
+    for _, _, _, path, problem in find_broken_pages(args.roots, max(1, args.workers)):
+        logging.error(f"{path}: {problem}")
+        broken += 1
+    logging.info(f"{broken} damaged or missing page(s). Run D4C --verify to re-fetch them.")
+    if broken:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
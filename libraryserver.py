@@ -0,0 +1,306 @@
+import os
+import re
+import struct
+import asyncio
+import zipfile
+import argparse
+import logging
+import mimetypes
+from pathlib import Path
+
+from aiohttp import web
+
+from convert_library import CHAPTER_FOLDER, IMAGE_SUFFIXES, format_chapter_number, list_pages, page_sort_key
+
+CHAPTER_FILE = re.compile(r'^Chapter\s*[-:]\s*(\d+(?:\.\d+)?)\.(cbz|pdf)$', re.IGNORECASE)
+LOCAL_HEADER = struct.Struct('<4s22xHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+FALLBACK_CHUNK = 256 * 1024
+
+
+class Member:
+    __slots__ = ("name", "offset", "size", "stored", "crc")
+
+    def __init__(self, name: str, offset: int, size: int, stored: bool, crc: int):
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.stored = stored
+        self.crc = crc
+
+
+def read_member_index(path: Path) -> list:
+    # Page members of a CBZ in reading order, with the offset of each
+    # member's data, so stored pages can be sent straight from the file
+    members = []
+    with open(path, 'rb') as file, zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or Path(info.filename).suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            file.seek(info.header_offset)
+            signature, name_length, extra_length = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
+            if signature != LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+            offset = info.header_offset + LOCAL_HEADER.size + name_length + extra_length
+            members.append(Member(info.filename, offset, info.compress_size if info.compress_type == zipfile.ZIP_STORED else info.file_size,
+                                  info.compress_type == zipfile.ZIP_STORED, info.CRC))
+    members.sort(key=lambda member: page_sort_key(member.name))
+    return members
+
+
+class Catalog:
+    # Series and chapters found under the library roots. Listings and CBZ
+    # member indexes are cached and only rebuilt when the folder or archive
+    # changes (by inode, mtime and size), so requests never re-parse an
+    # archive. All of it is blocking file system work: LibraryServer calls
+    # it from an executor.
+    def __init__(self, roots: list):
+        self.roots = roots
+        self._series = {}
+        self._chapters = {}
+        self._pages = {}
+        self._members = {}
+
+    def _entry(self, cache: dict, path: Path, build) -> tuple:
+        # (stamp, built value)
+        stat = path.stat()
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        entry = cache.get(path)
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, build(path))
+            cache[path] = entry
+        return entry
+
+    def _cached(self, cache: dict, path: Path, build):
+        return self._entry(cache, path, build)[1]
+
+    def series(self) -> dict:
+        # name -> series folder; the first root wins for duplicate names
+        found = {}
+        for root in self.roots:
+            if root.is_dir():
+                for name, folder in self._cached(self._series, root, self._scan_root).items():
+                    found.setdefault(name, folder)
+        return found
+
+    @staticmethod
+    def _scan_root(root: Path) -> dict:
+        return {entry.name: Path(entry.path) for entry in os.scandir(root)
+                if entry.is_dir() and not entry.name.startswith('.') and not CHAPTER_FOLDER.match(entry.name)}
+
+    def chapters(self, series: str) -> dict:
+        # chapter number -> {"folder": Path, "cbz": Path, "pdf": Path}
+        folder = self.series().get(series)
+        if folder is None:
+            return None
+        return self._cached(self._chapters, folder, self._scan_series)
+
+    @staticmethod
+    def _scan_series(folder: Path) -> dict:
+        chapters = {}
+        for entry in os.scandir(folder):
+            match = CHAPTER_FOLDER.match(entry.name) if entry.is_dir() else CHAPTER_FILE.match(entry.name)
+            if match:
+                kind = "folder" if entry.is_dir() else match.group(2).lower()
+                chapters.setdefault(format_chapter_number(match.group(1)), {})[kind] = Path(entry.path)
+        return dict(sorted(chapters.items(), key=lambda item: float(item[0])))
+
+    def pages(self, folder: Path) -> list:
+        return self._cached(self._pages, folder, list_pages)
+
+    def members(self, archive: Path) -> list:
+        return self._cached(self._members, archive, read_member_index)
+
+    def stamped_members(self, archive: Path) -> tuple:
+        # (inode, mtime, size) of the archive the index was read from, and the index
+        return self._entry(self._members, archive, read_member_index)
+
+
+class MemberResponse(web.StreamResponse):
+    # Sends one byte range of a file with loop.sendfile (zero-copy where the
+    # platform supports it), like web.FileResponse does for whole files
+    def __init__(self, path: Path, offset: int, count: int, status: int = 200, headers: dict = None):
+        super().__init__(status=status, headers=headers)
+        self.path = path
+        self.offset = offset
+        self.count = count
+
+    async def prepare(self, request):
+        if self.prepared:
+            return await super().prepare(request)
+        self.content_length = self.count
+        writer = await super().prepare(request)
+        if request.method == "HEAD" or not self.count:
+            return writer
+        loop = asyncio.get_running_loop()
+        file = await loop.run_in_executor(None, open, self.path, 'rb')
+        try:
+            transport = request.transport
+            if transport is None:
+                raise ConnectionResetError("Connection lost")
+            try:
+                await loop.sendfile(transport, file, self.offset, self.count)
+            except NotImplementedError:
+                # e.g. TLS transports: copy through the stream writer instead
+                file.seek(self.offset)
+                remaining = self.count
+                while remaining:
+                    chunk = await loop.run_in_executor(None, file.read, min(FALLBACK_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    await writer.write(chunk)
+                    remaining -= len(chunk)
+        finally:
+            file.close()
+        await super().write_eof()
+        return writer
+
+
+def range_response(request: web.Request, path: Path, offset: int, size: int, etag: str, content_type: str) -> web.StreamResponse:
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Content-Type": content_type,
+               "Cache-Control": "public, max-age=86400"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers={"ETag": etag})
+    try:
+        requested = request.http_range
+    except ValueError:
+        requested = slice(None, None)
+    if (requested.start is None and requested.stop is None) or request.headers.get("If-Range", etag) != etag:
+        return MemberResponse(path, offset, size, headers=headers)
+    start, stop = requested.start or 0, requested.stop
+    if start < 0:  # suffix range: the last -start bytes
+        start, stop = max(0, size + start), size
+    stop = size if stop is None else min(stop, size)
+    if start >= size or start >= stop:
+        return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+    headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    return MemberResponse(path, offset + start, stop - start, status=206, headers=headers)
+
+
+class LibraryServer:
+    # Read-only HTTP view of the library:
+    #   /                                  series (JSON)
+    #   /{series}/                         chapters with their formats and page counts (JSON)
+    #   /{series}/{chapter}/{page}         one page, from the chapter folder or its CBZ
+    #   /{series}/{chapter}.cbz|.pdf       a whole chapter file
+    #   /{series}/thumbnails.json          thumbnail index (thumbnails.py)
+    #   /{series}/thumbnails[.N].pack      the thumbnail pack the index names
+    def __init__(self, roots: list):
+        self.catalog = Catalog(roots)
+
+    @staticmethod
+    async def _blocking(function, *args):
+        # Catalog lookups stat, scan and parse archives; a cache miss must not
+        # stall every other reader on the loop
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/', self.list_series)
+        app.router.add_get('/{series}/', self.list_chapters)
+        app.router.add_get(r'/{series}/{name:thumbnails\.json|thumbnails(\.\d+)?\.pack}', self.thumbnails)
+        app.router.add_get(r'/{series}/{chapter}.{kind:(cbz|pdf)}', self.chapter_file)
+        app.router.add_get(r'/{series}/{chapter}/{page:\d+}', self.page)
+        return app
+
+    async def _chapter(self, request: web.Request) -> dict:
+        chapters = await self._blocking(self.catalog.chapters, request.match_info['series'])
+        if chapters is None:
+            raise web.HTTPNotFound(text="No such series")
+        try:
+            chapter = chapters.get(format_chapter_number(request.match_info['chapter']))
+        except ValueError:
+            chapter = None
+        if chapter is None:
+            raise web.HTTPNotFound(text="No such chapter")
+        return chapter
+
+    async def list_series(self, request: web.Request) -> web.Response:
+        return web.json_response(sorted(await self._blocking(self.catalog.series)))
+
+    async def list_chapters(self, request: web.Request) -> web.Response:
+        listing = await self._blocking(self._listing, request.match_info['series'])
+        if listing is None:
+            raise web.HTTPNotFound(text="No such series")
+        return web.json_response(listing)
+
+    def _listing(self, series: str) -> list:
+        chapters = self.catalog.chapters(series)
+        if chapters is None:
+            return None
+        listing = []
+        for number, sources in chapters.items():
+            if "folder" in sources:
+                pages = len(self.catalog.pages(sources["folder"]))
+            elif "cbz" in sources:
+                pages = len(self.catalog.members(sources["cbz"]))
+            else:
+                pages = None
+            listing.append({"chapter": number, "formats": sorted(sources), "pages": pages})
+        return listing
+
+    async def chapter_file(self, request: web.Request) -> web.StreamResponse:
+        path = (await self._chapter(request)).get(request.match_info['kind'])
+        if path is None:
+            raise web.HTTPNotFound(text="Chapter not available in this format")
+        # FileResponse already does sendfile, Range and ETag/If-None-Match
+        return web.FileResponse(path)
+
+    async def thumbnails(self, request: web.Request) -> web.StreamResponse:
+        folder = (await self._blocking(self.catalog.series)).get(request.match_info['series'])
+        path = folder / request.match_info['name'] if folder else None
+        if path is None or not await self._blocking(path.is_file):
+            raise web.HTTPNotFound(text="No thumbnails for this series")
+        return web.FileResponse(path)
+
+    async def page(self, request: web.Request) -> web.StreamResponse:
+        chapter = await self._chapter(request)
+        index = int(request.match_info['page']) - 1
+        if "folder" in chapter:
+            pages = await self._blocking(self.catalog.pages, chapter["folder"])
+            if not 0 <= index < len(pages):
+                raise web.HTTPNotFound(text="No such page")
+            return web.FileResponse(pages[index])
+        if "cbz" not in chapter:
+            raise web.HTTPNotFound(text="Pages are only served from chapter folders and CBZ files")
+        archive = chapter["cbz"]
+        try:
+            (inode, mtime, size), members = await self._blocking(self.catalog.stamped_members, archive)
+        except (OSError, zipfile.BadZipFile) as e:
+            logging.error(f"Cannot index {archive}: {e}")
+            raise web.HTTPInternalServerError(text="Damaged archive")
+        if not 0 <= index < len(members):
+            raise web.HTTPNotFound(text="No such page")
+        member = members[index]
+        content_type = mimetypes.guess_type(member.name)[0] or "application/octet-stream"
+        # The archive's identity and version plus the member's place in it
+        etag = f'"{inode:x}-{mtime:x}-{size:x}-{member.offset:x}"'
+        if member.stored:
+            return range_response(request, archive, member.offset, member.size, etag, content_type)
+        # Compressed members (not written by this project) are inflated per request
+        data = await asyncio.get_running_loop().run_in_executor(None, self._read_member, archive, member.name)
+        return web.Response(body=data, content_type=content_type, headers={"ETag": etag})
+
+    @staticmethod
+    def _read_member(archive: Path, name: str) -> bytes:
+        with zipfile.ZipFile(archive) as opened:
+            return opened.read(name)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the library read-only over HTTP")
+    parser.add_argument('roots', nargs='+', type=Path, help="Library folders (e.g. Mangas MANGA)")
+    parser.add_argument('--host', default="0.0.0.0", help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    server = LibraryServer(args.roots)
+    web.run_app(server.application(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+from budget import format_size
+
+# Per-page events are summed up and reported at most this often
+SUMMARY_INTERVAL = 5.0
+PAGE_LOGGER = "pages"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats every record on the calling thread;
+    # here records are queued as they are and the listener thread does the
+    # formatting and the writing, so neither runs on the event loop
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(log_format: str = '%(message)s', verbose: bool = False) -> logging.handlers.QueueListener:
+    # Replaces logging.basicConfig: the root logger only enqueues, and one
+    # background thread writes to stderr. Pending lines are flushed at exit.
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(log_format))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    # --verbose only opens up per-page events, not the DEBUG output of libraries
+    logging.getLogger(PAGE_LOGGER).setLevel(logging.DEBUG if verbose else logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class PageLog:
+    # Per-page "Downloaded" events. Each page is logged at DEBUG (shown with
+    # --verbose); otherwise pages are only counted and a summary line is
+    # logged every SUMMARY_INTERVAL seconds. Safe to call from worker threads.
+    def __init__(self, logger: logging.Logger = None, interval: float = SUMMARY_INTERVAL):
+        self.logger = logger or logging.getLogger(PAGE_LOGGER)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._since = time.monotonic()
+        self.pages = self.bytes = 0
+        self.total_pages = self.total_bytes = 0
+
+    def downloaded(self, url: str, size: int):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Downloaded: %s", url)
+        with self._lock:
+            self.pages += 1
+            self.bytes += size
+            if time.monotonic() - self._since < self.interval:
+                return
+            pages, size, elapsed = self._take()
+        self.logger.info("Downloaded %d page(s) (%s) in the last %.0fs", pages, format_size(size), elapsed)
+
+    def _take(self) -> tuple:
+        now = time.monotonic()
+        taken = self.pages, self.bytes, now - self._since
+        self.total_pages += self.pages
+        self.total_bytes += self.bytes
+        self.pages = self.bytes = 0
+        self._since = now
+        return taken
+
+    def flush(self):
+        with self._lock:
+            self._take()
+            pages, size = self.total_pages, self.total_bytes
+        if pages:
+            self.logger.info("Downloaded %d page(s) (%s) in total", pages, format_size(size))
@@ -0,0 +1,163 @@
+import re
+import asyncio
+from collections import deque
+from typing import NamedTuple
+
+from httpclient import HttpClient
+from integrity import fetch_page_retrying
+from planner import MAX_PAGES
+from ratelimit import RateLimiter
+
+CHAPTER_URL = "https://manga4life.com/read-online/{}-chapter-{}.html"
+CHAPTER_INDEX_URL = "https://manga4life.com/read-online/{}-chapter-{}-index-2.html"
+IMAGE_URL = "https://{}/manga/{}/{}-{:03d}.png"
+CUR_PATH_PATTERN = re.compile(r'vm\.CurPathName\s*=\s*"([^"]+)"')
+# Pages fetched ahead of the one the caller is consuming
+LOOKAHEAD = 8
+# Chapters whose image host is looked up ahead of the one being streamed
+RESOLVE_AHEAD = 2
+
+
+class ChapterNotFound(LookupError):
+    def __init__(self, series: str, chapter: str):
+        super().__init__(f"{series} chapter {chapter} not found")
+        self.series = series
+        self.chapter = chapter
+
+
+class PageUnavailable(IOError):
+    # A page that answered something other than 200 or 404 after the retries
+    def __init__(self, url: str, status: int):
+        super().__init__(f"{url}: HTTP {status}")
+        self.url = url
+        self.status = status
+
+
+class Page(NamedTuple):
+    index: int
+    data: bytes
+    content_type: str
+    host: str
+
+
+def format_series(series: str) -> str:
+    # The name as used in manga4life URLs; no case changes are applied
+    return re.sub(r'\s+', '-', series.strip())
+
+
+def format_chapter(chapter: str) -> str:
+    integer_part, _, decimal_part = str(chapter).partition('.')
+    formatted_chapter = f"{int(integer_part):04d}"
+    return f"{formatted_chapter}.{decimal_part}" if decimal_part else formatted_chapter
+
+
+class MangaClient:
+    # Library entry point: pages come back as Page tuples, in order, and
+    # nothing is written to disk or stdout and nothing is asked for.
+    #
+    #     async with MangaClient() as client:
+    #         async for page in client.stream_chapter("One-Piece", "1100"):
+    #             store(page.index, page.data, page.content_type)
+    #
+    # At most `lookahead` pages are fetched ahead of the consumer. A missing
+    # chapter raises ChapterNotFound; a page that stays damaged after retries
+    # raises integrity.DamagedPage, one still throttled or failing raises
+    # PageUnavailable; network errors surface as aiohttp errors.
+    def __init__(self, lookahead: int = LOOKAHEAD, client: HttpClient = None, rate_limiter: RateLimiter = None):
+        if lookahead < 1:
+            raise ValueError("Look-ahead must be at least one page")
+        self.lookahead = lookahead
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self._owns_client = client is None
+        self._hosts = {}
+
+    async def __aenter__(self):
+        if self.client is None:
+            self.client = HttpClient(rate_limiter=self.rate_limiter)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._owns_client and self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    async def _chapter_html(self, url: str) -> str:
+        async with self.client.session.get(url) as response:
+            return await response.text() if response.status == 200 else None
+
+    async def resolve(self, series: str, chapter: str) -> str:
+        # Image host of a chapter (vm.CurPathName), or None; remembered for
+        # the lifetime of the client
+        series, chapter = format_series(series), format_chapter(chapter)
+        key = (series, chapter)
+        if key not in self._hosts:
+            host = None
+            html_content = await self._chapter_html(CHAPTER_URL.format(series, chapter))
+            if html_content is not None:
+                match = CUR_PATH_PATTERN.search(html_content)
+                if not match:
+                    html_content = await self._chapter_html(CHAPTER_INDEX_URL.format(series, chapter))
+                    match = CUR_PATH_PATTERN.search(html_content or "")
+                host = match.group(1) if match else None
+            if host:
+                self.client.prewarm(host)
+            self._hosts[key] = host
+        return self._hosts[key]
+
+    async def stream_chapter(self, series: str, chapter: str, host: str = None):
+        series, chapter = format_series(series), format_chapter(chapter)
+        host = host or await self.resolve(series, chapter)
+        if not host:
+            raise ChapterNotFound(series, chapter)
+        session = self.client.session
+
+        # Pages are numbered without gaps; the first 404 ends the chapter
+        pending = deque()
+        next_index = 1
+        try:
+            while True:
+                while len(pending) < self.lookahead and next_index <= MAX_PAGES:
+                    url = IMAGE_URL.format(host, series, chapter, next_index)
+                    pending.append((next_index, asyncio.ensure_future(fetch_page_retrying(session, url))))
+                    next_index += 1
+                if not pending:
+                    break
+                index, task = pending.popleft()
+                status, data, headers = await task
+                if status == 404:
+                    break
+                if status != 200:
+                    raise PageUnavailable(IMAGE_URL.format(host, series, chapter, index), status)
+                content_type = headers.get('Content-Type', 'application/octet-stream').split(';')[0].strip()
+                yield Page(index, data, content_type, host)
+        finally:
+            for _, task in pending:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+
+    async def stream_chapters(self, series: str, chapters: list, skip_missing: bool = False):
+        # Yields (chapter, Page) for several chapters in the given order. The
+        # next chapters are resolved while the current one streams; missing
+        # chapters raise ChapterNotFound when their turn comes, unless skipped.
+        chapters = [format_chapter(chapter) for chapter in chapters]
+        lookups = {}
+        try:
+            for chapter_index, chapter in enumerate(chapters):
+                for upcoming in chapters[chapter_index:chapter_index + RESOLVE_AHEAD + 1]:
+                    if upcoming not in lookups:
+                        lookups[upcoming] = asyncio.ensure_future(self.resolve(series, upcoming))
+                host = await lookups.pop(chapter)
+                if not host:
+                    if skip_missing:
+                        continue
+                    raise ChapterNotFound(format_series(series), chapter)
+                async for page in self.stream_chapter(series, chapter, host):
+                    yield chapter, page
+        finally:
+            for lookup in lookups.values():
+                lookup.cancel()
+            await asyncio.gather(*lookups.values(), return_exceptions=True)
@@ -0,0 +1,35 @@
+import json
+from pathlib import Path
+
+# Written into every chapter folder by D4C; maps page file name to the HTTP
+# validators it was downloaded with
+METADATA_FILE = ".pages.json"
+
+
+def load_metadata(chapter_folder: Path) -> dict:
+    try:
+        return json.loads((chapter_folder / METADATA_FILE).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_metadata(chapter_folder: Path, metadata: dict):
+    if not metadata or not chapter_folder.is_dir():
+        return
+    path = chapter_folder / METADATA_FILE
+    partial_path = path.with_name(path.name + ".part")
+    partial_path.write_text(json.dumps(metadata, indent=1, sort_keys=True), encoding='utf-8')
+    partial_path.replace(path)
+
+
+def page_validators(headers, length: int) -> dict:
+    return {"etag": headers.get('ETag'), "last_modified": headers.get('Last-Modified'), "length": length}
+
+
+def conditional_headers(validators: dict) -> dict:
+    headers = {}
+    if validators and validators.get("etag"):
+        headers['If-None-Match'] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers['If-Modified-Since'] = validators["last_modified"]
+    return headers
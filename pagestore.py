@@ -0,0 +1,175 @@
+import os
+import sys
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from budget import format_size
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.webp', '.gif'}
+
+
+@contextmanager
+def replacing(path: Path):
+    # Opens a .part file that replaces path once the block succeeds. Pages are
+    # never rewritten in place: after a PageStore ingest they are hardlinks,
+    # and truncating one would change every chapter sharing the blob.
+    path = Path(path)
+    partial_path = path.with_name(path.name + ".part")
+    try:
+        with open(partial_path, 'wb') as file:
+            yield file
+        os.replace(partial_path, path)
+    finally:
+        partial_path.unlink(missing_ok=True)
+
+
+class PageStore:
+    # Content-addressed blob store. Every distinct page is kept once under
+    # objects/<2 hex>/<digest>, and chapter folders hold hardlinks to it, so
+    # credit pages and repeated covers cost their bytes only once. The catalog
+    # maps every linked path to its blob so the deduplication ratio is known.
+    # Pages must be replaced (write + rename), never edited in place, since
+    # an in-place edit would change every chapter sharing the blob.
+    def __init__(self, root: Path):
+        self.root = root
+        self.objects = root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(root / "catalog.db"), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS refs (path TEXT PRIMARY KEY, digest TEXT NOT NULL REFERENCES blobs(digest));
+            CREATE INDEX IF NOT EXISTS refs_digest ON refs(digest);
+        """)
+
+    def blob_path(self, digest: str) -> Path:
+        return self.objects / digest[:2] / digest
+
+    def put(self, data: bytes) -> tuple:
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self.blob_path(digest)
+        with self._lock:
+            if self.db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() and blob.exists():
+                return digest, False
+        blob.parent.mkdir(exist_ok=True)
+        partial_blob = blob.with_name(f"{digest}.{threading.get_ident()}.part")
+        partial_blob.write_bytes(data)
+        os.replace(partial_blob, blob)
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO blobs (digest, size) VALUES (?, ?)", (digest, len(data)))
+        return digest, True
+
+    def link(self, digest: str, path: Path):
+        blob = self.blob_path(digest)
+        partial_path = path.with_name(path.name + ".part")
+        partial_path.unlink(missing_ok=True)
+        try:
+            os.link(blob, partial_path)
+        except OSError:
+            # Hardlinks need the same filesystem; fall back to a private copy
+            shutil.copyfile(blob, partial_path)
+        os.replace(partial_path, path)
+        self._add_ref(digest, path)
+
+    def _add_ref(self, digest: str, path: Path):
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO refs (path, digest) VALUES (?, ?)", (str(path.resolve()), digest))
+
+    def store_page(self, data: bytes, path: Path) -> bool:
+        digest, is_new = self.put(data)
+        self.link(digest, path)
+        return is_new
+
+    def store_file(self, path: Path) -> bool:
+        # Adopts an existing page file; a new blob is linked from the file itself
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        blob = self.blob_path(digest)
+        with self._lock:
+            known = self.db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() and blob.exists()
+        if not known:
+            blob.parent.mkdir(exist_ok=True)
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copyfile(path, blob)
+            with self._lock, self.db:
+                self.db.execute("INSERT OR REPLACE INTO blobs (digest, size) VALUES (?, ?)", (digest, blob.stat().st_size))
+        if os.path.samefile(blob, path):
+            self._add_ref(digest, path)
+        else:
+            self.link(digest, path)
+        return not known
+
+    def stats(self) -> dict:
+        with self._lock:
+            logical, pages = self.db.execute(
+                "SELECT COALESCE(SUM(blobs.size), 0), COUNT(*) FROM refs JOIN blobs USING (digest)").fetchone()
+            stored, unique = self.db.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM blobs").fetchone()
+        return {
+            "pages": pages,
+            "unique_pages": unique,
+            "logical_bytes": logical,
+            "stored_bytes": stored,
+            "dedup_ratio": logical / stored if stored else 1.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def ingest_library(store: PageStore, root: Path) -> int:
+    # Replaces duplicate page files in an existing library with links into the store
+    ingested = 0
+    for folder, _, files in os.walk(root):
+        folder = Path(folder)
+        if folder == store.root or store.root in folder.parents:
+            continue
+        for name in sorted(files):
+            path = folder / name
+            if path.suffix.lower() not in IMAGE_SUFFIXES:
+                continue
+            store.store_file(path)
+            ingested += 1
+    return ingested
+
+
+def log_stats(store: PageStore):
+    stats = store.stats()
+    logging.info(f"{stats['pages']} page(s), {stats['unique_pages']} unique; "
+                 f"{format_size(stats['logical_bytes'])} referenced, {format_size(stats['stored_bytes'])} stored "
+                 f"(deduplication ratio {stats['dedup_ratio']:.2f}x)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Content-addressed page store")
+    parser.add_argument('store', type=Path, help="Page store folder")
+    parser.add_argument('-i', '--ingest', type=Path, nargs='*', default=[], help="Library folders whose pages should be deduplicated into the store")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    store = PageStore(args.store)
+    try:
+        for root in args.ingest:
+            if not root.is_dir():
+                logging.error(f"{root} is not a folder.")
+                sys.exit(1)
+            logging.info(f"Ingested {ingest_library(store, root)} page(s) from {root}")
+        log_stats(store)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import re
+from collections import namedtuple
+
+Ref = namedtuple("Ref", "num gen")
+
+TOKEN_END = re.compile(rb'[\x00\t\n\x0c\r ()<>\[\]{}/%]')
+SKIP_SPACE = re.compile(rb'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+REFERENCE = re.compile(rb'(\d+)\s+(\d+)\s+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+OBJECT_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+XREF_ENTRY = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+STARTXREF = re.compile(rb'startxref\s+(\d+)')
+STRING_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f'}
+
+
+class PdfError(ValueError):
+    pass
+
+
+class PdfName(str):
+    pass
+
+
+class PdfString(bytes):
+    pass
+
+
+class PdfRaw(str):
+    # Numbers, booleans and null are kept as their original tokens
+    pass
+
+
+class Stream(dict):
+    def __init__(self, dictionary: dict, data: bytes):
+        super().__init__(dictionary)
+        self.data = data
+
+
+def decode_text(value: bytes) -> str:
+    if value.startswith(b'\xfe\xff'):
+        return value[2:].decode('utf-16-be', errors='replace')
+    return value.decode('latin-1')
+
+
+def encode_text(text: str) -> PdfString:
+    try:
+        return PdfString(text.encode('latin-1'))
+    except UnicodeEncodeError:
+        return PdfString(b'\xfe\xff' + text.encode('utf-16-be'))
+
+
+def serialize(obj, mapping: dict = None) -> bytes:
+    # mapping renumbers references when objects are copied between files
+    if isinstance(obj, Ref):
+        num = mapping[obj.num] if mapping is not None else obj.num
+        return f"{num} 0 R".encode()
+    if isinstance(obj, dict):
+        parts = [b'<<']
+        for key, value in obj.items():
+            parts.append(key.encode('latin-1'))
+            parts.append(serialize(value, mapping))
+        parts.append(b'>>')
+        return b' '.join(parts)
+    if isinstance(obj, list):
+        return b'[' + b' '.join(serialize(item, mapping) for item in obj) + b']'
+    if isinstance(obj, PdfString):
+        return b'<' + obj.hex().encode() + b'>'
+    if isinstance(obj, bool):
+        return b'true' if obj else b'false'
+    if obj is None:
+        return b'null'
+    if isinstance(obj, (PdfName, PdfRaw)):
+        return obj.encode('latin-1')
+    if isinstance(obj, int):
+        return str(obj).encode()
+    if isinstance(obj, float):
+        return f"{obj:.4f}".rstrip('0').rstrip('.').encode()
+    raise PdfError(f"Cannot serialize {type(obj).__name__}")
+
+
+class PdfReader:
+    # Minimal reader for PDFs with classic cross-reference tables, which is
+    # what PdfWriter, reportlab and our own incremental updates produce.
+    def __init__(self, data):
+        self.data = data
+        self.offsets = {}
+        self.trailer = {}
+        self._cache = {}
+        match = None
+        for match in STARTXREF.finditer(data, max(0, len(data) - 2048)):
+            pass
+        if match is None:
+            raise PdfError("No startxref found")
+        self.startxref = int(match.group(1))
+        self._read_xref_chain(self.startxref)
+
+    def _read_xref_chain(self, offset: int):
+        seen = set()
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            pos = self._skip(offset)
+            if self.data[pos:pos + 4] != b'xref':
+                raise PdfError("Cross-reference streams are not supported; re-render the file with PdfWriter")
+            pos += 4
+            while True:
+                pos = self._skip(pos)
+                if self.data[pos:pos + 7] == b'trailer':
+                    break
+                header = re.compile(rb'(\d+)\s+(\d+)').match(self.data, pos)
+                if header is None:
+                    raise PdfError("Corrupt cross-reference table")
+                start, count = int(header.group(1)), int(header.group(2))
+                pos = header.end()
+                for index in range(count):
+                    pos = self._skip(pos)
+                    entry = XREF_ENTRY.match(self.data, pos)
+                    if entry is None:
+                        raise PdfError("Corrupt cross-reference entry")
+                    pos = entry.end()
+                    # Newer sections are read first and take precedence
+                    if entry.group(3) == b'n':
+                        self.offsets.setdefault(start + index, int(entry.group(1)))
+                    else:
+                        self.offsets.setdefault(start + index, None)
+            trailer, _ = self.parse_object(pos + 7)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            offset = trailer.get('/Prev')
+            offset = int(offset) if offset is not None else None
+
+    def _skip(self, pos: int) -> int:
+        return SKIP_SPACE.match(self.data, pos).end()
+
+    def parse_object(self, pos: int):
+        data = self.data
+        pos = self._skip(pos)
+        char = data[pos:pos + 1]
+        if char == b'/':
+            end = TOKEN_END.search(data, pos + 1)
+            end = end.start() if end else len(data)
+            return PdfName(data[pos:end].decode('latin-1')), end
+        if data[pos:pos + 2] == b'<<':
+            result = {}
+            pos += 2
+            while True:
+                pos = self._skip(pos)
+                if data[pos:pos + 2] == b'>>':
+                    return result, pos + 2
+                key, pos = self.parse_object(pos)
+                value, pos = self.parse_object(pos)
+                result[key] = value
+        if char == b'[':
+            result = []
+            pos += 1
+            while True:
+                pos = self._skip(pos)
+                if data[pos:pos + 1] == b']':
+                    return result, pos + 1
+                item, pos = self.parse_object(pos)
+                result.append(item)
+        if char == b'(':
+            return self._parse_literal_string(pos + 1)
+        if char == b'<':
+            end = data.find(b'>', pos)
+            digits = re.sub(rb'\s', b'', data[pos + 1:end])
+            if len(digits) % 2:
+                digits += b'0'
+            return PdfString(bytes.fromhex(digits.decode())), end + 1
+        reference = REFERENCE.match(data, pos)
+        if reference:
+            return Ref(int(reference.group(1)), int(reference.group(2))), reference.end()
+        end = TOKEN_END.search(data, pos)
+        end = end.start() if end else len(data)
+        token = data[pos:end].decode('latin-1')
+        if not token:
+            raise PdfError(f"Unexpected byte at offset {pos}")
+        if re.fullmatch(r'[+-]?\d+', token):
+            return int(token), end
+        if token == 'true' or token == 'false':
+            return token == 'true', end
+        if token == 'null':
+            return None, end
+        return PdfRaw(token), end
+
+    def _parse_literal_string(self, pos: int):
+        data = self.data
+        output = bytearray()
+        depth = 1
+        while True:
+            byte = data[pos]
+            pos += 1
+            if byte == 0x5C:  # backslash
+                escaped = data[pos]
+                pos += 1
+                if escaped in STRING_ESCAPES:
+                    output += STRING_ESCAPES[escaped]
+                elif 0x30 <= escaped <= 0x37:
+                    digits = bytes([escaped])
+                    while len(digits) < 3 and 0x30 <= data[pos] <= 0x37:
+                        digits += bytes([data[pos]])
+                        pos += 1
+                    output.append(int(digits, 8) & 0xFF)
+                elif escaped == 0x0D:
+                    if data[pos] == 0x0A:
+                        pos += 1
+                elif escaped != 0x0A:
+                    output.append(escaped)
+                continue
+            if byte == 0x28:
+                depth += 1
+            elif byte == 0x29:
+                depth -= 1
+                if depth == 0:
+                    return PdfString(bytes(output)), pos
+            output.append(byte)
+
+    def get_object(self, num: int):
+        if num in self._cache:
+            return self._cache[num]
+        offset = self.offsets.get(num)
+        if offset is None:
+            return None
+        header = OBJECT_HEADER.match(self.data, offset)
+        if header is None or int(header.group(1)) != num:
+            raise PdfError(f"Object {num} not found at offset {offset}")
+        obj, pos = self.parse_object(header.end())
+        pos = self._skip(pos)
+        if isinstance(obj, dict) and self.data[pos:pos + 6] == b'stream':
+            pos += 6
+            if self.data[pos:pos + 2] == b'\r\n':
+                pos += 2
+            elif self.data[pos:pos + 1] in (b'\n', b'\r'):
+                pos += 1
+            length = self.resolve(obj.get('/Length'))
+            obj = Stream(obj, bytes(self.data[pos:pos + int(length)]))
+        self._cache[num] = obj
+        return obj
+
+    def resolve(self, obj):
+        while isinstance(obj, Ref):
+            obj = self.get_object(obj.num)
+        return obj
+
+    @property
+    def root(self) -> dict:
+        return self.resolve(self.trailer['/Root'])
+
+    def pages(self):
+        # Yields (page ref, inherited attributes) in document order
+        inheritable = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+        stack = [(self.root['/Pages'], {})]
+        while stack:
+            node_ref, inherited = stack.pop()
+            node = self.resolve(node_ref)
+            if node.get('/Type') == '/Pages' or '/Kids' in node:
+                attributes = dict(inherited)
+                attributes.update({key: node[key] for key in inheritable if key in node})
+                for kid in reversed(self.resolve(node['/Kids'])):
+                    stack.append((kid, attributes))
+            else:
+                yield node_ref, inherited
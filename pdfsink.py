@@ -0,0 +1,205 @@
+import struct
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for images PDF cannot embed as-is
+    Image = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# SOF markers that carry frame dimensions (excludes DHT/JPG/DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# PDF viewers reject pages larger than 200 inches on either side
+MAX_PAGE_POINTS = 14400
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+class EmbeddedImage:
+    def __init__(self, width: int, height: int, stream: bytes, dictionary: str):
+        self.width = width
+        self.height = height
+        self.stream = stream
+        self.dictionary = dictionary
+
+
+def parse_png(data: bytes) -> EmbeddedImage:
+    if not data.startswith(PNG_SIGNATURE):
+        raise UnsupportedImage("Not a PNG file")
+    pos = len(PNG_SIGNATURE)
+    header = None
+    palette = None
+    idat = []
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        if pos + 12 + length > len(data):
+            raise UnsupportedImage("Truncated PNG chunk")
+        body = data[pos + 8:pos + 8 + length]
+        if chunk_type == b'IHDR' and length == 13:
+            header = struct.unpack('>IIBBBBB', body)
+        elif chunk_type == b'PLTE':
+            palette = body
+        elif chunk_type == b'IDAT':
+            idat.append(body)
+        elif chunk_type == b'IEND':
+            break
+        pos += 12 + length
+    if header is None or not idat:
+        raise UnsupportedImage("PNG is missing IHDR or IDAT")
+
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if interlace:
+        raise UnsupportedImage("Interlaced PNGs must be decoded")
+    if bit_depth == 16:
+        # 16 bits per component needs PDF 1.5; the writer emits 1.4
+        raise UnsupportedImage("16-bit PNGs must be decoded")
+    if color_type == 0:
+        color_space, colors = "/DeviceGray", 1
+    elif color_type == 2:
+        color_space, colors = "/DeviceRGB", 3
+    elif color_type == 3 and palette:
+        color_space, colors = f"[/Indexed /DeviceRGB {len(palette) // 3 - 1} <{palette.hex()}>]", 1
+    else:
+        raise UnsupportedImage("PNGs with an alpha channel must be decoded")
+
+    # The zlib stream with PNG row filters is exactly what FlateDecode with
+    # the PNG predictors expects, so the IDAT bytes are copied through.
+    dictionary = (
+        f"/Filter /FlateDecode /ColorSpace {color_space} /BitsPerComponent {bit_depth} "
+        f"/DecodeParms << /Predictor 15 /Colors {colors} /BitsPerComponent {bit_depth} /Columns {width} >>"
+    )
+    return EmbeddedImage(width, height, b''.join(idat), dictionary)
+
+
+def parse_jpeg(data: bytes) -> EmbeddedImage:
+    if not data.startswith(b'\xff\xd8'):
+        raise UnsupportedImage("Not a JPEG file")
+    pos = 2
+    adobe = False
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise UnsupportedImage("Corrupt JPEG marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker == 0xEE and data[pos + 4:pos + 9] == b'Adobe':
+            adobe = True
+        if marker in JPEG_SOF_MARKERS:
+            bits, height, width, components = struct.unpack('>BHHB', data[pos + 4:pos + 10])
+            color_space = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}.get(components)
+            if color_space is None or height == 0:
+                raise UnsupportedImage("Unsupported JPEG layout")
+            dictionary = f"/Filter /DCTDecode /ColorSpace {color_space} /BitsPerComponent {bits}"
+            if components == 4 and adobe:
+                # Adobe CMYK JPEGs are stored inverted
+                dictionary += " /Decode [1 0 1 0 1 0 1 0]"
+            return EmbeddedImage(width, height, data, dictionary)
+        pos += 2 + length
+    raise UnsupportedImage("JPEG has no frame header")
+
+
+def decode_to_png(data: bytes) -> bytes:
+    if Image is None:
+        raise UnsupportedImage("Pillow is required to embed this image")
+    with Image.open(BytesIO(data)) as image:
+        if image.mode.startswith("I"):
+            # 16-bit grayscale; a plain convert would clip it to white
+            image = image.convert("I").point(lambda value: value / 256).convert("L")
+        elif image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, format="PNG", compress_level=1)
+        return output.getvalue()
+
+
+def embed_image(data: bytes) -> EmbeddedImage:
+    try:
+        if data.startswith(PNG_SIGNATURE):
+            return parse_png(data)
+        if data.startswith(b'\xff\xd8'):
+            return parse_jpeg(data)
+    except UnsupportedImage:
+        pass
+    # Alpha, interlaced, 16-bit, damaged and non-PNG/JPEG pages are the only ones decoded
+    return parse_png(decode_to_png(data))
+
+
+class PdfWriter:
+    # Streams a PDF with one image per page. Objects are written as soon as a
+    # page is added, so only the page currently being embedded is in memory.
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3  # 1 is the catalog, 2 the page tree written on close
+        self.pos = 0
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data: bytes):
+        self.file.write(data)
+        self.pos += len(data)
+
+    def _allocate(self) -> int:
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def _write_object(self, object_id: int, body: bytes, stream: bytes = None):
+        self.offsets[object_id] = self.pos
+        self._write(f"{object_id} 0 obj\n".encode())
+        if stream is None:
+            self._write(body + b'\nendobj\n')
+        else:
+            self._write(body[:-2] + f" /Length {len(stream)} >>\nstream\n".encode())
+            self._write(stream)
+            self._write(b'\nendstream\nendobj\n')
+
+    def add_image(self, data: bytes):
+        image = embed_image(data)
+        # One image pixel is one point; only oversized webtoon strips are scaled
+        scale = min(1.0, MAX_PAGE_POINTS / max(image.width, image.height))
+        page_width = round(image.width * scale, 2)
+        page_height = round(image.height * scale, 2)
+
+        image_id, content_id, page_id = self._allocate(), self._allocate(), self._allocate()
+        self._write_object(image_id, (
+            f"<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} {image.dictionary} >>"
+        ).encode(), image.stream)
+        content = f"q {page_width} 0 0 {page_height} 0 0 cm /Im0 Do Q".encode()
+        self._write_object(content_id, b'<< >>', content)
+        self._write_object(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode())
+        self.page_ids.append(page_id)
+
+    def close(self):
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        kids = ' '.join(f"{page_id} 0 R" for page_id in self.page_ids)
+        self._write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode())
+
+        xref_offset = self.pos
+        lines = [f"xref\n0 {self.next_id}\n", "0000000000 65535 f \n"]
+        for object_id in range(1, self.next_id):
+            lines.append(f"{self.offsets[object_id]:010d} 00000 n \n")
+        self._write(''.join(lines).encode())
+        self._write(f"trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
@@ -0,0 +1,219 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from pathlib import Path
+
+import aiohttp
+
+from budget import format_size
+from httpclient import HttpClient
+
+RESOLVER_CACHE_FILE = Path("resolver_cache.json")
+HOST_STATS_FILE = Path("host_stats.json")
+# Image hosts rotate now and then, so resolved chapters are re-checked weekly
+RESOLVER_TTL = 7 * 24 * 3600
+# Weight of the newest sample in the per-host throughput average
+THROUGHPUT_SMOOTHING = 0.3
+MAX_PAGES = 1000
+SAMPLE_PAGES = 3
+
+
+class JsonStore:
+    # Small JSON file in the working directory, next to download_history.txt
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self.entries = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.entries = {}
+        self.dirty = False
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            partial_path = self.path.with_name(self.path.name + ".part")
+            partial_path.write_text(json.dumps(self.entries, indent=1, sort_keys=True), encoding='utf-8')
+            partial_path.replace(self.path)
+            self.dirty = False
+
+
+class ResolverCache(JsonStore):
+    # Remembers the image host (vm.CurPathName) of each chapter page
+    def __init__(self, path: Path = RESOLVER_CACHE_FILE, ttl: float = RESOLVER_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+
+    def get(self, series: str, chapter: str) -> str:
+        entry = self.entries.get(f"{series}/{chapter}")
+        if entry is None or time.time() - entry["resolved"] > self.ttl:
+            return None
+        return entry["host"]
+
+    def put(self, series: str, chapter: str, host: str):
+        with self._lock:
+            self.entries[f"{series}/{chapter}"] = {"host": host, "resolved": int(time.time())}
+            self.dirty = True
+
+    def forget(self, series: str, chapter: str):
+        with self._lock:
+            if self.entries.pop(f"{series}/{chapter}", None) is not None:
+                self.dirty = True
+
+
+class HostStats(JsonStore):
+    # Smoothed download throughput per image host
+    def __init__(self, path: Path = HOST_STATS_FILE):
+        super().__init__(path)
+
+    def record(self, host: str, nbytes: int, seconds: float):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        rate = nbytes / seconds
+        with self._lock:
+            entry = self.entries.setdefault(host, {"bytes_per_second": rate})
+            entry["bytes_per_second"] += THROUGHPUT_SMOOTHING * (rate - entry["bytes_per_second"])
+            entry["updated"] = int(time.time())
+            self.dirty = True
+
+    def throughput(self, host: str) -> float:
+        entry = self.entries.get(host)
+        return entry["bytes_per_second"] if entry else None
+
+
+async def resolve_host(downloader, session: aiohttp.ClientSession, chapter: str, resolver_cache: ResolverCache) -> tuple:
+    # Returns (host, whether a request was made)
+    host = resolver_cache.get(downloader.formatted_manga_name, chapter)
+    if host:
+        return host, False
+    host = await downloader.extract_text_from_url(session, chapter)
+    if host:
+        resolver_cache.put(downloader.formatted_manga_name, chapter, host)
+    return host, True
+
+
+async def probe(session: aiohttp.ClientSession, url: str) -> tuple:
+    # HEAD request; returns (exists, Content-Length or None, seconds)
+    started = time.monotonic()
+    try:
+        async with session.head(url, allow_redirects=True) as response:
+            exists = response.status == 200
+            length = response.content_length if exists else None
+    except aiohttp.ClientError:
+        exists, length = False, None
+    return exists, length, time.monotonic() - started
+
+
+async def plan_chapter(downloader, session: aiohttp.ClientSession, chapter: str, resolver_cache: ResolverCache) -> dict:
+    chapter = downloader.format_chapter_number(chapter)
+    host, resolved = await resolve_host(downloader, session, chapter, resolver_cache)
+    plan = {"chapter": chapter, "host": host, "pages": 0, "bytes": 0, "requests": 0,
+            "probe_requests": int(resolved), "probe_seconds": 0.0}
+    if not host:
+        plan["status"] = "missing"
+        return plan
+    lengths = {}
+
+    async def exists(page: int) -> bool:
+        found, length, seconds = await probe(session, await downloader.generate_image_url(chapter, page, host))
+        plan["probe_requests"] += 1
+        plan["probe_seconds"] += seconds
+        if found and length is not None:
+            lengths[page] = length
+        return found
+
+    # Pages are numbered without gaps: double until a page is missing, then
+    # bisect, so a 40-page chapter costs ~12 HEAD requests instead of 100 GETs
+    low, high = 0, 1
+    while high <= MAX_PAGES and await exists(high):
+        low, high = high, high * 2
+    high = min(high, MAX_PAGES + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if await exists(middle):
+            low = middle
+        else:
+            high = middle
+    pages = low
+    # Spread a few more Content-Length samples across the chapter
+    for page in {1, (pages + 1) // 2, pages} - set(lengths) - {0}:
+        if len(lengths) >= SAMPLE_PAGES:
+            break
+        await exists(page)
+    plan["status"] = "found" if pages else "empty"
+    plan["pages"] = pages
+    plan["bytes"] = round(sum(lengths.values()) / len(lengths) * pages) if lengths else 0
+    # One request per page, the 404 that ends the chapter, and the chapter
+    # page itself unless its host is cached
+    plan["requests"] = pages + 1 + int(resolved)
+    return plan
+
+
+async def plan_download(downloader, chapters: list, concurrency: int = 10, resolver_cache: ResolverCache = None,
+                        host_stats: HostStats = None, client: HttpClient = None) -> dict:
+    # Pass the downloader's client to keep the probe connections for the download
+    if client is None:
+        async with HttpClient(limit=concurrency) as client:
+            return await plan_download(downloader, chapters, concurrency, resolver_cache, host_stats, client)
+    resolver_cache = resolver_cache or ResolverCache()
+    host_stats = host_stats or HostStats()
+    chapter_plans = await asyncio.gather(*(plan_chapter(downloader, client.session, chapter, resolver_cache) for chapter in chapters))
+    resolver_cache.save()
+
+    found = [plan for plan in chapter_plans if plan["status"] == "found"]
+    total_bytes = sum(plan["bytes"] for plan in chapter_plans)
+    total_requests = sum(plan["requests"] for plan in chapter_plans)
+    seconds = 0.0
+    for host in {plan["host"] for plan in found}:
+        host_plans = [plan for plan in found if plan["host"] == host]
+        host_bytes = sum(plan["bytes"] for plan in host_plans)
+        throughput = host_stats.throughput(host)
+        if throughput:
+            seconds += host_bytes / throughput
+        else:
+            # No history for this host: scale the probe latency by the concurrency
+            probes = sum(plan["probe_requests"] for plan in host_plans)
+            latency = sum(plan["probe_seconds"] for plan in host_plans) / probes if probes else 0
+            seconds += sum(plan["requests"] for plan in host_plans) * latency / concurrency
+    return {
+        "series": downloader.formatted_manga_name,
+        "chapters": chapter_plans,
+        "found": len(found),
+        "missing": [plan["chapter"] for plan in chapter_plans if plan["status"] != "found"],
+        "pages": sum(plan["pages"] for plan in chapter_plans),
+        "bytes": total_bytes,
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 1),
+        "probe_requests": sum(plan["probe_requests"] for plan in chapter_plans),
+    }
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def format_plan(plan: dict) -> str:
+    lines = [f"{'Chapter':<10} {'Status':<8} {'Pages':>6} {'Size':>10} {'Requests':>9}"]
+    for chapter in plan["chapters"]:
+        lines.append(f"{chapter['chapter']:<10} {chapter['status']:<8} {chapter['pages']:>6} "
+                     f"{format_size(chapter['bytes']):>10} {chapter['requests']:>9}")
+    lines.append(f"{plan['found']} of {len(plan['chapters'])} chapter(s) found, {plan['pages']} pages, "
+                 f"~{format_size(plan['bytes'])}, {plan['requests']} requests, "
+                 f"~{format_duration(plan['seconds'])} at concurrency {plan['concurrency']} "
+                 f"(planned with {plan['probe_requests']} small requests)")
+    if plan["missing"]:
+        lines.append(f"Missing or empty: {', '.join(plan['missing'])}")
+    return "\n".join(lines)
+
+
+def print_plan(plan: dict, as_json: bool = False):
+    if as_json:
+        print(json.dumps(plan, indent=2))
+    else:
+        logging.info(format_plan(plan))
@@ -1,51 +1,141 @@
-import requests
+import asyncio
 import argparse
+import logging
 from pathlib import Path
 
-def search_and_download_manga_poster(manga_name):
+import aiohttp
+
+from httpclient import HttpClient
+from integrity import DamagedPage, fetch_page
+from planner import JsonStore
+
+POSTER_URL = "https://temp.compsci88.com/cover/{}.jpg"
+POSTER_HISTORY_FILE = Path("manga_history.txt")
+POSTER_STATE_FILE = Path("poster_state.json")
+# Covers all come from one host, so the whole batch shares its connections
+POSTER_CONCURRENCY = 16
+LIBRARY_COVER = "cover.jpg"
+
+
+def format_manga_name(manga_name: str) -> str:
     # Remove quotes if they surround the manga name
     if manga_name.startswith('"') and manga_name.endswith('"'):
-        formatted_manga_name = manga_name.strip('"')
-    else:
-        # Format the manga name to have the first letter of each word in uppercase and replace spaces with "-"
-        formatted_manga_name = manga_name.title().replace(" ", "-")
-    
-    # Construct the poster URL using the formatted manga name
-    poster_url = f"https://temp.compsci88.com/cover/{formatted_manga_name}.jpg"
-    
-    # Path for the downloaded poster
-    poster_path = Path(f"{formatted_manga_name}_poster.jpg")
-    
-    # Check if the poster already exists
-    if poster_path.exists():
-        print(f"Poster already exists: {poster_path}")
-        return
-    
+        return manga_name.strip('"')
+    # Format the manga name to have the first letter of each word in uppercase and replace spaces with "-"
+    return manga_name.title().replace(" ", "-")
+
+
+class PosterState(JsonStore):
+    # Per cover file: the HTTP validators it was downloaded with
+    def __init__(self, path: Path = POSTER_STATE_FILE):
+        super().__init__(path)
+
+    def validators(self, poster_path: Path) -> dict:
+        # Only sent while the file is still there; a deleted cover is fetched again
+        entry = self.entries.get(str(poster_path))
+        if entry is None or not poster_path.exists():
+            return {}
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, poster_path: Path, etag: str, last_modified: str):
+        with self._lock:
+            self.entries[str(poster_path)] = {"etag": etag, "last_modified": last_modified}
+            self.dirty = True
+
+
+def write_atomically(path: Path, data: bytes):
+    partial_path = path.with_name(path.name + ".part")
+    partial_path.write_bytes(data)
+    partial_path.replace(path)
+
+
+async def fetch_poster(session: aiohttp.ClientSession, state: PosterState, name: str, poster_path: Path) -> str:
+    # One conditional GET; returns "downloaded", "unchanged", "missing" or "failed"
+    had_poster = poster_path.exists()
     try:
-        # Send a GET request to the poster URL
-        response = requests.get(poster_url)
-        response.raise_for_status()  # Raise an error for bad status codes
-
-        # Save the downloaded image to a file
-        with poster_path.open("wb") as file:
-            file.write(response.content)
-        print("Manga poster downloaded successfully!")
-        
-        # Save the entered manga name to a history file for successful downloads
-        history_path = Path("manga_history.txt")
-        with history_path.open("a") as history_file:
-            history_file.write(formatted_manga_name + "\n")
-        print("Manga name added to history.")
-        
-    except requests.RequestException as e:
-        print(f"Failed to download the manga poster: {e}")
+        status, data, headers = await fetch_page(session, POSTER_URL.format(name), headers=state.validators(poster_path))
+    except (DamagedPage, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning(f"Could not fetch the poster of {name}: {e}")
+        return "failed"
+    if status == 304:
+        return "unchanged"
+    if status != 200:
+        if status != 404:
+            logging.warning(f"Could not fetch the poster of {name}: HTTP {status}")
+        return "missing" if status == 404 else "failed"
+    await asyncio.get_running_loop().run_in_executor(None, write_atomically, poster_path, data)
+    state.put(poster_path, headers.get("ETag"), headers.get("Last-Modified"))
+    logging.info(f"{'Updated' if had_poster else 'Downloaded'} poster: {poster_path}")
+    return "downloaded"
 
-def main():
+
+async def fetch_posters(targets: list, state: PosterState, concurrency: int = POSTER_CONCURRENCY,
+                        history_file: Path = POSTER_HISTORY_FILE) -> dict:
+    # targets: (URL name, output path) pairs
+    results = {"downloaded": 0, "unchanged": 0, "missing": 0, "failed": 0}
+    downloaded = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with HttpClient(limit=concurrency, limit_per_host=concurrency) as client:
+        async def fetch(name: str, poster_path: Path):
+            async with semaphore:
+                result = await fetch_poster(client.session, state, name, poster_path)
+            results[result] += 1
+            if result == "downloaded":
+                downloaded.append(name)
+
+        await asyncio.gather(*(fetch(name, poster_path) for name, poster_path in targets))
+    state.save()
+    if downloaded and history_file is not None:
+        # Save the names of successful downloads to the history file, once each
+        known = set(history_file.read_text(encoding='utf-8').splitlines()) if history_file.exists() else set()
+        with history_file.open("a", encoding='utf-8') as file:
+            file.writelines(f"{name}\n" for name in dict.fromkeys(downloaded) if name not in known)
+    logging.info(f"Posters: {results['downloaded']} downloaded, {results['unchanged']} unchanged, "
+                 f"{results['missing']} not found, {results['failed']} failed.")
+    return results
+
+
+def library_targets(roots: list) -> list:
+    # A cover.jpg in every series folder, named after the folder
+    from libraryserver import Catalog
+    return [(name, folder / LIBRARY_COVER) for name, folder in sorted(Catalog(roots).series().items())]
+
+
+def search_and_download_manga_poster(manga_name):
+    formatted_manga_name = format_manga_name(manga_name)
+    poster_path = Path(f"{formatted_manga_name}_poster.jpg")
+    return asyncio.run(fetch_posters([(formatted_manga_name, poster_path)], PosterState()))
+
+
+def parse_args():
     parser = argparse.ArgumentParser(description="Download manga posters by name.")
-    parser.add_argument('manga_name', type=str, help="Name of the manga")
+    parser.add_argument('manga_names', nargs='*', metavar='manga_name', help="Names of the manga")
+    parser.add_argument('--library', nargs='+', type=Path, metavar='ROOT',
+                        help=f"Fetch a {LIBRARY_COVER} for every series folder in these library folders")
+    parser.add_argument('--history', action='store_true', help=f"Refresh the posters of every name in {POSTER_HISTORY_FILE}")
+    parser.add_argument('--concurrency', type=int, default=POSTER_CONCURRENCY, help="Posters fetched at once")
     args = parser.parse_args()
-    
-    search_and_download_manga_poster(args.manga_name)
+    if not (args.manga_names or args.library or args.history):
+        parser.error("give manga names, --library or --history")
+    return args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    names = [format_manga_name(name) for name in args.manga_names]
+    if args.history and POSTER_HISTORY_FILE.exists():
+        names += [line.strip() for line in POSTER_HISTORY_FILE.read_text(encoding='utf-8').splitlines() if line.strip()]
+    targets = [(name, Path(f"{name}_poster.jpg")) for name in dict.fromkeys(names)]
+    if args.library:
+        targets += library_targets(args.library)
+    asyncio.run(fetch_posters(targets, PosterState(), max(1, args.concurrency)))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,111 @@
+import json
+import time
+import asyncio
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+import aiohttp
+
+try:
+    import fcntl
+except ImportError:  # Windows: the limit then only applies within one process
+    fcntl = None
+
+RATE_LIMIT_FILE = Path(tempfile.gettempdir()) / "manga4life-rate-limit.json"
+# Received bytes are settled with the shared state in batches, not per page
+BYTE_BATCH = 256 * 1024
+# Hosts idle for this long are dropped from the state file
+STALE_AFTER = 3600
+
+
+class RateLimiter:
+    # Token buckets per target host, shared by every downloader process on the
+    # machine through a small file-locked JSON state file. Each take may drive
+    # a bucket into debt; the caller then sleeps until the debt is repaid, so
+    # concurrent processes queue up behind each other instead of all bursting.
+    # Run every process with the same limits.
+    def __init__(self, requests_per_second: float = None, bytes_per_second: float = None, path: Path = RATE_LIMIT_FILE):
+        if requests_per_second is not None and requests_per_second <= 0:
+            raise ValueError("Request rate must be positive")
+        if bytes_per_second is not None and bytes_per_second <= 0:
+            raise ValueError("Byte rate must be positive")
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        self.path = path
+        self._lock = threading.Lock()
+        self._unsettled = {}
+        self.waited = 0.0
+
+    def _take(self, host: str, requests: int, nbytes: int) -> float:
+        # Returns how long the caller has to wait
+        with self._lock, open(self.path, 'a+', encoding='utf-8') as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            try:
+                state = json.loads(file.read() or "{}")
+            except ValueError:
+                state = {}
+            now = time.time()
+            state = {name: bucket for name, bucket in state.items() if now - bucket["updated"] < STALE_AFTER}
+            bucket = state.setdefault(host, {"requests": self.requests_per_second or 0,
+                                             "bytes": self.bytes_per_second or 0, "updated": now})
+            elapsed = max(0.0, now - bucket["updated"])
+            wait = 0.0
+            # Up to one second's worth of tokens is saved up while idle
+            for key, rate, amount in (("requests", self.requests_per_second, requests),
+                                      ("bytes", self.bytes_per_second, nbytes)):
+                if rate is None or not amount:
+                    continue
+                bucket[key] = min(rate, bucket[key] + elapsed * rate) - amount
+                if bucket[key] < 0:
+                    wait = max(wait, -bucket[key] / rate)
+            bucket["updated"] = now
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(state))
+            file.flush()
+            # Closing the file releases the lock
+        return wait
+
+    async def _wait(self, host: str, requests: int, nbytes: int):
+        wait = await asyncio.get_running_loop().run_in_executor(None, self._take, host, requests, nbytes)
+        if wait > 0:
+            self.waited += wait
+            await asyncio.sleep(wait)
+
+    async def acquire(self, host: str):
+        if self.requests_per_second is not None:
+            await self._wait(host, 1, 0)
+
+    async def consume(self, host: str, nbytes: int):
+        if self.bytes_per_second is None:
+            return
+        pending = self._unsettled.get(host, 0) + nbytes
+        if pending < BYTE_BATCH:
+            self._unsettled[host] = pending
+            return
+        self._unsettled[host] = 0
+        await self._wait(host, 0, pending)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        # aiohttp awaits trace callbacks, so sleeping in them delays the
+        # request (or the reading of its body) without extra plumbing
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            await self.acquire(params.url.host)
+
+        async def on_response_chunk_received(session, context, params):
+            await self.consume(params.url.host, len(params.chunk))
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        return trace_config
+
+    def log_stats(self):
+        if self.waited:
+            logging.info(f"Rate limit: waited {self.waited:.1f}s in total")
+
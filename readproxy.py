@@ -0,0 +1,286 @@
+import os
+import hashlib
+import itertools
+import asyncio
+import argparse
+import logging
+import mimetypes
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+from budget import parse_size, format_size
+from integrity import DamagedPage, fetch_page_retrying
+from mangaclient import MangaClient, PageUnavailable, IMAGE_URL, format_series, format_chapter
+from planner import MAX_PAGES
+from sinks import image_extension
+
+CACHE_POLICIES = ("lru", "lfu")
+PREFETCH_PAGES = 5
+
+
+def content_type(extension: str) -> str:
+    return mimetypes.guess_type(f"page{extension}")[0] or "application/octet-stream"
+
+
+class PageCache:
+    # Pages on disk under a byte cap. LRU evicts the page read longest ago;
+    # LFU the page read least often (ties go to the older read). Files are
+    # named by a hash of series/chapter/page plus the image extension, and the
+    # index is rebuilt from them at startup, oldest modification first.
+    def __init__(self, root: Path, max_bytes: int, policy: str = "lru"):
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"Unknown cache policy {policy!r} (choose from {', '.join(CACHE_POLICIES)})")
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = OrderedDict()  # hash -> [size, reads, extension, prefetched]
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.evicted_bytes = 0
+        # Stores and deletions run in submission order on one thread, off the
+        # event loop, so a page evicted and fetched again is never deleted
+        # after it was rewritten
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        files = [entry for entry in os.scandir(self.root) if entry.is_file() and not entry.name.endswith(".part")]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            name, extension = os.path.splitext(entry.name)
+            self.entries[name] = [entry.stat().st_size, 0, extension, False]
+            self.size += entry.stat().st_size
+        self.remove_files(self._evict())
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def lookup(self, key: str) -> list:
+        # The cache entry of a page, counted as a hit, or None as a miss
+        name = self.digest(key)
+        entry = self.entries.get(name)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[1] += 1
+        self.entries.move_to_end(name)
+        return entry
+
+    def path(self, key: str, extension: str) -> Path:
+        return self.root / f"{self.digest(key)}{extension}"
+
+    def contains(self, key: str) -> bool:
+        return self.digest(key) in self.entries
+
+    def store(self, key: str, data: bytes, extension: str):
+        # Runs in a worker thread; add() then updates the index on the loop
+        path = self.path(key, extension)
+        partial_path = path.with_name(path.name + ".part")
+        partial_path.write_bytes(data)
+        partial_path.replace(path)
+
+    def add(self, key: str, size: int, extension: str, prefetched: bool = False) -> list:
+        # Returns the files of evicted pages, for remove_files() on the writer
+        name = self.digest(key)
+        old = self.entries.pop(name, None)
+        if old is not None:
+            self.size -= old[0]
+        # The miss that fetched a page counts as its first read; a prefetched
+        # page has not been read yet
+        self.entries[name] = [size, 0 if prefetched else 1, extension, prefetched]
+        self.size += size
+        return self._evict()
+
+    def _victim(self) -> str:
+        if self.policy == "lru":
+            return next(iter(self.entries))
+        # Iteration runs oldest read first, so min() keeps the older of equal
+        # counts. The newest entry is left out: it has had no chance to be read.
+        older = itertools.islice(self.entries, max(1, len(self.entries) - 1))
+        return min(older, key=lambda name: self.entries[name][1])
+
+    def _evict(self) -> list:
+        # Drops entries from the index only; the caller deletes their files
+        evicted = []
+        while self.size > self.max_bytes and self.entries:
+            name = self._victim()
+            size, _, extension, _ = self.entries.pop(name)
+            self.size -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+            evicted.append(self.root / f"{name}{extension}")
+        return evicted
+
+    @staticmethod
+    def remove_files(paths: list):
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"policy": self.policy, "pages": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions, "evicted_bytes": self.evicted_bytes}
+
+
+class ReadProxy:
+    # Maps /{series}/{chapter}/{page} onto the image host of the chapter.
+    # A miss is fetched, cached and answered; the next pages of the chapter
+    # are prefetched in the background so reading on stays local.
+    def __init__(self, cache: PageCache, prefetch: int = PREFETCH_PAGES):
+        self.cache = cache
+        self.prefetch = prefetch
+        self.client = None
+        self.hosts = {}
+        self.in_flight = {}
+        self.chapter_ends = {}
+        self.prefetched = 0
+        self.prefetch_hits = 0
+        self._tasks = set()
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/stats', self.stats)
+        app.router.add_get(r'/{series}/{chapter}/{page:\d+}', self.page)
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+        return app
+
+    async def _start(self, app):
+        self.client = MangaClient()
+        await self.client.__aenter__()
+
+    async def _stop(self, app):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.client.close()
+        self.cache.close()
+        logging.info(f"Cache: {self.summary()}")
+
+    def summary(self) -> str:
+        stats = self.cache.stats()
+        ratio = f"{stats['hit_ratio']:.1%}" if stats["hit_ratio"] is not None else "n/a"
+        return (f"{stats['hits']} hits, {stats['misses']} misses ({ratio} hit ratio), {stats['pages']} pages "
+                f"({format_size(stats['bytes'])} of {format_size(stats['max_bytes'])}), {stats['evictions']} evicted "
+                f"({format_size(stats['evicted_bytes'])}), {self.prefetched} prefetched, {self.prefetch_hits} read after prefetch")
+
+    def _shared(self, tasks: dict, key, make) -> asyncio.Future:
+        # One lookup or fetch per key at a time, shared by readers and the prefetcher
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(make())
+            tasks[key].add_done_callback(lambda _: tasks.pop(key, None))
+        return asyncio.shield(tasks[key])
+
+    async def _resolve(self, series: str, chapter: str) -> str:
+        # MangaClient remembers hosts once found; this only merges concurrent lookups
+        return await self._shared(self.hosts, (series, chapter), lambda: self.client.resolve(series, chapter))
+
+    async def _fetch(self, series: str, chapter: str, page: int, prefetched: bool = False) -> bytes:
+        key = f"{series}/{chapter}/{page}"
+        return await self._shared(self.in_flight, key, lambda: self._download(series, chapter, page, key, prefetched))
+
+    async def _download(self, series: str, chapter: str, page: int, key: str, prefetched: bool) -> bytes:
+        host = await self._resolve(series, chapter)
+        if not host:
+            return None
+        url = IMAGE_URL.format(host, series, chapter, page)
+        status, data, _ = await fetch_page_retrying(self.client.client.session, url)
+        if status == 404:
+            end = self.chapter_ends.get((series, chapter), page - 1)
+            self.chapter_ends[(series, chapter)] = min(end, page - 1)
+            return None
+        if status != 200:
+            raise PageUnavailable(url, status)
+        extension = image_extension(data)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.cache.writer, self.cache.store, key, data, extension)
+        evicted = self.cache.add(key, len(data), extension, prefetched)
+        if evicted:
+            await loop.run_in_executor(self.cache.writer, self.cache.remove_files, evicted)
+        return data
+
+    def _prefetch(self, series: str, chapter: str, page: int):
+        end = self.chapter_ends.get((series, chapter), MAX_PAGES)
+        for next_page in range(page + 1, min(page + self.prefetch, end) + 1):
+            key = f"{series}/{chapter}/{next_page}"
+            if self.cache.contains(key) or key in self.in_flight:
+                continue
+            self.prefetched += 1
+            task = asyncio.ensure_future(self._fetch(series, chapter, next_page, prefetched=True))
+            self._tasks.add(task)
+            task.add_done_callback(self._prefetch_done)
+
+    def _prefetch_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"Prefetch failed: {task.exception()}")
+
+    async def page(self, request: web.Request) -> web.StreamResponse:
+        series = format_series(request.match_info['series'])
+        try:
+            chapter = format_chapter(request.match_info['chapter'])
+        except ValueError:
+            raise web.HTTPNotFound(text="Invalid chapter number")
+        page = int(request.match_info['page'])
+        key = f"{series}/{chapter}/{page}"
+        if self.prefetch:
+            self._prefetch(series, chapter, page)
+        entry = self.cache.lookup(key)
+        if entry is not None:
+            _, _, extension, prefetched = entry
+            if prefetched:
+                entry[3] = False
+                self.prefetch_hits += 1
+            # Read now rather than handing a path to FileResponse: a concurrent
+            # miss may evict the page before a lazy response gets to it
+            try:
+                data = await asyncio.get_running_loop().run_in_executor(None, self.cache.path(key, extension).read_bytes)
+                return web.Response(body=data, headers={"Content-Type": content_type(extension), "X-Cache": "HIT"})
+            except FileNotFoundError:
+                pass  # Evicted while being read; fetch it again below
+        try:
+            data = await self._fetch(series, chapter, page)
+        except PageUnavailable as e:
+            # Throttled or failing upstream: tell the reader to retry, not that the page is missing
+            logging.error(f"Could not fetch {key}: {e}")
+            if e.status == 429 or e.status == 503:
+                raise web.HTTPServiceUnavailable(text="Upstream busy, try again")
+            raise web.HTTPBadGateway(text="Upstream fetch failed")
+        except (DamagedPage, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Could not fetch {key}: {e}")
+            raise web.HTTPBadGateway(text="Upstream fetch failed")
+        if data is None:
+            raise web.HTTPNotFound(text="No such page")
+        return web.Response(body=data, content_type=content_type(image_extension(data)), headers={"X-Cache": "MISS"})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.cache.stats(), prefetched=self.prefetched, prefetch_hits=self.prefetch_hits,
+                                      in_flight=len(self.in_flight)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Read chapters on demand through a size-capped local page cache")
+    parser.add_argument('--cache', type=Path, default=Path("page-cache"), help="Cache folder")
+    parser.add_argument('--max-size', metavar='SIZE', type=parse_size, default=parse_size("2GB"), help="Cache size cap (e.g. 2GB)")
+    parser.add_argument('--policy', choices=CACHE_POLICIES, default="lru", help="Eviction policy")
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_PAGES, help="Pages fetched ahead of the one being read")
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8081, help="Port to listen on")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    proxy = ReadProxy(PageCache(args.cache, args.max_size, args.policy), max(0, args.prefetch))
+    web.run_app(proxy.application(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
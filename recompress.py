@@ -0,0 +1,105 @@
+import io
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from budget import format_size
+
+# mode: default quality (shades for grey, encoder quality for webp/jpeg)
+RECOMPRESS_MODES = {"png": None, "grey": 16, "webp": 80, "jpeg": 85}
+# Largest channel difference still treated as a grey pixel (scan noise)
+GREY_TOLERANCE = 8
+
+
+def parse_recompress(value: str) -> tuple:
+    # "png", "grey", "grey:8", "webp:75", "jpeg:90"
+    mode, _, quality = value.strip().lower().partition(':')
+    if mode == "gray":
+        mode = "grey"
+    if mode not in RECOMPRESS_MODES:
+        raise ValueError(f"Unknown recompression mode {mode!r} (choose from {', '.join(RECOMPRESS_MODES)})")
+    if not quality:
+        return mode, RECOMPRESS_MODES[mode]
+    if mode == "png" or not quality.isdigit():
+        raise ValueError(f"Invalid recompression setting {value!r}")
+    quality = int(quality)
+    if mode == "grey" and not 2 <= quality <= 256:
+        raise ValueError("Grey shades must be between 2 and 256")
+    if mode != "grey" and not 1 <= quality <= 100:
+        raise ValueError("Quality must be between 1 and 100")
+    return mode, quality
+
+
+def is_grey(image) -> bool:
+    from PIL import ImageChops
+    if image.mode in ("1", "L", "LA", "I", "I;16"):
+        return True
+    red, green, blue = image.convert("RGB").split()
+    return all(ImageChops.difference(a, b).getextrema()[1] <= GREY_TOLERANCE
+               for a, b in ((red, green), (green, blue)))
+
+
+def recompress_page(data: bytes, mode: str, quality: int = None) -> bytes:
+    # Runs in a worker process. Returns the smaller of the input and the
+    # re-encoded page, so a page never grows.
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+        candidates = [data]
+        output = io.BytesIO()
+        if mode == "webp":
+            image.save(output, "WEBP", quality=quality, method=4)
+        elif mode == "jpeg" and not has_alpha:
+            image.convert("L" if is_grey(image) else "RGB").save(output, "JPEG", quality=quality, optimize=True)
+        else:
+            # Lossless; also the fallback for colour pages in grey mode and
+            # transparent pages in jpeg mode
+            image.save(output, "PNG", optimize=True)
+            if mode == "grey" and not has_alpha and is_grey(image):
+                # Manga pages are mostly flat tones; a small palette packs to 4 bits,
+                # though dithered screentone can compress better without it
+                candidates.append(output.getvalue())
+                output = io.BytesIO()
+                image.convert("L").quantize(colors=quality).save(output, "PNG", optimize=True)
+        candidates.append(output.getvalue())
+    return min(candidates, key=len)
+
+
+class Recompressor:
+    # Re-encodes pages in a process pool. At most two pages per worker are
+    # queued; fetchers awaiting a slot keep their bytes charged to the byte
+    # budget, which in turn stops new fetches, so the pool applies
+    # backpressure all the way back to the network.
+    def __init__(self, mode: str, quality: int = None, workers: int = None):
+        self.mode = mode
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.slots = asyncio.Semaphore(self.workers * 2)
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def transform(self, data: bytes) -> bytes:
+        async with self.slots:
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, recompress_page, data, self.mode, self.quality)
+            except Exception as e:
+                logging.warning(f"Could not recompress page, keeping original: {e}")
+                result = data
+        self.pages += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(result)
+        return result
+
+    def log_report(self):
+        saved = self.bytes_in - self.bytes_out
+        percent = saved / self.bytes_in * 100 if self.bytes_in else 0
+        logging.info(f"Recompressed {self.pages} page(s) ({self.mode}): {format_size(self.bytes_in)} -> "
+                     f"{format_size(self.bytes_out)}, saved {format_size(saved)} ({percent:.1f}%)")
+
+    def close(self):
+        self.executor.shutdown()
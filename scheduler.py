@@ -0,0 +1,149 @@
+import re
+import heapq
+import argparse
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: queue updates are then not locked
+    fcntl = None
+
+PRIORITY_QUEUE_FILE = Path("priority_queue.txt")
+URGENT, NORMAL = 0, 1
+ORDERS = ("given", "reading", "newest")
+
+
+def series_key(name: str) -> str:
+    return re.sub(r'\s+', '-', name.strip()).lower()
+
+
+@contextmanager
+def queue_lock(queue_file: Path):
+    # Held by everything that reads and rewrites a queue file, or appends to
+    # it. The lock lives in a separate file because the queue itself is
+    # replaced, which would leave a lock on the old file behind.
+    with open(queue_file.with_name(queue_file.name + ".lock"), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+        # Closing the file releases the lock
+
+
+def take_urgent(series: str, queue_file: Path = PRIORITY_QUEUE_FILE) -> list:
+    # Removes and returns the chapters queued for one series; lines for other
+    # series stay for the processes downloading those
+    if not queue_file.exists():
+        return []
+    with queue_lock(queue_file):
+        if not queue_file.exists():
+            return []
+        taken, kept = [], []
+        for line in queue_file.read_text(encoding='utf-8').splitlines():
+            name, _, chapter = line.partition('\t')
+            if chapter and series_key(name) == series_key(series):
+                taken.append(chapter.strip())
+            elif line.strip():
+                kept.append(line)
+        if taken:
+            partial_path = queue_file.with_name(queue_file.name + ".part")
+            partial_path.write_text("".join(line + "\n" for line in kept), encoding='utf-8')
+            partial_path.replace(queue_file)
+    return taken
+
+
+class ChapterScheduler:
+    # Hands out chapters by priority class, then by the chosen order. Urgent
+    # chapters, whether given up front or queued while the run is going, are
+    # taken before any bulk chapter that has not started yet; a chapter that
+    # is already downloading is never interrupted. An urgent chapter therefore
+    # waits for at most one chapter, however long the backlog is.
+    def __init__(self, series: str, order: str = "given", normalize=str, queue_file: Path = PRIORITY_QUEUE_FILE):
+        if order not in ORDERS:
+            raise ValueError(f"Unknown order {order!r} (choose from {', '.join(ORDERS)})")
+        self.series = series
+        self.order = order
+        self.normalize = normalize
+        self.queue_file = queue_file
+        self.heap = []
+        self.priority = {}
+        self.sequence = 0
+
+    def _sort_key(self, chapter: str):
+        if self.order == "reading":
+            return float(chapter)
+        if self.order == "newest":
+            return -float(chapter)
+        return self.sequence
+
+    def add(self, chapters: list, priority: int = NORMAL):
+        for chapter in chapters:
+            try:
+                chapter = self.normalize(chapter)
+            except ValueError:
+                logging.warning(f"Ignoring invalid chapter number {chapter!r}")
+                continue
+            if self.priority.get(chapter, priority + 1) <= priority:
+                continue
+            # A chapter moved to a higher class leaves a stale entry behind,
+            # which pop() skips
+            self.priority[chapter] = priority
+            heapq.heappush(self.heap, (priority, self._sort_key(chapter), self.sequence, chapter))
+            self.sequence += 1
+
+    def poll(self) -> list:
+        urgent = take_urgent(self.series, self.queue_file)
+        if urgent:
+            logging.info(f"\nMoving chapter(s) {', '.join(urgent)} to the front of the queue.")
+            self.add(urgent, URGENT)
+        return urgent
+
+    def peek(self, count: int) -> list:
+        # Every heap entry beyond the live ones is stale, so this many of the
+        # smallest are enough to hold the first count live chapters
+        stale = len(self.heap) - len(self.priority)
+        upcoming = []
+        for priority, _, _, chapter in heapq.nsmallest(count + stale, self.heap):
+            if len(upcoming) == count:
+                break
+            if self.priority.get(chapter) == priority:
+                upcoming.append(chapter)
+        return upcoming
+
+    def pop(self) -> str:
+        while self.heap:
+            priority, _, _, chapter = heapq.heappop(self.heap)
+            if self.priority.get(chapter) == priority:
+                del self.priority[chapter]
+                return chapter
+        return None
+
+    def __len__(self) -> int:
+        return len(self.priority)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ask a running D4C2 download to fetch some chapters next")
+    parser.add_argument('series', help="Manga name, as given to the downloader")
+    parser.add_argument('chapters', help="Chapters to move to the front (e.g. 1050,1051-1053)")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    chapters = []
+    for part in args.chapters.split(','):
+        if '-' in part:
+            start, end = map(int, part.split('-'))
+            chapters.extend(str(chapter) for chapter in range(start, end + 1))
+        elif part.strip():
+            chapters.append(part.strip())
+    with queue_lock(PRIORITY_QUEUE_FILE), open(PRIORITY_QUEUE_FILE, 'a', encoding='utf-8') as file:
+        file.writelines(f"{args.series}\t{chapter}\n" for chapter in chapters)
+    logging.info(f"Queued {len(chapters)} chapter(s) of {args.series}; they start after the chapter in progress.")
+
+
+if __name__ == "__main__":
+    main()
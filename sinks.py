@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import zipfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+from pdfsink import PdfWriter
+from buildcache import BuildCache, PageSetHasher, settings_digest
+from storage import Storage, LocalStorage, StoredFile, settle
+
+# Pages of a chapter that may not need rebuilding are held here until the
+# page set is known; larger chapters spill to a temporary file
+SPOOL_MAX_SIZE = 16 * 1024 ** 2
+SINK_QUEUE_SIZE = 32
+
+
+def image_extension(data: bytes) -> str:
+    if data.startswith(b'\x89PNG'):
+        return ".png"
+    if data.startswith(b'\xff\xd8'):
+        return ".jpg"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return ".webp"
+    if data.startswith(b'GIF8'):
+        return ".gif"
+    return ".png"
+
+
+class Sink(ABC):
+    name = "sink"
+
+    @abstractmethod
+    def open_chapter(self, chapter: str):
+        ...
+
+    @abstractmethod
+    def write_page(self, page_number: int, data: bytes):
+        ...
+
+    @abstractmethod
+    def close_chapter(self) -> int:
+        ...
+
+    def abort_chapter(self):
+        pass
+
+
+class FolderSink(Sink):
+    # The Chapter-NNNN/NNN.png layout written by D4C and D4B2
+    name = "folder"
+
+    def __init__(self, storage: Storage, series: str, page_store=None):
+        if page_store is not None and storage.local_path(series) is None:
+            raise ValueError(f"The page store needs local storage, not {storage.name}")
+        self.storage = storage
+        self.series = series
+        self.page_store = page_store
+        self.chapter_key = None
+        self.uploads = []
+        self.page_count = 0
+
+    def open_chapter(self, chapter: str):
+        self.chapter_key = f"{self.series}/Chapter-{chapter}"
+        local_folder = self.storage.local_path(self.chapter_key)
+        if local_folder is not None:
+            local_folder.mkdir(parents=True, exist_ok=True)
+        self.uploads = []
+        self.page_count = 0
+
+    def write_page(self, page_number: int, data: bytes):
+        key = f"{self.chapter_key}/{page_number:03d}{image_extension(data)}"
+        if self.page_store is not None:
+            self.page_store.store_page(data, self.storage.local_path(key))
+        else:
+            self.uploads.append(self.storage.put(key, data))
+        self.page_count += 1
+
+    def close_chapter(self) -> int:
+        uploads, self.uploads = self.uploads, []
+        settle(uploads)
+        return self.page_count
+
+    def abort_chapter(self):
+        # The pages already written are intact; just let their uploads finish
+        uploads, self.uploads = self.uploads, []
+        settle(uploads)
+
+
+class ArchiveSink(Sink):
+    # Base for sinks that build one file per chapter. Outputs are committed to
+    # the storage backend only when complete; an output the build cache knows
+    # was produced from the same pages and settings is left untouched.
+    suffix = ""
+    settings = {}
+
+    def __init__(self, storage: Storage, series: str, build_cache: BuildCache):
+        self.storage = storage
+        self.series = series
+        self.build_cache = build_cache
+        self.settings_digest = settings_digest(self.settings)
+        self.output = None
+        self.hasher = None
+        self.spool = None
+        self.spooled = []
+        self.file = None
+        self.page_count = 0
+
+    def open_chapter(self, chapter: str):
+        self.output = StoredFile(self.storage, f"{self.series}/Chapter-{chapter}{self.suffix}")
+        self.hasher = PageSetHasher()
+        self.page_count = 0
+        if self.build_cache.lookup(self.output, self.settings_digest) is None:
+            self._start()
+        else:
+            self.spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            self.spooled = []
+
+    def _start(self):
+        self.file = self.storage.open_write(self.output.key)
+        self.begin(self.file)
+
+    def write_page(self, page_number: int, data: bytes):
+        self.hasher.update(data)
+        if self.spool is not None:
+            self.spool.write(data)
+            self.spooled.append((page_number, len(data)))
+        elif self.add(page_number, data):
+            self.page_count += 1
+
+    def close_chapter(self) -> int:
+        if self.spool is not None:
+            spool, self.spool = self.spool, None
+            with spool:
+                if self.build_cache.is_fresh(self.output, self.hasher.hexdigest(), self.settings_digest):
+                    logging.info(f"{self.output.name} is up to date, skipping render.")
+                    return 0
+                self._start()
+                spool.seek(0)
+                for page_number, length in self.spooled:
+                    if self.add(page_number, spool.read(length)):
+                        self.page_count += 1
+
+        if self.page_count:
+            self.finish()
+        file, self.file = self.file, None
+        if not self.page_count:
+            file.abort()
+            return 0
+        settle([file.commit()])
+        self.build_cache.record(self.output, self.hasher.hexdigest(), self.settings_digest, self.page_count)
+        return self.page_count
+
+    def abort_chapter(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        if self.file is not None:
+            try:
+                # Let the writer release its state; the output is discarded anyway
+                self.finish()
+            except Exception:
+                pass
+            self.file.abort()
+            self.file = None
+
+    @abstractmethod
+    def begin(self, file):
+        ...
+
+    @abstractmethod
+    def add(self, page_number: int, data: bytes) -> bool:
+        ...
+
+    @abstractmethod
+    def finish(self):
+        ...
+
+
+class PdfSink(ArchiveSink):
+    name = "pdf"
+    suffix = ".pdf"
+    settings = {"format": "pdf", "writer": "pdfsink-1"}
+
+    def begin(self, file):
+        self.writer = PdfWriter(file)
+
+    def add(self, page_number: int, data: bytes) -> bool:
+        # Pages are embedded without decoding and sized to each image. A page
+        # that cannot be rendered fails the chapter for this sink, so a PDF
+        # with a page missing is never committed or cached as fresh.
+        try:
+            self.writer.add_image(data)
+        except Exception as e:
+            raise ValueError(f"cannot render page {page_number}: {e}") from e
+        return True
+
+    def finish(self):
+        self.writer.close()
+
+
+class CbzSink(ArchiveSink):
+    name = "cbz"
+    suffix = ".cbz"
+    settings = {"format": "cbz", "compression": "stored"}
+
+    def begin(self, file):
+        # Pages are already compressed images, so members are stored as-is
+        self.archive = zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_STORED)
+
+    def add(self, page_number: int, data: bytes) -> bool:
+        self.archive.writestr(f"{page_number:03d}{image_extension(data)}", data)
+        return True
+
+    def finish(self):
+        self.archive.close()
+
+
+SINK_TYPES = {sink_type.name: sink_type for sink_type in (FolderSink, PdfSink, CbzSink)}
+
+
+def parse_formats(formats_str: str) -> list:
+    formats = [name.strip().lower() for name in formats_str.split(',') if name.strip()]
+    for name in formats:
+        if name not in SINK_TYPES:
+            raise ValueError(f"Unknown output format {name!r} (choose from {', '.join(SINK_TYPES)})")
+    return formats
+
+
+def build_sinks(formats: list, series_folder: Path, build_cache: BuildCache, page_store=None, storage: Storage = None) -> list:
+    # Without a storage backend, outputs go to series_folder as before
+    if storage is None:
+        storage = LocalStorage(series_folder.parent)
+    series = series_folder.name
+    sinks = []
+    for name in formats:
+        sink_type = SINK_TYPES[name]
+        sinks.append(FolderSink(storage, series, page_store) if sink_type is FolderSink else sink_type(storage, series, build_cache))
+    return sinks
+
+
+class SinkPipeline:
+    # Fans one in-order page stream out to several sinks. Each sink has its
+    # own bounded queue and worker thread, so a slow sink only applies
+    # backpressure and a failing sink only loses its own output for that
+    # chapter. Page bytes are released from the budget once every sink is done.
+    def __init__(self, sinks: list, budget=None, queue_size: int = SINK_QUEUE_SIZE):
+        self.sinks = sinks
+        self.budget = budget
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in sinks]
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(sinks)))
+        self.failures = {sink.name: [] for sink in sinks}
+        self.written = {sink.name: 0 for sink in sinks}
+        self.workers = [asyncio.ensure_future(self._run(sink, sink_queue)) for sink, sink_queue in zip(sinks, self.queues)]
+
+    async def _broadcast(self, item):
+        # Fed concurrently: a full queue holds back the producer, but never
+        # the delivery of this item to the other sinks
+        await asyncio.gather(*(sink_queue.put(item) for sink_queue in self.queues))
+
+    async def open_chapter(self, chapter: str):
+        await self._broadcast(("open", chapter))
+
+    async def put_page(self, page_number: int, data: bytes):
+        # [sinks still to consume the page, bytes charged to the budget]
+        await self._broadcast(("page", page_number, data, [len(self.sinks), len(data)]))
+
+    async def close_chapter(self):
+        await self._broadcast(("close",))
+
+    async def abort_chapter(self):
+        # The chapter could not be downloaded in full: every sink drops its
+        # output, and nothing is recorded in the build cache
+        await self._broadcast(("abort",))
+
+    def _page_done(self, pending: list):
+        pending[0] -= 1
+        if pending[0] == 0 and self.budget is not None:
+            self.budget.release(pending[1])
+
+    async def _run(self, sink: Sink, sink_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        chapter = None
+        failed = False
+        while True:
+            item = await sink_queue.get()
+            if item is None:
+                return
+            kind = item[0]
+            try:
+                if kind == "open":
+                    chapter, failed = item[1], False
+                    await loop.run_in_executor(self.executor, sink.open_chapter, chapter)
+                elif kind == "page" and not failed:
+                    await loop.run_in_executor(self.executor, sink.write_page, item[1], item[2])
+                elif kind == "close" and not failed:
+                    self.written[sink.name] += await loop.run_in_executor(self.executor, sink.close_chapter)
+                elif kind == "abort" and not failed:
+                    failed = True
+                    await loop.run_in_executor(self.executor, sink.abort_chapter)
+            except Exception as e:
+                logging.error(f"{sink.name} output failed for chapter {chapter}: {e}")
+                failed = True
+                self.failures[sink.name].append(chapter)
+                try:
+                    await loop.run_in_executor(self.executor, sink.abort_chapter)
+                except Exception as e:
+                    logging.error(f"{sink.name} output could not clean up chapter {chapter}: {e}")
+            finally:
+                if kind == "page":
+                    self._page_done(item[3])
+
+    async def close(self):
+        await self._broadcast(None)
+        await asyncio.gather(*self.workers)
+        self.executor.shutdown(wait=False)
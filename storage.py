@@ -0,0 +1,390 @@
+import os
+import hmac
+import time
+import hashlib
+import tarfile
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+from budget import parse_size
+from httpclient import create_requests_session
+
+SHARD_SIZE = parse_size("1GB")
+# S3 wants parts of at least 5MB, except the last one
+PART_SIZE = parse_size("8MB")
+UPLOAD_WORKERS = 4
+SPOOL_MAX_SIZE = 16 * 1024 ** 2
+
+
+class StorageError(OSError):
+    pass
+
+
+class StoredFile:
+    # Path-like handle for an output in a storage backend; the build cache
+    # only needs its name and whether it exists
+    def __init__(self, storage, key: str):
+        self.storage = storage
+        self.key = key
+        self.name = key.rsplit('/', 1)[-1]
+
+    def exists(self) -> bool:
+        return self.storage.exists(self.key)
+
+    def __str__(self) -> str:
+        return self.storage.describe(self.key)
+
+
+def settle(results: list):
+    # Waits for uploads started by put()/commit(); raises the first failure
+    for result in results:
+        if result is not None:
+            result.result()
+
+
+class Storage(ABC):
+    # Keys are '/'-separated paths below the library root, such as
+    # "One-Piece/Chapter-0001.cbz". open_write() returns a writer with
+    # write/tell/commit/abort; nothing is visible under the key until commit.
+    # put() and commit() may return a future when the backend uploads in the
+    # background; pass those to settle(). Only D4C2's sinks write through a
+    # Storage; page metadata and the build cache stay beside local files.
+    name = "storage"
+
+    @abstractmethod
+    def open_write(self, key: str):
+        ...
+
+    def put(self, key: str, data: bytes):
+        writer = self.open_write(key)
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    def local_path(self, key: str) -> Path:
+        # Only local storage can hand out paths (needed for hardlinked pages)
+        return None
+
+    def describe(self, key: str) -> str:
+        return key
+
+    def close(self):
+        pass
+
+
+class LocalWriter:
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path.with_name(path.name + ".part"), 'wb')
+
+    def write(self, data) -> int:
+        return self.file.write(data)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def flush(self):
+        self.file.flush()
+
+    def commit(self):
+        self.file.close()
+        Path(self.file.name).replace(self.path)
+
+    def abort(self):
+        self.file.close()
+        Path(self.file.name).unlink(missing_ok=True)
+
+
+class LocalStorage(Storage):
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def local_path(self, key: str) -> Path:
+        return self.root / key
+
+    def open_write(self, key: str) -> LocalWriter:
+        return LocalWriter(self.local_path(key))
+
+    def exists(self, key: str) -> bool:
+        return self.local_path(key).exists()
+
+    def describe(self, key: str) -> str:
+        return str(self.local_path(key))
+
+
+class SpoolWriter:
+    # Collects an object whose size must be known before it is stored
+    def __init__(self, on_commit):
+        self.spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.on_commit = on_commit
+
+    def write(self, data) -> int:
+        return self.spool.write(data)
+
+    def tell(self) -> int:
+        return self.spool.tell()
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        with self.spool:
+            size = self.spool.tell()
+            self.spool.seek(0)
+            return self.on_commit(self.spool, size)
+
+    def abort(self):
+        self.spool.close()
+
+
+class ShardedTarStorage(Storage):
+    # Appends every object to shard-NNNNN.tar files of about shard_size
+    # bytes; few large files suit tape-like and object-store archiving
+    # better than millions of small pages. A key written twice is stored
+    # twice, and tar extraction keeps the later copy.
+    name = "tar"
+
+    def __init__(self, root: Path, shard_size: int = SHARD_SIZE):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self._lock = threading.Lock()
+        self.members = {}
+        shards = sorted(self.root.glob("shard-*.tar"))
+        for shard in shards:
+            with tarfile.open(shard, 'r:') as archive:
+                for member in archive.getmembers():
+                    self.members[member.name] = shard.name
+        self.shard_index = len(shards) - 1 if shards else 0
+        self.archive = None
+
+    def _shard_path(self) -> Path:
+        return self.root / f"shard-{self.shard_index:05d}.tar"
+
+    def _open_shard(self):
+        path = self._shard_path()
+        if path.exists() and path.stat().st_size >= self.shard_size:
+            self.shard_index += 1
+            path = self._shard_path()
+        self.archive = tarfile.open(path, 'a' if path.exists() else 'w')
+
+    def _add(self, key: str, fileobj, size: int):
+        with self._lock:
+            if self.archive is None:
+                self._open_shard()
+            member = tarfile.TarInfo(key)
+            member.size = size
+            member.mtime = int(time.time())
+            self.archive.addfile(member, fileobj)
+            self.archive.fileobj.flush()
+            self.members[key] = self._shard_path().name
+            if self.archive.offset >= self.shard_size:
+                self.archive.close()
+                self.archive = None
+                self.shard_index += 1
+
+    def open_write(self, key: str) -> SpoolWriter:
+        return SpoolWriter(lambda spool, size: self._add(key, spool, size))
+
+    def exists(self, key: str) -> bool:
+        return key in self.members
+
+    def describe(self, key: str) -> str:
+        return f"{self.root / self.members.get(key, self._shard_path().name)}:{key}"
+
+    def close(self):
+        with self._lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+
+def sign_v4(method: str, url: str, headers: dict, payload_hash: str, access_key: str, secret_key: str,
+            region: str, service: str = "s3", amz_date: str = None) -> dict:
+    # AWS Signature Version 4. Returns the headers to send, including the
+    # signed x-amz-date, x-amz-content-sha256 and Authorization.
+    parts = urlsplit(url)
+    amz_date = amz_date or time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+    headers.update({"host": parts.netloc, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+    query = []
+    for pair in filter(None, parts.query.split('&')):
+        name, _, value = pair.partition('=')
+        query.append((quote(unquote(name), safe='-_.~'), quote(unquote(value), safe='-_.~')))
+    signed_headers = ";".join(sorted(headers))
+    canonical_request = "\n".join([
+        method,
+        quote(unquote(parts.path) or "/", safe='/-_.~'),
+        "&".join(f"{name}={value}" for name, value in sorted(query)),
+        "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+    key = ("AWS4" + secret_key).encode()
+    for part in (amz_date[:8], region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+                                f"SignedHeaders={signed_headers}, Signature={signature}")
+    return headers
+
+
+class S3Writer:
+    # Buffers up to one part. Small objects become a single background PUT;
+    # larger ones switch to a multipart upload whose parts are uploaded
+    # concurrently while the caller keeps writing.
+    def __init__(self, storage, key: str):
+        self.storage = storage
+        self.key = key
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.storage.part_size:
+            self._upload_part(bytes(self.buffer[:self.storage.part_size]))
+            del self.buffer[:self.storage.part_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data: bytes):
+        if self.upload_id is None:
+            response = self.storage.request("POST", self.key, "uploads=")
+            self.upload_id = ElementTree.fromstring(response.content).findtext('{*}UploadId')
+            if not self.upload_id:
+                raise StorageError(f"No upload id for {self.storage.describe(self.key)}")
+        part_number = len(self.parts) + 1
+        query = f"partNumber={part_number}&uploadId={quote(self.upload_id, safe='')}"
+        self.parts.append(self.storage.submit(self.storage.request, "PUT", self.key, query, data))
+
+    def commit(self):
+        if self.upload_id is None:
+            return self.storage.submit(self.storage.request, "PUT", self.key, "", bytes(self.buffer))
+        if self.buffer:
+            self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            etags = [part.result().headers["ETag"] for part in self.parts]
+        except BaseException:
+            self.abort()
+            raise
+        body = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                       for number, etag in enumerate(etags, start=1))
+        self.storage.request("POST", self.key, f"uploadId={quote(self.upload_id, safe='')}",
+                             f"<CompleteMultipartUpload>{body}</CompleteMultipartUpload>".encode())
+        return None
+
+    def abort(self):
+        self.buffer.clear()
+        if self.upload_id is not None:
+            for part in self.parts:
+                part.cancel()
+            for part in self.parts:
+                try:
+                    part.result()
+                except BaseException:
+                    pass
+            self.storage.request("DELETE", self.key, f"uploadId={quote(self.upload_id, safe='')}")
+            self.upload_id = None
+
+
+class S3Storage(Storage):
+    # S3-compatible object storage (AWS, MinIO, Ceph, ...), path-style URLs.
+    # Uploads run on a small thread pool behind a bounded queue: writers
+    # block once queue_size uploads are pending, so memory stays bounded by
+    # about queue_size * part_size.
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint: str = None, region: str = None,
+                 access_key: str = None, secret_key: str = None, part_size: int = PART_SIZE,
+                 workers: int = UPLOAD_WORKERS, queue_size: int = None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.region = region or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+        self.endpoint = (endpoint or os.environ.get("S3_ENDPOINT_URL") or f"https://s3.{self.region}.amazonaws.com").rstrip('/')
+        self.access_key = access_key or os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secret_key = secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY")
+        if not (self.access_key and self.secret_key):
+            raise ValueError("S3 storage needs AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY")
+        if part_size < parse_size("5MB"):
+            raise ValueError("S3 parts must be at least 5MB")
+        self.part_size = part_size
+        self.session = create_requests_session(workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(queue_size or workers * 2)
+
+    def url(self, key: str) -> str:
+        path = f"{self.prefix}/{key}" if self.prefix else key
+        return f"{self.endpoint}/{self.bucket}/{quote(path, safe='/-_.~')}"
+
+    def describe(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self.prefix + '/' if self.prefix else ''}{key}"
+
+    def request(self, method: str, key: str, query: str = "", data: bytes = b""):
+        url = self.url(key) + (f"?{query}" if query else "")
+        headers = sign_v4(method, url, {}, hashlib.sha256(data).hexdigest(), self.access_key, self.secret_key, self.region)
+        response = self.session.request(method, url, data=data, headers=headers)
+        if response.status_code >= 300 and not (method == "HEAD" and response.status_code == 404):
+            raise StorageError(f"{method} {self.describe(key)} failed: HTTP {response.status_code} {response.text[:200]}")
+        return response
+
+    def submit(self, function, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def open_write(self, key: str) -> S3Writer:
+        return S3Writer(self, key)
+
+    def exists(self, key: str) -> bool:
+        return self.request("HEAD", key).status_code == 200
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def parse_storage(spec: str) -> Storage:
+    # "DIR", "file:DIR", "tar:DIR" or "s3://bucket/prefix"
+    if spec.startswith("s3://"):
+        bucket, _, prefix = spec[len("s3://"):].partition('/')
+        if not bucket:
+            raise ValueError(f"Invalid S3 location {spec!r} (expected s3://bucket/prefix)")
+        return S3Storage(bucket, prefix)
+    if spec.startswith("tar:"):
+        return ShardedTarStorage(Path(spec[len("tar:"):]))
+    if spec.startswith("file:"):
+        spec = spec[len("file:"):]
+    return LocalStorage(Path(spec))
@@ -0,0 +1,79 @@
+import os
+import array
+import asyncio
+import logging
+from pathlib import Path
+
+# File suffixes of pages, stored as one byte per task
+PAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+# Page numbers come from file names, which may hold dates such as
+# scan_20240101.png, so they get a full unsigned 32-bit column
+PAGE_TYPECODE = 'I'
+MAX_PAGE_NUMBER = 2 ** (8 * array.array(PAGE_TYPECODE).itemsize) - 1
+
+
+class TaskTable:
+    # Pending (series, chapter, page) work held as parallel arrays: 9 bytes
+    # per page. Series and chapters are stored once; paths and URLs are only
+    # built when a task is handed out, and run_tasks() keeps a fixed number
+    # of workers instead of a coroutine per page, so a multi-million page
+    # backfill stays in the tens of megabytes.
+    def __init__(self):
+        self.series = []
+        self.chapters = []  # (series index, chapter number, chapter folder)
+        self._series_index = {}
+        self._chapter_index = {}
+        self.chapter = array.array('I')
+        self.page = array.array(PAGE_TYPECODE)
+        self.suffix = array.array('B')
+        self.names = {}  # task -> file name, for the rare page not named NNN.ext
+        self._last_key = None
+        self._last_chapter = None
+
+    def add(self, series: str, chapter: str, page: int, folder: Path, name: str = None):
+        if not 0 <= page <= MAX_PAGE_NUMBER:
+            logging.warning(f"Skipping {Path(folder, name or str(page))}: page number {page} is out of range")
+            return
+        key = (series, chapter, folder)
+        if key != self._last_key:
+            # Pages of one chapter arrive together, so this runs once per chapter
+            series_index = self._series_index.setdefault(series, len(self.series))
+            if series_index == len(self.series):
+                self.series.append(series)
+            entry = (series_index, chapter, str(folder))
+            self._last_chapter = self._chapter_index.setdefault(entry, len(self.chapters))
+            if self._last_chapter == len(self.chapters):
+                self.chapters.append(entry)
+            self._last_key = key
+        suffix = os.path.splitext(name)[1].lower() if name else PAGE_SUFFIXES[0]
+        code = PAGE_SUFFIXES.index(suffix) if suffix in PAGE_SUFFIXES else 0
+        if name is not None and name != f"{page:03d}{PAGE_SUFFIXES[code]}":
+            self.names[len(self.page)] = name
+        self.chapter.append(self._last_chapter)
+        self.page.append(page)
+        self.suffix.append(code)
+
+    def __len__(self) -> int:
+        return len(self.page)
+
+    def task(self, task: int) -> tuple:
+        # (series, chapter number, page number)
+        series_index, chapter, _ = self.chapters[self.chapter[task]]
+        return self.series[series_index], chapter, self.page[task]
+
+    def path(self, task: int) -> Path:
+        folder = self.chapters[self.chapter[task]][2]
+        name = self.names.get(task) or f"{self.page[task]:03d}{PAGE_SUFFIXES[self.suffix[task]]}"
+        return Path(folder, name)
+
+
+async def run_tasks(table: TaskTable, handle, concurrency: int):
+    # Awaits handle(task) for every task in table order, with at most
+    # `concurrency` running; the workers share one iterator over the indexes
+    tasks = iter(range(len(table)))
+
+    async def worker():
+        for task in tasks:
+            await handle(task)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(table)))))
@@ -0,0 +1,237 @@
+import io
+import os
+import sys
+import json
+import zipfile
+import argparse
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from convert_library import IMAGE_SUFFIXES
+from libraryserver import Catalog
+
+PACK_FILE = "thumbnails.pack"  # generation 0; compaction moves on to thumbnails.1.pack, ...
+INDEX_FILE = "thumbnails.json"
+THUMBNAIL_SIZE = (240, 360)
+THUMBNAIL_QUALITY = 80
+# Rewrite the pack once less than this share of it is still referenced
+COMPACT_BELOW = 0.5
+COVER_NAMES = {"cover", "poster"}
+
+
+def make_thumbnail(path: Path, member: str, size: tuple, quality: int = THUMBNAIL_QUALITY) -> bytes:
+    # Runs in a worker process and reads the source itself, so only the
+    # small JPEG travels back to the parent
+    from PIL import Image
+    if member is None:
+        data = path.read_bytes()
+    else:
+        with zipfile.ZipFile(path) as archive:
+            data = archive.read(member)
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", size)  # lets JPEG sources decode at reduced scale
+        image.thumbnail(size)
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def find_cover(folder: Path) -> Path:
+    for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+        stem, suffix = os.path.splitext(entry.name)
+        if entry.is_file() and suffix.lower() in IMAGE_SUFFIXES and (stem.lower() in COVER_NAMES or stem.lower().endswith("_poster")):
+            return Path(entry.path)
+    return None
+
+
+def pack_name(generation: int) -> str:
+    return f"thumbnails.{generation}.pack" if generation else PACK_FILE
+
+
+def stamp(path: Path) -> list:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class ThumbnailPack:
+    # Thumbnails of one series: JPEGs appended back to back in a pack file,
+    # and thumbnails.json naming that pack and mapping "cover" and each
+    # chapter number to {"offset", "length", "source", "stamp"}. A grid view
+    # loads the index and one file. Entries whose source is unchanged are
+    # kept; new ones are appended and a mostly stale pack is compacted into
+    # the next generation, so the previous index never points into a
+    # rewritten pack.
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.index_path = folder / INDEX_FILE
+        self.generation = 0
+        self.entries = {}
+        self.size = None
+        if self.index_path.exists():
+            try:
+                index = json.loads(self.index_path.read_text(encoding='utf-8'))
+                self.generation = index.get("generation", 0)
+                if (folder / pack_name(self.generation)).exists():
+                    self.entries = index["entries"]
+                    self.size = index["size"]
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Rebuilding damaged thumbnail index {self.index_path}: {e}")
+                self.entries = {}
+        self.pack_path = folder / pack_name(self.generation)
+        # The pack ends where the indexed entries end; anything after that was
+        # appended by an interrupted run
+        self.pack_size = max((entry["offset"] + entry["length"] for entry in self.entries.values()), default=0)
+
+    def current(self, key: str, source: str, source_stamp: list) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and entry["source"] == source and entry["stamp"] == source_stamp
+
+    def update(self, thumbnails: dict, keep: set, size: tuple):
+        # thumbnails: key -> (JPEG bytes, source, stamp); entries not in keep
+        # or thumbnails are dropped
+        entries = {key: entry for key, entry in self.entries.items() if key in keep and key not in thumbnails}
+        live = sum(entry["length"] for entry in entries.values())
+        generation, pack_size = self.generation, self.pack_size
+        if pack_size and live < pack_size * COMPACT_BELOW:
+            # Readers holding the current index keep reading the current pack
+            generation += 1
+            entries, pack_size = self._compact(entries, self.folder / pack_name(generation)), live
+        pack_path = self.folder / pack_name(generation)
+        # Appending leaves every indexed offset in place
+        with open(pack_path, 'ab') as pack:
+            pack.truncate(pack_size)
+            for key, (data, source, source_stamp) in thumbnails.items():
+                entries[key] = {"offset": pack_size, "length": len(data), "source": source, "stamp": source_stamp}
+                pack.write(data)
+                pack_size += len(data)
+        # Index last: until it is replaced, the old index still describes its pack
+        partial_path = self.index_path.with_name(self.index_path.name + ".part")
+        ordered = dict(sorted(entries.items(), key=lambda item: (item[0] != "cover", item[0])))
+        index = {"generation": generation, "pack": pack_path.name, "size": list(size), "entries": ordered}
+        partial_path.write_text(json.dumps(index), encoding='utf-8')
+        partial_path.replace(self.index_path)
+        if generation != self.generation:
+            # Keep the previous pack for clients that fetched the old index;
+            # anything older is unreferenced
+            for older in range(self.generation):
+                (self.folder / pack_name(older)).unlink(missing_ok=True)
+        self.generation, self.pack_path, self.pack_size = generation, pack_path, pack_size
+        self.entries = ordered
+        self.size = list(size)
+
+    def _compact(self, entries: dict, path: Path) -> dict:
+        compacted = {}
+        offset = 0
+        with open(self.pack_path, 'rb') as old, open(path, 'wb') as new:
+            for key, entry in sorted(entries.items(), key=lambda item: item[1]["offset"]):
+                old.seek(entry["offset"])
+                new.write(old.read(entry["length"]))
+                compacted[key] = dict(entry, offset=offset)
+                offset += entry["length"]
+        return compacted
+
+
+def series_sources(catalog: Catalog, folder: Path) -> dict:
+    # key -> (path, member or None, source name, stamp) of the image each
+    # thumbnail is made from: the cover file, and every chapter's first page
+    sources = {}
+    cover = find_cover(folder)
+    if cover is not None:
+        sources["cover"] = (cover, None, cover.name, stamp(cover))
+    for number, chapter in (catalog.chapters(folder.name) or {}).items():
+        try:
+            if "folder" in chapter:
+                pages = catalog.pages(chapter["folder"])
+                if pages:
+                    sources[number] = (pages[0], None, f"{chapter['folder'].name}/{pages[0].name}", stamp(pages[0]))
+            elif "cbz" in chapter:
+                members = catalog.members(chapter["cbz"])
+                if members:
+                    sources[number] = (chapter["cbz"], members[0].name, f"{chapter['cbz'].name}/{members[0].name}", stamp(chapter["cbz"]))
+        except (OSError, zipfile.BadZipFile) as e:
+            logging.warning(f"Skipping chapter {number} of {folder.name}: {e}")
+    return sources
+
+
+def build_thumbnails(roots: list, workers: int, size: tuple = THUMBNAIL_SIZE, rebuild: bool = False) -> bool:
+    catalog = Catalog(roots)
+    made = kept = failed = 0
+    in_flight = {}
+    pending = {}  # series folder -> [ThumbnailPack, thumbnails, keep, jobs left]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def finish(folder: Path):
+            pack, thumbnails, keep, _ = pending.pop(folder)
+            if thumbnails or set(pack.entries) - keep:
+                pack.update(thumbnails, keep, size)
+                logging.info(f"Updated thumbnails of {folder.name} ({len(thumbnails)} new, {len(keep) - len(thumbnails)} kept)")
+
+        def collect(futures):
+            nonlocal made, failed
+            for future in futures:
+                folder, key, source, source_stamp = in_flight.pop(future)
+                state = pending[folder]
+                try:
+                    state[1][key] = (future.result(), source, source_stamp)
+                    made += 1
+                except Exception as e:
+                    failed += 1
+                    state[2].discard(key)
+                    logging.error(f"Could not make thumbnail for {folder.name}/{source}: {e}")
+                state[3] -= 1
+                if not state[3]:
+                    finish(folder)
+
+        for folder in sorted(catalog.series().values()):
+            pack = ThumbnailPack(folder)
+            if rebuild or pack.size != list(size):
+                pack.entries = {}
+            sources = series_sources(catalog, folder)
+            jobs = [(key, source) for key, source in sources.items() if not pack.current(key, source[2], source[3])]
+            kept += len(sources) - len(jobs)
+            pending[folder] = [pack, {}, set(sources), len(jobs)]
+            if not jobs:
+                finish(folder)
+                continue
+            for key, (path, member, source, source_stamp) in jobs:
+                # Submit lazily so a huge library never queues every page at once
+                while len(in_flight) >= workers * 2:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                future = executor.submit(make_thumbnail, path, member, size)
+                in_flight[future] = (folder, key, source, source_stamp)
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(finished)
+    logging.info(f"Made {made} thumbnail(s), {kept} unchanged, {failed} failed.")
+    return failed == 0
+
+
+def parse_thumbnail_size(value: str) -> tuple:
+    width, _, height = value.lower().partition('x')
+    if not (width.isdigit() and height.isdigit() and int(width) and int(height)):
+        raise argparse.ArgumentTypeError(f"Invalid thumbnail size {value!r} (expected WIDTHxHEIGHT)")
+    return int(width), int(height)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build per-series thumbnail packs of covers and chapter first pages")
+    parser.add_argument('roots', nargs='+', type=Path, help="Library folders (e.g. Mangas MANGA)")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument('--size', type=parse_thumbnail_size, default=THUMBNAIL_SIZE, metavar='WxH',
+                        help=f"Largest thumbnail size (default {THUMBNAIL_SIZE[0]}x{THUMBNAIL_SIZE[1]})")
+    parser.add_argument('--rebuild', action='store_true', help="Remake every thumbnail instead of only new and changed ones")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    if not build_thumbnails(args.roots, max(1, args.workers), args.size, args.rebuild):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import re
-import requests
 import subprocess
 
+from httpclient import shared_requests_session
+
 def extract_text_from_html(html_content):
     awk_command = ["awk", "-F=", '/vm\.CurPathName/ {gsub(/"/, "", $2); if ($2 !~ /^https/) print $2}']
     result = subprocess.run(awk_command, input=html_content, capture_output=True, text=True)
@@ -23,7 +24,7 @@ def extract_text_from_url(manga_name, manga_chapter):
     
     url = f"https://manga4life.com/read-online/{manga_name}-chapter-{manga_chapter}.html"
     try:
-        response = requests.get(url)
+        response = shared_requests_session().get(url)
         if response.status_code == 200:
             html_content = response.text
             extract_text_from_html(html_content)
@@ -0,0 +1,294 @@
+import re
+import mmap
+import shutil
+import zipfile
+import argparse
+import logging
+from pathlib import Path
+
+from pdfobjects import PdfReader, PdfError, PdfName, Ref, Stream, serialize, decode_text, encode_text
+
+CHAPTER_FILE = re.compile(r'Chapter-(\d+(?:\.\d+)?)$')
+
+
+def chapter_sort_key(path: Path):
+    match = CHAPTER_FILE.match(path.stem)
+    return (float(match.group(1)) if match else float('inf'), path.name)
+
+
+def open_mapped(path: Path):
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PdfVolume:
+    # Builds a volume PDF by copying the page objects of chapter PDFs as-is.
+    # An existing volume is extended with an incremental update: new objects
+    # and the rewritten page tree/outline are appended after the old %%EOF.
+    def __init__(self, path: Path):
+        self.path = path
+        self.new_offsets = {}
+        self.pending_items = {}
+        self.chapters = []
+        self.last_item = None
+        if path.exists() and path.stat().st_size:
+            self._load()
+        else:
+            self.prev_xref = None
+            self.next_id = 4
+            self.root_ref, self.pages_ref, self.outlines_ref = Ref(1, 0), Ref(2, 0), Ref(3, 0)
+            self.catalog = {PdfName('/Type'): PdfName('/Catalog'), PdfName('/Pages'): self.pages_ref,
+                            PdfName('/Outlines'): self.outlines_ref, PdfName('/PageMode'): PdfName('/UseOutlines')}
+            self.catalog_changed = True
+            self.kids = []
+            self.outlines = {PdfName('/Type'): PdfName('/Outlines'), PdfName('/Count'): 0}
+            self.trailer_extra = {}
+        self.file = open(path, 'r+b' if path.exists() else 'w+b')
+        self.file.seek(0, 2)
+        self.pos = self.original_size = self.file.tell()
+        if self.prev_xref is None:
+            self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _load(self):
+        data = open_mapped(self.path)
+        try:
+            reader = PdfReader(data)
+            self.prev_xref = reader.startxref
+            self.next_id = int(reader.trailer['/Size'])
+            self.root_ref = reader.trailer['/Root']
+            self.catalog = dict(reader.root)
+            self.pages_ref = self.catalog['/Pages']
+            self.kids = [page_ref for page_ref, _ in reader.pages()]
+            self.trailer_extra = {key: reader.trailer[key] for key in ('/Info', '/ID') if key in reader.trailer}
+            if '/Outlines' in self.catalog:
+                self.outlines_ref = self.catalog['/Outlines']
+                self.outlines = dict(reader.resolve(self.outlines_ref))
+                self.catalog_changed = False
+                item_ref = self.outlines.get('/First')
+                while item_ref is not None:
+                    item = reader.resolve(item_ref)
+                    self.chapters.append(decode_text(reader.resolve(item.get('/Title', b''))))
+                    self.last_item = (item_ref, dict(item))
+                    item_ref = item.get('/Next')
+            else:
+                self.outlines_ref = Ref(self._allocate(), 0)
+                self.outlines = {PdfName('/Type'): PdfName('/Outlines'), PdfName('/Count'): 0}
+                self.catalog[PdfName('/Outlines')] = self.outlines_ref
+                self.catalog_changed = True
+        finally:
+            data.close()
+
+    def _write(self, data: bytes):
+        self.file.write(data)
+        self.pos += len(data)
+
+    def _allocate(self) -> int:
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def _write_object(self, object_id: int, obj):
+        self.new_offsets[object_id] = self.pos
+        self._write(f"{object_id} 0 obj\n".encode())
+        if isinstance(obj, Stream):
+            dictionary = dict(obj)
+            dictionary[PdfName('/Length')] = len(obj.data)
+            self._write(serialize(dictionary) + b'\nstream\n')
+            self._write(obj.data)
+            self._write(b'\nendstream\nendobj\n')
+        else:
+            self._write(serialize(obj) + b'\nendobj\n')
+
+    def _copy(self, reader: PdfReader, obj, mapping: dict):
+        # Gives every referenced object a new number and writes it once
+        if isinstance(obj, Ref):
+            if obj.num not in mapping:
+                mapping[obj.num] = self._allocate()
+                target = reader.get_object(obj.num)
+                self._write_object(mapping[obj.num], self._copy(reader, target, mapping))
+            return Ref(mapping[obj.num], 0)
+        if isinstance(obj, Stream):
+            return Stream({key: self._copy(reader, value, mapping) for key, value in obj.items() if key != '/Length'}, obj.data)
+        if isinstance(obj, dict):
+            return {key: self._copy(reader, value, mapping) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self._copy(reader, item, mapping) for item in obj]
+        return obj
+
+    def append_chapter(self, title: str, chapter_path: Path) -> int:
+        data = open_mapped(chapter_path)
+        try:
+            reader = PdfReader(data)
+            mapping = {}
+            page_ids = []
+            pages = list(reader.pages())
+            # Number the pages first so links between them stay inside the copy
+            for page_ref, _ in pages:
+                mapping[page_ref.num] = self._allocate()
+            for page_ref, inherited in pages:
+                page = dict(inherited)
+                page.update(reader.resolve(page_ref))
+                for key in ('/Parent', '/B', '/StructParents'):
+                    page.pop(key, None)
+                page = self._copy(reader, page, mapping)
+                page[PdfName('/Parent')] = self.pages_ref
+                self._write_object(mapping[page_ref.num], page)
+                page_ids.append(mapping[page_ref.num])
+        finally:
+            data.close()
+        if not page_ids:
+            return 0
+
+        self.kids.extend(Ref(page_id, 0) for page_id in page_ids)
+        item_id = self._allocate()
+        item = {PdfName('/Title'): encode_text(title), PdfName('/Parent'): self.outlines_ref,
+                PdfName('/Dest'): [Ref(page_ids[0], 0), PdfName('/Fit')]}
+        if self.last_item is None:
+            self.outlines[PdfName('/First')] = Ref(item_id, 0)
+        else:
+            previous_ref, previous = self.last_item
+            previous[PdfName('/Next')] = Ref(item_id, 0)
+            item[PdfName('/Prev')] = previous_ref
+            self.pending_items[previous_ref.num] = previous
+        self.outlines[PdfName('/Last')] = Ref(item_id, 0)
+        self.outlines[PdfName('/Count')] = len(self.chapters) + 1
+        self.last_item = (Ref(item_id, 0), item)
+        self.pending_items[item_id] = item
+        self.chapters.append(title)
+        return len(page_ids)
+
+    def abort(self):
+        # Drop the partial update so the previous revision stays readable
+        self.file.truncate(self.original_size)
+        self.file.close()
+
+    def close(self):
+        if self.prev_xref is not None and not self.new_offsets:
+            self.file.close()
+            return
+        # Outline items touched in this session are written once, here
+        for item_id, item in self.pending_items.items():
+            self._write_object(item_id, item)
+        self._write_object(self.pages_ref.num, {PdfName('/Type'): PdfName('/Pages'), PdfName('/Kids'): self.kids,
+                                                PdfName('/Count'): len(self.kids)})
+        self._write_object(self.outlines_ref.num, self.outlines)
+        if self.catalog_changed:
+            self._write_object(self.root_ref.num, self.catalog)
+
+        xref_offset = self.pos
+        lines = ["xref\n"]
+        if self.prev_xref is None:
+            lines.append("0 1\n0000000000 65535 f \n")
+        ids = sorted(self.new_offsets)
+        start = 0
+        while start < len(ids):
+            end = start
+            while end + 1 < len(ids) and ids[end + 1] == ids[end] + 1:
+                end += 1
+            lines.append(f"{ids[start]} {end - start + 1}\n")
+            lines.extend(f"{self.new_offsets[object_id]:010d} 00000 n \n" for object_id in ids[start:end + 1])
+            start = end + 1
+        self._write(''.join(lines).encode())
+        trailer = {PdfName('/Size'): self.next_id, PdfName('/Root'): self.root_ref, **self.trailer_extra}
+        if self.prev_xref is not None:
+            trailer[PdfName('/Prev')] = self.prev_xref
+        self._write(b'trailer\n' + serialize(trailer) + f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+        self.file.close()
+
+
+class CbzVolume:
+    # Appending to a ZIP only rewrites its central directory; member data of
+    # the existing chapters is left in place.
+    def __init__(self, path: Path):
+        self.path = path
+        self.created = not path.exists()
+        self.archive = zipfile.ZipFile(path, 'w' if self.created else 'a')
+        self.chapters = sorted({name.split('/', 1)[0] for name in self.archive.namelist() if '/' in name})
+        if not self.created:
+            # New members overwrite the central directory; abort() puts it back
+            self.original_end = self.archive.start_dir
+            with open(path, 'rb') as file:
+                file.seek(self.original_end)
+                self.original_directory = file.read()
+
+    def append_chapter(self, title: str, chapter_path: Path) -> int:
+        page_count = 0
+        with zipfile.ZipFile(chapter_path) as chapter:
+            for info in chapter.infolist():
+                if info.is_dir():
+                    continue
+                target = zipfile.ZipInfo(f"{title}/{Path(info.filename).name}", date_time=info.date_time)
+                target.compress_type = zipfile.ZIP_STORED
+                with chapter.open(info) as source, self.archive.open(target, 'w') as destination:
+                    shutil.copyfileobj(source, destination, 1024 * 1024)
+                page_count += 1
+        self.chapters.append(title)
+        return page_count
+
+    def abort(self):
+        # Drop every member written in this session so a failed chapter is not
+        # left half-copied (and then skipped as present on the next run)
+        self.archive.close()
+        if self.created:
+            self.path.unlink(missing_ok=True)
+            return
+        with open(self.path, 'r+b') as file:
+            file.seek(self.original_end)
+            file.write(self.original_directory)
+            file.truncate()
+
+    def close(self):
+        self.archive.close()
+
+
+def build_volume(output: Path, chapter_paths: list) -> int:
+    volume_class = PdfVolume if output.suffix.lower() == '.pdf' else CbzVolume
+    volume = volume_class(output)
+    added = 0
+    try:
+        for chapter_path in chapter_paths:
+            title = chapter_path.stem
+            if title in volume.chapters:
+                logging.info(f"{title} is already in {output.name}")
+                continue
+            page_count = volume.append_chapter(title, chapter_path)
+            logging.info(f"Added {title} ({page_count} pages)")
+            added += 1
+    except BaseException:
+        volume.abort()
+        raise
+    volume.close()
+    return added
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge chapter PDFs/CBZs into a volume without re-rendering")
+    parser.add_argument('output', type=Path, help="Volume file to create or extend (.pdf or .cbz)")
+    parser.add_argument('chapters', nargs='*', type=Path, help="Chapter files to append, in order")
+    parser.add_argument('-s', '--series', type=Path, help="Append every Chapter-NNNN file of this series folder")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parse_args()
+    suffix = args.output.suffix.lower()
+    if suffix not in ('.pdf', '.cbz'):
+        logging.error("The volume must be a .pdf or .cbz file.")
+        return
+    chapter_paths = list(args.chapters)
+    if args.series:
+        chapter_paths += sorted((path for path in args.series.glob(f"Chapter-*{suffix}") if path != args.output), key=chapter_sort_key)
+    if not chapter_paths:
+        logging.error("No chapter files given.")
+        return
+    try:
+        added = build_volume(args.output, chapter_paths)
+    except (PdfError, zipfile.BadZipFile) as e:
+        logging.error(f"Could not build {args.output}: {e}")
+        return
+    logging.info(f"Added {added} chapter(s) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()